@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+
+#Samples x families relative abundance matrix used downstream of the family aggregation.
+#Rows are grouped by Category, so the rows of one Category are a contiguous block and subsets
+#by Category are views of the same arrays. A family missing from a sample is NaN (no row in the long table).
+
+LONG_COLUMNS = ['family', 'sample_name', 'relative_abundance', 'patient', 'timepoint', 'Category']
+
+
+class AbundanceMatrix:
+    def __init__(self, values, samples, families, patient, timepoint, category):
+        self.values = values
+        self.samples = samples
+        self.families = families
+        self.patient = patient
+        self.timepoint = timepoint
+        self.category = category
+        self.sample_index = {sample: i for i, sample in enumerate(samples)}
+        self.family_index = {family: j for j, family in enumerate(families)}
+        self.blocks = _category_blocks(category)
+
+    @classmethod
+    def from_long(cls, species_abundance_avg_tagged):
+        #From the long table of add_patient_info (one row per family and sample)
+        data = species_abundance_avg_tagged
+        sample_codes, samples = pd.factorize(data['sample_name'].astype(object))
+        family_codes, families = pd.factorize(data['family'].astype(object))
+        samples = np.asarray(samples, dtype=object)
+        families = np.asarray(families, dtype=object)
+        values = np.full((len(samples), len(families)), np.nan, dtype=np.float32)
+        values[sample_codes, family_codes] = data['relative_abundance'].to_numpy(dtype=np.float32)
+        # Per sample metadata, from the first row of each sample
+        first_rows = np.unique(sample_codes, return_index=True)[1]
+        metadata = {}
+        for column in ['patient', 'timepoint', 'Category']:
+            if column in data.columns:
+                metadata[column] = data[column].astype(object).to_numpy()[first_rows]
+            else:
+                metadata[column] = np.full(len(samples), np.nan, dtype=object)
+        # Group the rows by Category (in order of appearance), keeping the sample order within a Category
+        category_codes = pd.factorize(pd.Series(metadata['Category']), use_na_sentinel=False)[0]
+        order = np.argsort(category_codes, kind='stable')
+        return cls(values[order], samples[order], families,
+                   metadata['patient'][order], metadata['timepoint'][order], metadata['Category'][order])
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def row(self, sample):
+        return self.values[self.sample_index[sample]]
+
+    def column(self, family):
+        return self.values[:, self.family_index[family]]
+
+    def subset(self, category):
+        #Rows of one Category, as views of this matrix' arrays
+        start, stop = self.blocks.get(category, (0, 0))
+        return self._take_rows(slice(start, stop))
+
+    def select(self, categories=None, families=None):
+        #Rows of the given Categories (in that order) and columns of the given families
+        matrix = self
+        if categories is not None:
+            bounds = [self.blocks[category] for category in categories if category in self.blocks]
+            if len(bounds) == 1 or all(bounds[i][1] == bounds[i + 1][0] for i in range(len(bounds) - 1)):
+                rows = slice(bounds[0][0], bounds[-1][1]) if bounds else slice(0, 0)
+            else:
+                rows = np.concatenate([np.arange(start, stop) for start, stop in bounds])
+            matrix = matrix._take_rows(rows)
+        if families is not None:
+            columns = [matrix.family_index[family] for family in families]
+            matrix = AbundanceMatrix(matrix.values[:, columns], matrix.samples, matrix.families[columns],
+                                     matrix.patient, matrix.timepoint, matrix.category)
+        return matrix
+
+    def timepoint_rows(self):
+        #Row positions of each timepoint, in order of appearance
+        timepoints = pd.unique(pd.Series(self.timepoint).dropna())
+        return {timepoint: np.flatnonzero(self.timepoint == timepoint) for timepoint in timepoints}
+
+    def max_by_family(self):
+        return pd.Series(np.nanmax(self.values, axis=0) if len(self.samples) else np.nan, index=self.families)
+
+    def to_long(self):
+        #Long format (family major, rows of missing families dropped), for the plotting libraries
+        n_samples, n_families = self.values.shape
+        flat = self.values.T.reshape(-1)
+        present = np.flatnonzero(~np.isnan(flat))
+        family_of_row, sample_of_row = np.divmod(present, n_samples)
+        return pd.DataFrame({
+            'family': self.families[family_of_row],
+            'sample_name': self.samples[sample_of_row],
+            'relative_abundance': flat[present].astype(float),
+            'patient': self.patient[sample_of_row],
+            'timepoint': self.timepoint[sample_of_row],
+            'Category': self.category[sample_of_row],
+        }, columns=LONG_COLUMNS)
+
+    def _take_rows(self, rows):
+        return AbundanceMatrix(self.values[rows], self.samples[rows], self.families,
+                               self.patient[rows], self.timepoint[rows], self.category[rows])
+
+
+
+def _category_blocks(category):
+    #(start, stop) of the rows of each Category, rows being grouped by Category
+    blocks = {}
+    for i, value in enumerate(category):
+        key = None if pd.isna(value) else value
+        start, _ = blocks.get(key, (i, i))
+        blocks[key] = (start, i + 1)
+    return blocks
@@ -1,75 +1,358 @@
-import seaborn as sns
-import matplotlib.pyplot as plt
-from plotnine import ggplot, aes, geom_bar, theme, element_text, labs, scale_fill_gradientn
-import pandas as pd
-import functions_analyze_cefprozil_effect as fn
-import sys
-from pandas.api.types import CategoricalDtype
-from scipy.stats import ttest_ind, f_oneway
-import os
-import warnings
+#Wall clock read before the imports below, so STARTUP_SECONDS is the import time of the analysis whether it
+#runs as a script or is imported by another module (the imports come after it on purpose)
+import time
+_import_start = time.perf_counter()
+import pandas as pd  # noqa: E402
+import functions_analyze_cefprozil_effect as fn  # noqa: E402
+import abundance_matrix as am  # noqa: E402
+from abundance_matrix import AbundanceMatrix  # noqa: E402
+from longitudinal import PatientTensor  # noqa: E402
+import stats_engine as se  # noqa: E402
+import sample_names as sn  # noqa: E402
+import taxonomy_index as ti  # noqa: E402
+import resampling as rs  # noqa: E402
+import diversity as dv  # noqa: E402
+import render  # noqa: E402
+import fast_render  # noqa: E402
+from render import PlotJob  # noqa: E402
+from stage_cache import StageCache  # noqa: E402
+import profiling  # noqa: E402
+import table_cache as tc  # noqa: E402
+import csr_store as csr  # noqa: E402
+import sys  # noqa: E402
+import os  # noqa: E402
+import tempfile  # noqa: E402
+import json  # noqa: E402
+import argparse  # noqa: E402
+import warnings  # noqa: E402
+#Only the plot functions import plotnine, seaborn and matplotlib, so runs without plots never load them
+STARTUP_SECONDS = time.perf_counter() - _import_start
 
 
-def main():
+#Cached stages of the pipeline, in order (per project stages are named <project_id>/<stage>)
+STAGES = ['metadata', 'select_projects', 'species_abundance', 'family_abundance', 'patient_info', 'timepoint_tests', 'diversity', 'beta_diversity']
+#What a run writes: tables and plots, tables only, or the test results only
+OUTPUT_MODES = ['all', 'no-plots', 'stats-only']
+#Plotting back ends: plotnine/seaborn, or direct matplotlib (fast_render)
+RENDERERS = ['default', 'fast']
+
+
+def main(argv=None):
+    run_start = time.perf_counter()
 
     #Known warnings to ignore
     warnings.filterwarnings("ignore", category=UserWarning, module='plotnine')
     warnings.filterwarnings("ignore", category=RuntimeWarning)
     warnings.filterwarnings("ignore", category=FutureWarning)
 
-    #Checking if the required arguments are provided
-    if len(sys.argv) < 3:
-        print("Error: Missing input directory or output directory.")
-        print("Usage: python analyze_cefprozil_effect.py <path/to/input_files> <path/to/save_results>")
-        print("Please provide the paths to the input files directory and the directory to save results.")
-        sys.exit(1)
-    
-    if len(sys.argv) > 3:
-        print("Error: Too many arguments provided.")
-        print("Usage: python analyze_cefprozil_effect.py <path/to/input_files> <path/to/save_results>")
-        print("Please provide only the paths to the input files directory and the directory to save results.")
-        sys.exit(1)
-    
+    args = parse_arguments(sys.argv[1:] if argv is None else argv)
+    sys_argv = [sys.argv[0], args.input_dir, args.output_dir]
+    outputs = 'stats-only' if args.stats_only else 'no-plots' if args.no_plots else 'all'
 
-    #Getting the raw data and the project data
-    samples_loaded, superkingdom, species_abundance, project,families_table = fn.get_raw_data(sys.argv)
+    #Without a batch config, only PRJEB8094 is analysed and its results go directly to the output directory
+    projects = fn.load_batch_config(args.config) if args.config else [dict(fn.project_settings(), output_dir='')]
+    #Plot options given on the command line apply to every project
+    plot_options = {'renderer': args.renderer, 'plot_formats': args.plot_format or None, 'plot_dpi': args.dpi, 'facets_per_page': args.facets_per_page,
+                    'diversity': args.diversity or None}
+    projects = [dict(settings, **{key: value for key, value in plot_options.items() if value is not None}) for settings in projects]
 
-    #Keeping only selected project (in our case: "PRJEB8094")
-    selected_project_data = fn.filter_project(project)
+    cache_dir = None if args.no_cache else (args.cache_dir or os.path.join(args.output_dir, ".stage_cache"))
+    profiler = profiling.Profiler(cprofile=args.profile_cprofile) if args.profile or args.profile_cprofile else None
+    cache = StageCache(cache_dir, args.cache_size_mb * 1024 ** 2, force=args.force, invalidate=args.invalidate, profiler=profiler)
+    run_batch(sys_argv, projects, cache, outputs)
 
-    #Adding accession ID from 'samples_loaded' to the selected project data
-    selected_project_w_accession = fn.add_accession_id(samples_loaded, selected_project_data)
+    #Measurements of every stage: Chrome trace, summary table and cProfile of the slowest stage
+    if profiler is not None:
+        print(profiler.write(os.path.join(args.output_dir, "profile_trace.json"), os.path.join(args.output_dir, "profile_summary.txt"),
+                             os.path.join(args.output_dir, "profile_slowest_stage.prof")))
 
-    #Adding super kingdom information to 'species_abundance' and filtering for rank level of species only
-    species_abundance_kingdom = fn.add_kingdom(species_abundance, superkingdom)
+    #Startup (import) time and run time, tracked across runs and by the benchmarks
+    run_info = {
+        'outputs': outputs,
+        'startup_seconds': STARTUP_SECONDS,
+        'run_seconds': time.perf_counter() - run_start,
+        'cached_stages': cache.hits,
+        'computed_stages': cache.misses,
+    }
+    with open(os.path.join(args.output_dir, "run_info.json"), 'w') as run_info_file:
+        json.dump(run_info, run_info_file, indent=2)
 
-    #Keeping only selected uids and desired information in 'species_abundance_kingdom'
-    filtered_species_abundance = fn.filter_species_abundance(selected_project_w_accession, species_abundance_kingdom)
 
-    #Match and addition of 'sample_name' to filtered_species_abundance from selected_project_w_accession
-    species_abundance_w_sample_name = fn.match_sample_name(selected_project_w_accession,filtered_species_abundance)
 
-    #Adding matching families to species_abundance_w_sample_name
-    species_abundance_family = fn.add_family(species_abundance_w_sample_name,families_table)
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog="analyze_cefprozil_effect.py",
+        description="Analysis of the effect of Cefprozil on gut microbiota.")
+    parser.add_argument("input_dir", help="path/to/input_files")
+    parser.add_argument("output_dir", help="path/to/save_results")
+    parser.add_argument("config", nargs='?', help="path/to/projects.json, to analyse several projects in one run")
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument("--no-plots", action='store_true', help="write the computed tables and test results, without plots")
+    modes.add_argument("--stats-only", action='store_true', help="write only the test results")
+    parser.add_argument("--force", action='store_true', help="recompute every stage, ignoring cached results")
+    parser.add_argument("--invalidate", action='append', default=[], metavar="STAGE",
+                        help=f"recompute STAGE and the stages after it (one of: {', '.join(STAGES)})")
+    parser.add_argument("--cache-dir", help="directory of the cached stage results (default: <output_dir>/.stage_cache)")
+    parser.add_argument("--cache-size-mb", type=int, default=2048, help="size limit of the stage cache")
+    parser.add_argument("--no-cache", action='store_true', help="do not read or write cached stage results")
+    parser.add_argument("--renderer", choices=RENDERERS, help="plotnine/seaborn plots ('default') or the faster direct matplotlib ones ('fast')")
+    parser.add_argument("--plot-format", action='append', default=[], metavar="FORMAT",
+                        help="file format of the plots (png, svg, pdf, ..., can be repeated), with --renderer fast")
+    parser.add_argument("--dpi", type=int, help="resolution of the plots, with --renderer fast")
+    parser.add_argument("--facets-per-page", type=int, help="split the family plot into pages of this many families, with --renderer fast")
+    parser.add_argument("--diversity", action='store_true', help="also compute the species level alpha and beta diversity of the samples")
+    parser.add_argument("--profile", action='store_true', help="measure every stage (time, memory, rows) into profile_trace.json and profile_summary.txt")
+    parser.add_argument("--profile-cprofile", action='store_true', help="like --profile, with a cProfile of the slowest stage")
+    args = parser.parse_args(argv)
+    unknown = [stage for stage in args.invalidate if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s) {', '.join(unknown)}, expected one of: {', '.join(STAGES)}")
+    #The plot options only apply to the fast renderer, of the command line or else of every project of the config
+    fast_options = [option for option, value in [("--plot-format", args.plot_format), ("--dpi", args.dpi), ("--facets-per-page", args.facets_per_page)] if value]
+    if fast_options:
+        projects = fn.load_batch_config(args.config) if args.config and args.renderer is None else [{'renderer': args.renderer}]
+        if any((settings.get('renderer') or 'default') != 'fast' for settings in projects):
+            parser.error(f"{', '.join(fast_options)} only apply to --renderer fast")
+    return args
+
+
+
+def run_batch(sys_argv, projects, cache=None, outputs='all'):
+    #Several projects share one scan of 'species_abundance.txt', each project writes to its own output directory
+    cache = cache or StageCache()
+    files_path = sys_argv[1]
+
+    #Getting the raw data and the project data ('species_abundance.txt' is streamed later)
+    metadata_files = [f"{files_path}/{name}" for name in ["samples_loaded.txt", "superkingdom2descendents.txt", "sample_to_run_info.txt", "families.csv"]]
+    samples_loaded, superkingdom, project,families_table = cache.run(
+        'metadata', fn.get_metadata, (sys_argv,), code=[fn.get_metadata, fn.read_input_table, tc], files=metadata_files)
+
+    #Keeping only the selected projects, with accession ID from 'samples_loaded'
+    selected_projects = cache.run(
+        'select_projects', select_projects, (samples_loaded, project, projects),
+        code=[select_projects, fn.filter_project, fn.add_accession_id],
+        params=[(settings['project_id'], list(settings['excluded_uids'])) for settings in projects], depends_on=['metadata'])
+
+    #Taxonomy and families compiled to flat arrays (loaded from their saved index when the files didn't change)
+    taxonomy = fn.load_taxonomy_index(sys_argv, superkingdom, families_table)
+
+    #One pass over 'species_abundance' for the uids of all projects (at rank level of species, with super kingdom information),
+    #then routing of the rows to each project
+    filtered_per_project = cache.run(
+        'species_abundance', scan_species_abundance, (sys_argv, selected_projects, superkingdom, taxonomy),
+        code=[scan_species_abundance, fn.load_species_abundance_kingdom, fn.split_species_abundance, fn.add_kingdom,
+              fn.filter_species_abundance, fn.species_abundance_columns, ti, tc, csr],
+        params={'taxonomy_index': taxonomy is not None},
+        files=[f"{files_path}/species_abundance.txt"], depends_on=['select_projects', 'metadata'])
+
+    species_matrices = []
+    for settings, selected_project_w_accession, filtered_species_abundance in zip(projects, selected_projects, filtered_per_project):
+        project_argv = [sys_argv[0], sys_argv[1], os.path.join(sys_argv[2], settings['output_dir'])]
+        os.makedirs(project_argv[2], exist_ok=True)
+        analyze_project(filtered_species_abundance, selected_project_w_accession, families_table, project_argv, settings, cache, outputs, taxonomy)
+        if settings.get('diversity'):
+            species_matrices.append(analyze_diversity(filtered_species_abundance, selected_project_w_accession, project_argv, settings, cache, outputs))
+
+    #Beta diversity between the samples of all the projects, grouped by project, Category and time point
+    if len(species_matrices) > 1:
+        matrix = dv.SpeciesMatrix.concat([matrix for matrix, metadata in species_matrices])
+        metadata = pd.concat([metadata for matrix, metadata in species_matrices], ignore_index=True)
+        groups = metadata['project'] + " " + diversity_groups(metadata)
+        diversity_stages = [f"{settings['project_id']}/diversity" for settings in projects if settings.get('diversity')]
+        beta_diversity_stage(cache, 'beta_diversity', matrix, metadata, groups, sys_argv[2], projects[0], outputs, "_projects", diversity_stages)
 
-    #Calculating relative aboundance by families
-    species_relative_abundance = fn.cal_relative_abundance(species_abundance_family, selected_project_w_accession)
-    fn.relative_abundance_plot(species_relative_abundance,sys.argv)
+
+
+def select_projects(samples_loaded, project, projects):
+    selected_projects = []
+    for settings in projects:
+        selected_project_data = fn.filter_project(project, settings['project_id'])
+        selected_projects.append(fn.add_accession_id(samples_loaded, selected_project_data, settings['excluded_uids']))
+    return selected_projects
+
+
+
+def scan_species_abundance(sys_argv, selected_projects, superkingdom, taxonomy=None):
+    all_uids = pd.concat([selected['loaded_uid'] for selected in selected_projects])
+    species_abundance_kingdom = fn.load_species_abundance_kingdom(sys_argv, all_uids, superkingdom, taxonomy=taxonomy)
+    return fn.split_species_abundance(selected_projects, species_abundance_kingdom)
+
+
+
+def analyze_project(filtered_species_abundance, selected_project_w_accession, families_table, sys_argv, settings=None, cache=None, outputs='all', taxonomy=None):
+    settings = fn.project_settings(settings)
+    cache = cache or StageCache()
+    stage = f"{settings['project_id']}/{{}}".format
+    patient_info_path = settings['patient_info'] or f"{sys_argv[1]}/patient_info.csv"
+
+    #Match and addition of 'sample_name' to filtered_species_abundance, adding matching families and calculating relative aboundance by families
+    species_relative_abundance = cache.run(
+        stage('family_abundance'), family_abundance, (filtered_species_abundance, selected_project_w_accession, families_table, taxonomy),
+        code=[family_abundance, fn.match_sample_name, fn.aggregate_family_abundance, ti],
+        depends_on=['species_abundance', 'select_projects', 'metadata'])
+    if outputs != 'stats-only':
+        species_relative_abundance.to_csv(os.path.join(sys_argv[2], "relative_abundance.csv"), index=False)
+    #Plots are gathered as jobs and rendered together once all the data and statistics are computed
+    bar_plot, families_plot, combined_plot, plot_kwargs = plot_functions(settings)
+    plot_jobs = [PlotJob(bar_plot, (species_relative_abundance.copy(), sys_argv, settings['sample_order'], settings['separators']), plot_kwargs)]
 
     #2nd analysis - difference between time points (for each family)
-    species_abundance_avg_tagged = fn.add_patient_info(species_relative_abundance, sys.argv)
-    control_data = fn.get_control_data(species_abundance_avg_tagged)
-    exposed_data = fn.get_exposed_data(species_abundance_avg_tagged)
-    significant_families_exposed = fn.plot_families_aboundance(exposed_data, "exposed", sys.argv)
+    abundance_matrix = cache.run(
+        stage('patient_info'), patient_matrix, (species_relative_abundance, sys_argv, settings['patient_info']),
+        code=[patient_matrix, fn.add_patient_info, sn, am], files=[patient_info_path], depends_on=[stage('family_abundance')])
+    #Change of every patient's families from day 0 to the later time points
+    if outputs != 'stats-only':
+        PatientTensor.from_matrix(abundance_matrix).deltas_table().to_csv(os.path.join(sys_argv[2], "paired_deltas.csv"), index=False)
+    test_params = {key: settings.get(key) for key in ['test', 'correction', 'n_permutations', 'n_jobs', 'seed']}
+    tests = cache.run(
+        stage('timepoint_tests'), timepoint_tests, (abundance_matrix, settings),
+        code=[timepoint_tests, compare_timepoints, se, am, PatientTensor, rs], params=test_params, depends_on=[stage('patient_info')])
+    if tests is None:
+        print(f"No exposed samples with patient information in {sys_argv[2]}, skipping the time point analysis.")
+        if outputs == 'all':
+            profiling.measure(cache.profiler, stage('render'), render.render_jobs, (plot_jobs, settings.get('render_jobs')), inputs=[])
+        return
+    exposed_results, significant_families, combined_results = tests
+    exposed_results.to_csv(os.path.join(sys_argv[2], "timepoint_tests_exposed.csv"), index=False)
+    if combined_results is not None:
+        combined_results.to_csv(os.path.join(sys_argv[2], "timepoint_tests_combined.csv"), index=False)
+    if outputs != 'all':
+        return
+    exposed_data = fn.get_exposed_data(abundance_matrix)
+    families_kwargs = dict(plot_kwargs, facets_per_page=settings.get('facets_per_page')) if families_plot is fast_render.plot_families_aboundance else plot_kwargs
+    plot_jobs.append(PlotJob(families_plot, (exposed_data, "exposed", sys_argv, exposed_results), families_kwargs))
     
-    #Filter for significant families in the exposed group and comparison to control group
-    significant_exposed_data = exposed_data[exposed_data['family'].isin(significant_families_exposed)]
-    significant_control_data = control_data[control_data['family'].isin(significant_families_exposed)]
-    for family in significant_families_exposed:
-        family_exposed_data = significant_exposed_data[significant_exposed_data['family'] == family]
-        family_control_data = significant_control_data[significant_control_data['family'] == family]
-        combined_data = pd.concat([family_exposed_data, family_control_data])
-        fn.plot_combined_families(combined_data, family, sys.argv)
+    #Comparison of the significant families in the exposed group to the control group
+    for family in significant_families:
+        combined_data = abundance_matrix.select(categories=["Exposed", "Control"], families=[family])
+        plot_jobs.append(PlotJob(combined_plot, (combined_data, family, sys_argv, combined_results[combined_results['family'] == family]), plot_kwargs))
+
+    profiling.measure(cache.profiler, stage('render'), render.render_jobs, (plot_jobs, settings.get('render_jobs')), inputs=[])
+
+
+
+def plot_functions(settings):
+    #(bar plot, families plot, combined plot, keyword arguments) of the project's renderer
+    if settings.get('renderer', 'default') == 'fast':
+        plot_kwargs = {'formats': settings.get('plot_formats') or ['png'], 'dpi': settings.get('plot_dpi')}
+        return fast_render.relative_abundance_plot, fast_render.plot_families_aboundance, fast_render.plot_combined_families, plot_kwargs
+    return fn.relative_abundance_plot, fn.plot_families_aboundance, fn.plot_combined_families, {}
+
+
+
+def family_abundance(filtered_species_abundance, selected_project_w_accession, families_table, taxonomy=None):
+    species_abundance_w_sample_name = fn.match_sample_name(selected_project_w_accession,filtered_species_abundance)
+    return fn.aggregate_family_abundance(species_abundance_w_sample_name, families_table, selected_project_w_accession, taxonomy)
+
+
+
+def patient_matrix(species_relative_abundance, sys_argv, patient_info_path):
+    species_abundance_avg_tagged = fn.add_patient_info(species_relative_abundance, sys_argv, patient_info_path)
+    return AbundanceMatrix.from_long(species_abundance_avg_tagged)
+
+
+
+def timepoint_tests(abundance_matrix, settings):
+    #Tests between time points of the exposed group, then of the exposed and control groups for the families
+    #significant in the exposed group. None when there are no exposed samples.
+    exposed_data = fn.get_exposed_data(abundance_matrix)
+    if exposed_data.shape[0] == 0:
+        return None
+    exposed_results = compare_timepoints(exposed_data, settings)
+    significant_families_exposed = set(se.significance_by_family(exposed_results))
+    significant_families = [family for family in exposed_data.families if family in significant_families_exposed]
+    combined_matrix = abundance_matrix.select(categories=["Exposed", "Control"], families=significant_families)
+    combined_results = compare_timepoints(combined_matrix, settings) if significant_families else None
+    return exposed_results, significant_families, combined_results
+
+
+
+def analyze_diversity(filtered_species_abundance, selected_project_w_accession, sys_argv, settings, cache=None, outputs='all'):
+    #Species level alpha diversity of the project's samples (tested between time points in each Category) and
+    #beta diversity between them. Returns the species matrix and the samples' information, for the comparison of projects.
+    cache = cache or StageCache()
+    stage = f"{settings['project_id']}/{{}}".format
+    patient_info_path = settings['patient_info'] or f"{sys_argv[1]}/patient_info.csv"
+    test_params = {key: settings.get(key) for key in ['test', 'correction', 'n_permutations', 'n_jobs', 'seed']}
+    matrix, metadata, alpha, alpha_tests = cache.run(
+        stage('diversity'), species_diversity, (filtered_species_abundance, selected_project_w_accession, sys_argv, settings),
+        code=[species_diversity, fn.match_sample_name, fn.add_patient_info, sn, dv, am, compare_timepoints, se, PatientTensor, rs], params=test_params,
+        files=[patient_info_path], depends_on=['species_abundance', 'select_projects', 'metadata'])
+    if outputs != 'stats-only':
+        alpha.to_csv(os.path.join(sys_argv[2], "alpha_diversity.csv"), index=False)
+    alpha_tests.to_csv(os.path.join(sys_argv[2], "alpha_diversity_tests.csv"), index=False)
+    beta_diversity_stage(cache, stage('beta_diversity'), matrix, metadata, diversity_groups(metadata), sys_argv[2], settings, outputs,
+                         depends_on=[stage('diversity')])
+    return matrix, metadata
+
+
+
+def species_diversity(filtered_species_abundance, selected_project_w_accession, sys_argv, settings):
+    species_abundance_w_sample_name = fn.match_sample_name(selected_project_w_accession, filtered_species_abundance)
+    matrix = dv.SpeciesMatrix.from_species_abundance(species_abundance_w_sample_name, selected_project_w_accession, settings['project_id'])
+    metadata = dv.sample_metadata(matrix, sys_argv, settings['patient_info'])
+    alpha = dv.alpha_diversity(matrix)
+    alpha_tagged = dv.alpha_matrix(alpha, metadata)
+    tests = []
+    for category in ["Exposed", "Control"]:
+        category_matrix = alpha_tagged.subset(category)
+        if category_matrix.shape[0]:
+            tests.append(compare_timepoints(category_matrix, settings).assign(Category=category))
+    alpha_tests = pd.concat(tests, ignore_index=True) if tests else pd.DataFrame(columns=['family', 'Category'])
+    alpha = alpha.merge(metadata[['sample_name', 'patient', 'timepoint', 'Category']], on='sample_name', how='left')
+    return matrix, metadata, alpha, alpha_tests.rename(columns={'family': 'metric'})
+
+
+
+def diversity_groups(metadata):
+    #'<Category> <time point>' of every sample (NaN without patient information)
+    return (metadata['Category'] + " " + metadata['timepoint'].astype(str)).where(metadata['Category'].notna())
+
+
+
+def beta_diversity_stage(cache, name, matrix, metadata, groups, output_dir, settings, outputs='all', suffix="", depends_on=()):
+    #Cached beta diversity and its tables. The cached result names the distance files it wrote, so it is
+    #computed again when one of them was removed or overwritten since.
+    args = (matrix, metadata, groups, output_dir, settings, outputs, suffix)
+    params = {'output_dir': os.path.abspath(output_dir), 'outputs': outputs, 'suffix': suffix}
+    run = lambda: cache.run(name, beta_diversity_distances, args, code=[beta_diversity_distances, dv], params=params, depends_on=depends_on)
+    result = run()
+    if any(not os.path.exists(path) or tc.source_key(path) != key for path, key in result['files'].items()):
+        cache.invalidated.add(name)
+        result = run()
+    pd.concat(result['groups'], ignore_index=True).to_csv(os.path.join(output_dir, f"beta_diversity_groups{suffix}.csv"), index=False)
+    if outputs != 'stats-only':
+        metadata.to_csv(os.path.join(output_dir, f"beta_diversity_samples{suffix}.csv"), index=False)
+        pd.concat(result['to_baseline'], ignore_index=True).to_csv(os.path.join(output_dir, f"beta_diversity_to_baseline{suffix}.csv"), index=False)
+
+
+
+def beta_diversity_distances(matrix, metadata, groups, output_dir, settings, outputs='all', suffix=""):
+    #Distances between the samples (beta_<metric><suffix>.npy, rows in the order of beta_diversity_samples<suffix>.csv),
+    #their means within and between the groups, and the distance of every sample to the patient's day 0 sample.
+    #Returns the tables and the distance files with their size and mtime; with 'stats-only' the distances are
+    #memory mapped to a temporary file, removed once the tables are computed.
+    result = {'files': {}, 'groups': [], 'to_baseline': []}
+    with tempfile.TemporaryDirectory(dir=output_dir) as temporary_dir:
+        for metric in dv.BETA_METRICS:
+            path = os.path.join(temporary_dir if outputs == 'stats-only' else output_dir, f"beta_{metric}{suffix}.npy")
+            distances = dv.beta_diversity(matrix, metric, path, n_jobs=settings.get('diversity_jobs') or os.cpu_count())
+            result['groups'].append(dv.group_distances(distances, groups).assign(metric=metric))
+            result['to_baseline'].append(dv.distance_to_baseline(distances, metadata).assign(metric=metric))
+            del distances
+            if outputs != 'stats-only':
+                result['files'][path] = tc.source_key(path)
+    return result
+
+
+
+def compare_timepoints(matrix, settings):
+    #Tests between time points for all families: t-tests, or permutation tests with bootstrap intervals
+    test, correction = settings.get('test', 'student'), settings.get('correction')
+    if test == 'permutation':
+        return rs.resample_timepoints(matrix, n_permutations=settings.get('n_permutations', 10000),
+                                      n_jobs=settings.get('n_jobs', 1), seed=settings.get('seed', 0), correction=correction)
+    return se.compare_timepoints(matrix, test, correction)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
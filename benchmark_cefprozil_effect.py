@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import functions_analyze_cefprozil_effect as fn
+from abundance_matrix import AbundanceMatrix
+import stats_engine as se
+import diversity as dv
+
+
+#Synthetic inputs with the schemas of the real input files, and a benchmark of every pipeline stage.
+#Run it with: python benchmark_cefprozil_effect.py [--scales 1 10 100] [--baseline benchmarks/baseline.json]
+#The timings and peak memory of each stage are compared to the baseline (if it exists), and any
+#regression beyond the tolerance makes the run fail. --update-baseline stores the current results instead.
+
+TIMEPOINTS = ["0", "7", "90"]
+#Size of the synthetic dataset at scale 1. Larger scales grow the projects, the patients of every project, the
+#runs of every sample and the species (of the taxonomy and of every run) by scale ** exponent, so the rows of
+#species_abundance.txt grow with the scale and the per project stages see more data too
+SCALE_1 = {'n_projects': 2, 'n_patients': 24, 'n_species': 300, 'runs_per_sample': 2, 'species_per_run': 60}
+SCALE_EXPONENTS = {'n_projects': 0.25, 'n_patients': 0.25, 'n_species': 0.25, 'runs_per_sample': 0.25, 'species_per_run': 0.25}
+DEFAULT_TOLERANCE = 0.3
+#Differences below these are noise, whatever the relative change
+MIN_SECONDS = 0.05
+MIN_BYTES = 1024 ** 2
+
+
+def generate_synthetic_inputs(path, n_projects=2, n_patients=24, n_species=300, runs_per_sample=2, species_per_run=60, seed=0):
+    #Write the six input files to 'path'. The first project is PRJEB8094; every project has 'n_patients'
+    #patients (3 in 4 exposed) sampled at days 0, 7 and 90, and samples are named like the real ones (P1E0, P6C7, ...).
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    species_per_run = min(species_per_run, n_species)
+
+    # Patients and samples
+    patients = [f"P{i}" for i in range(1, n_patients + 1)]
+    exposed = np.arange(n_patients) % 4 != 3
+    pd.DataFrame({
+        'patient': patients,
+        'Category': np.where(exposed, "Exposed", "Control"),
+        'Gender': rng.choice(["M", "F"], n_patients),
+        'Age': rng.integers(21, 36, n_patients),
+        'BMI': np.round(rng.normal(23, 2.5, n_patients), 2),
+    }).to_csv(os.path.join(path, "patient_info.csv"), index=False)
+    sample_names = [f"{patient}{'E' if is_exposed else 'C'}{tp}" for tp in TIMEPOINTS for patient, is_exposed in zip(patients, exposed)]
+    sample_is_exposed = np.tile(exposed, len(TIMEPOINTS))
+    sample_timepoint = np.repeat(TIMEPOINTS, n_patients)
+
+    # Runs of every project
+    project_ids = ["PRJEB8094"] + [f"PRJNA{100000 + i}" for i in range(1, n_projects)]
+    n_samples = len(sample_names)
+    runs_per_project = n_samples * runs_per_sample
+    n_runs = runs_per_project * n_projects
+    uids = np.arange(1, n_runs + 1)
+    run_ids = np.array([f"ERR{uid:07d}" for uid in uids])
+    run_sample = np.tile(np.repeat(np.arange(n_samples), runs_per_sample), n_projects)
+    pd.DataFrame({
+        'project_id': np.repeat(project_ids, runs_per_project),
+        'sample_name': np.array(sample_names)[run_sample],
+        'original_sample_description': "stool",
+        'run_id': run_ids,
+        'loaded_uid': uids,
+        # Mixed numbers and text, like the columns that need low_memory=False
+        'host_age': np.where(rng.random(n_runs) < 0.9, rng.integers(21, 36, n_runs).astype(str), "unknown"),
+    }).to_csv(os.path.join(path, "sample_to_run_info.txt"), sep='\t', index=False)
+    pd.DataFrame({
+        'uid': uids,
+        'accession_id': run_ids,
+        'nr_reads_sequenced': rng.integers(10 ** 5, 10 ** 7, n_runs),
+    }).to_csv(os.path.join(path, "samples_loaded.txt"), sep='\t', index=False)
+
+    # Taxonomy: species, the genera above them, and families for 90% of the species
+    n_families = max(5, n_species // 10)
+    n_genera = max(1, n_species // 3)
+    species_names = [f"Genus{i % n_genera} species{i}" for i in range(n_species)]
+    genus_names = [f"Genus{i}" for i in range(n_genera)]
+    species_ids = np.arange(1000, 1000 + n_species)
+    genus_ids = np.arange(1000 + n_species, 1000 + n_species + n_genera)
+    pd.DataFrame({
+        'ncbi_taxon_id': np.concatenate([species_ids, genus_ids]),
+        'scientific_name': species_names + genus_names,
+        'superkingdom': "Bacteria",
+    }).to_csv(os.path.join(path, "superkingdom2descendents.txt"), sep='\t', index=False)
+    species_family = rng.integers(0, n_families, n_species)
+    with_family = rng.random(n_species) < 0.9
+    families = pd.DataFrame({
+        'scientific_name': [name for name, known in zip(species_names, with_family) if known] + ["Other"],
+        'family': [f"{name}: Family{family}aceae" for name, family, known in zip(species_names, species_family, with_family) if known] + ["Other: Other"],
+    })
+    families.index = families.index + 1
+    # Same header as the real file: an unnamed index column and an unnamed family column
+    families.columns = ["levels.factor.species_abundance_3.scientific_name..", ""]
+    families.to_csv(os.path.join(path, "families.csv"))
+
+    # Abundances: 'species_per_run' species per run, plus 3 genus level rows that the pipeline drops
+    species_of_run = np.argsort(rng.random((n_runs, n_species)), axis=1)[:, :species_per_run]
+    abundance = rng.gamma(0.7, 1.0, (n_runs, species_per_run))
+    # The exposed patients lose families 0-2 at day 7, so there is something to find
+    run_exposed_day7 = sample_is_exposed[run_sample] & (sample_timepoint[run_sample] == "7")
+    affected = np.isin(species_family[species_of_run], [0, 1, 2])
+    abundance[run_exposed_day7[:, None] & affected] *= 0.2
+    abundance = abundance / abundance.sum(axis=1, keepdims=True) * 100
+    genus_of_run = rng.integers(0, n_genera, (n_runs, 3))
+    species_abundance = pd.DataFrame({
+        'loaded_uid': np.concatenate([np.repeat(uids, species_per_run), np.repeat(uids, 3)]),
+        'ncbi_taxon_id': np.concatenate([species_ids[species_of_run].reshape(-1), genus_ids[genus_of_run].reshape(-1)]),
+        'relative_abundance': np.concatenate([np.round(abundance.reshape(-1), 5), np.full(n_runs * 3, 50.0)]),
+        'taxon_rank_level': np.repeat(["species", "genus"], [n_runs * species_per_run, n_runs * 3]),
+    })
+    species_abundance = species_abundance.sort_values('loaded_uid', kind='stable').reset_index(drop=True)
+    species_abundance.insert(0, 'uid', np.arange(1, len(species_abundance) + 1))
+    species_abundance.to_csv(os.path.join(path, "species_abundance.txt"), sep='\t', index=False)
+    return ["benchmark_cefprozil_effect.py", path]
+
+
+
+def scale_settings(scale):
+    #Arguments of generate_synthetic_inputs at 'scale'
+    return {key: max(1, round(value * scale ** SCALE_EXPONENTS[key])) for key, value in SCALE_1.items()}
+
+
+
+def measure(function, *args):
+    #Wall time of one call, then peak traced memory of a second call
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'seconds': seconds, 'peak_bytes': peak_bytes}
+
+
+
+def benchmark_stages(sys_argv, plots=False):
+    #Time and peak memory of every pipeline stage on the inputs of 'sys_argv'
+    results = {}
+
+    def stage(name, function, *args):
+        result, results[name] = measure(function, *args)
+        return result
+
+    files_path = sys_argv[1]
+    stage('get_metadata_text', fn.get_metadata, sys_argv, False)
+    # First call builds the columnar caches, the measured calls read them
+    fn.get_metadata(sys_argv)
+    samples_loaded, superkingdom, project, families_table = stage('get_metadata_cached', fn.get_metadata, sys_argv)
+    selected_project_data = stage('filter_project', fn.filter_project, project)
+    selected_project_w_accession = stage('add_accession_id', fn.add_accession_id, samples_loaded, selected_project_data)
+    stage('stream_species_abundance_text', fn.stream_species_abundance, sys_argv, selected_project_w_accession, superkingdom, 1_000_000, False)
+    fn.load_species_abundance_kingdom(sys_argv, selected_project_w_accession['loaded_uid'], superkingdom)
+    filtered_species_abundance = stage('stream_species_abundance_cached', fn.stream_species_abundance, sys_argv, selected_project_w_accession, superkingdom)
+    species_abundance_w_sample_name = stage('match_sample_name', fn.match_sample_name, selected_project_w_accession, filtered_species_abundance)
+    taxonomy = stage('load_taxonomy_index', fn.load_taxonomy_index, sys_argv, superkingdom, families_table)
+    indexed_species_abundance = stage('stream_species_abundance_indexed', fn.stream_species_abundance, sys_argv, selected_project_w_accession, superkingdom, 1_000_000, True, taxonomy)
+    stage('aggregate_family_abundance_indexed', fn.aggregate_family_abundance,
+          fn.match_sample_name(selected_project_w_accession, indexed_species_abundance), families_table, selected_project_w_accession, taxonomy)
+    stage('add_family_cal_relative_abundance', lambda: fn.cal_relative_abundance(
+        fn.add_family(species_abundance_w_sample_name, families_table.copy()), selected_project_w_accession))
+    species_relative_abundance = stage('aggregate_family_abundance', fn.aggregate_family_abundance,
+                                       species_abundance_w_sample_name, families_table, selected_project_w_accession)
+    species_abundance_avg_tagged = stage('add_patient_info', fn.add_patient_info, species_relative_abundance, sys_argv)
+    abundance_matrix = stage('abundance_matrix', AbundanceMatrix.from_long, species_abundance_avg_tagged)
+    exposed_data = fn.get_exposed_data(abundance_matrix)
+    stage('compare_timepoints', se.compare_timepoints, exposed_data)
+    species_matrix = stage('species_matrix', dv.SpeciesMatrix.from_species_abundance, species_abundance_w_sample_name, selected_project_w_accession)
+    stage('alpha_diversity', dv.alpha_diversity, species_matrix)
+    for metric in dv.BETA_METRICS:
+        stage(f'beta_diversity_{metric}', dv.beta_diversity, species_matrix, metric)
+    if plots:
+        output_dir = os.path.join(files_path, "plots")
+        os.makedirs(output_dir, exist_ok=True)
+        plot_argv = [sys_argv[0], files_path, output_dir]
+        stage('relative_abundance_plot', fn.relative_abundance_plot, species_relative_abundance.copy(), plot_argv)
+        stage('plot_families_aboundance', fn.plot_families_aboundance, exposed_data, "exposed", plot_argv)
+    return results
+
+
+
+def startup_seconds():
+    #Import time (wall clock) of the entry script in a fresh interpreter
+    code = "import analyze_cefprozil_effect as a; print(a.STARTUP_SECONDS)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(result.stdout.strip())
+
+
+
+def run_benchmarks(scales, work_dir, plots=False):
+    results = {'startup': {'seconds': startup_seconds(), 'peak_bytes': 0}}
+    for scale in scales:
+        input_dir = os.path.join(work_dir, f"scale_{scale}")
+        settings = scale_settings(scale)
+        # Inputs of a previous run are reused unless they were generated with other settings
+        settings_path = os.path.join(input_dir, "synthetic_settings.json")
+        previous = None
+        if os.path.exists(settings_path):
+            with open(settings_path) as settings_file:
+                previous = json.load(settings_file)
+        if previous != settings:
+            generate_synthetic_inputs(input_dir, **settings)
+            with open(settings_path, 'w') as settings_file:
+                json.dump(settings, settings_file)
+        for name, measurement in benchmark_stages(["benchmark_cefprozil_effect.py", input_dir], plots).items():
+            results[f"{scale}x/{name}"] = measurement
+    return results
+
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    #Descriptions of the measurements that are worse than the baseline by more than 'tolerance'
+    regressions = []
+    for name, measurement in results.items():
+        if name not in baseline:
+            continue
+        for key, minimum in [('seconds', MIN_SECONDS), ('peak_bytes', MIN_BYTES)]:
+            current, reference = measurement[key], baseline[name][key]
+            if current > reference * (1 + tolerance) and current - reference > minimum:
+                regressions.append(f"{name} {key}: {current:.4g} (baseline {reference:.4g})")
+    return regressions
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the pipeline stages on synthetic inputs.")
+    parser.add_argument("--scales", type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument("--work-dir", default="benchmark_inputs", help="directory of the generated inputs (reused between runs)")
+    parser.add_argument("--baseline", default=os.path.join("benchmarks", "baseline.json"))
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--plots", action='store_true', help="also benchmark the plot functions")
+    parser.add_argument("--update-baseline", action='store_true', help="store the results as the new baseline")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scales, args.work_dir, args.plots)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    for name, measurement in results.items():
+        print(f"{name:<50} {measurement['seconds']:>10.4f} s {measurement['peak_bytes'] / 1024 ** 2:>10.1f} MB")
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline to create one.")
+        return 0
+    with open(args.baseline) as baseline_file:
+        regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+import io
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+import table_cache as tc
+
+
+#On-disk CSR store of 'species_abundance.txt': one row per sample (loaded_uid), holding the taxon ids
+#('indices'), abundances ('values') and rank codes of its rows in file order, with 'indptr' giving the
+#slice of each row. The arrays are raw files memory-mapped on open, and a sorted uid -> row lookup makes
+#fetching the rows of a set of samples proportional to the rows returned, whatever the file size.
+#The store is made of segments: rows added to the source file after it was built (or given to append())
+#are written as a new segment, so growing the data never rebuilds the existing segments. A sample can have
+#rows in several segments, they are returned in segment order, i.e. in file order.
+#Like the columnar caches, a store is built in a private directory and raises OSError where it can't be written.
+
+FORMAT_VERSION = 1
+UID, TAXON, VALUE, RANK = 'loaded_uid', 'ncbi_taxon_id', 'relative_abundance', 'taxon_rank_level'
+STORED_COLUMNS = [UID, TAXON, VALUE, RANK]
+HASH_BLOCK_SIZE = tc.HASH_BLOCK_SIZE
+
+
+def default_store_dir(path):
+    return os.path.join(tc.default_cache_dir(path), os.path.basename(path) + ".csr")
+
+
+
+def _memmap(path, dtype, length):
+    if length == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(length,))
+
+
+
+class CSRStore:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json")) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.columns = self.manifest['columns']
+        self.rank_categories = self.manifest['rank_categories']
+        self.segments = [self._open_segment(segment) for segment in self.manifest['segments']]
+        # uid -> (segment, row) pairs, sorted by uid then segment
+        uids = [segment['uids'] for segment in self.segments]
+        segment_of_row = [np.full(len(segment['uids']), i, dtype=np.int32) for i, segment in enumerate(self.segments)]
+        row_in_segment = [np.arange(len(segment['uids']), dtype=np.int64) for segment in self.segments]
+        uids = np.concatenate(uids) if uids else np.empty(0, dtype=np.int64)
+        order = np.argsort(uids, kind='stable')
+        self.uids = uids[order]
+        self.segment_of_row = np.concatenate(segment_of_row)[order] if segment_of_row else np.empty(0, dtype=np.int32)
+        self.row_in_segment = np.concatenate(row_in_segment)[order] if row_in_segment else np.empty(0, dtype=np.int64)
+
+    def _open_segment(self, segment):
+        directory, dtypes = os.path.join(self.directory, segment['name']), self.manifest['dtypes']
+        n_rows, nnz = segment['n_rows'], segment['nnz']
+        return {
+            'uids': _memmap(os.path.join(directory, "uids.bin"), dtypes[UID], n_rows),
+            'indptr': _memmap(os.path.join(directory, "indptr.bin"), np.int64, n_rows + 1) if n_rows else np.zeros(1, dtype=np.int64),
+            'indices': _memmap(os.path.join(directory, "indices.bin"), dtypes[TAXON], nnz),
+            'values': _memmap(os.path.join(directory, "values.bin"), dtypes[VALUE], nnz),
+            'ranks': _memmap(os.path.join(directory, "ranks.bin"), np.int16, nnz),
+        }
+
+    @property
+    def nnz(self):
+        return sum(segment['nnz'] for segment in self.manifest['segments'])
+
+    def row(self, uid):
+        #(taxon ids, abundances, rank codes) of one sample: views of the mapped arrays when it is in one segment
+        start, stop = np.searchsorted(self.uids, uid, 'left'), np.searchsorted(self.uids, uid, 'right')
+        parts = [self._slice(self.segment_of_row[i], self.row_in_segment[i]) for i in range(start, stop)]
+        if len(parts) == 1:
+            return parts[0]
+        return tuple(np.concatenate([part[k] for part in parts]) if parts else np.empty(0) for k in range(3))
+
+    def _slice(self, segment_index, row):
+        segment = self.segments[segment_index]
+        start, stop = segment['indptr'][row], segment['indptr'][row + 1]
+        return segment['indices'][start:stop], segment['values'][start:stop], segment['ranks'][start:stop]
+
+    def read(self, loaded_uids, columns=None, rank=None):
+        #Rows of the given samples (each uid once, in the given order, rows of a sample in file order) as a
+        #DataFrame of the stored 'columns' (default: all), keeping only rows at 'rank' when it is given
+        columns = self.columns if columns is None else [column for column in self.columns if column in columns]
+        wanted = pd.unique(pd.Series(loaded_uids).dropna()).astype(self.uids.dtype, copy=False) if len(loaded_uids) else self.uids[:0]
+        starts, stops = np.searchsorted(self.uids, wanted, 'left'), np.searchsorted(self.uids, wanted, 'right')
+        pairs = [(self.segment_of_row[i], self.row_in_segment[i], uid) for uid, start, stop in zip(wanted, starts, stops) for i in range(start, stop)]
+        slices = [self._slice(segment_index, row) for segment_index, row, uid in pairs]
+        lengths = np.array([len(indices) for indices, values, ranks in slices], dtype=np.int64)
+        dtypes = self.manifest['dtypes']
+
+        def gather(k, dtype):
+            return np.concatenate([part[k] for part in slices]) if slices else np.empty(0, dtype=dtype)
+        data = {
+            UID: np.repeat(np.array([uid for segment_index, row, uid in pairs], dtype=dtypes[UID]), lengths),
+            TAXON: gather(0, dtypes[TAXON]), VALUE: gather(1, dtypes[VALUE]), RANK: gather(2, np.int16),
+        }
+        if rank is not None:
+            keep = data[RANK] == (self.rank_categories.index(rank) if rank in self.rank_categories else -2)
+            data = {name: values[keep] for name, values in data.items()}
+        if RANK in columns:
+            lookup = np.array(self.rank_categories + [np.nan], dtype=object)
+            data[RANK] = pd.Series(lookup.take(data[RANK].astype(np.int64)), dtype=self.manifest['rank_dtype'])
+        return pd.DataFrame({column: data[column] for column in columns}, columns=columns)
+
+    def append(self, species_abundance):
+        #Add the rows of a DataFrame with the source columns as a new segment (existing segments are kept)
+        _write_segment(self.directory, self.manifest, species_abundance)
+        _save_manifest(self.directory, self.manifest)
+        self.__init__(self.directory)
+
+
+
+def _encode_ranks(manifest, ranks, length):
+    #Rank codes in the manifest's categories, adding the new ones (-1 for missing ranks)
+    codes = np.full(length, -1, dtype=np.int16)
+    if ranks is None:
+        return codes
+    ranks = pd.Series(ranks)
+    for value in pd.unique(ranks.dropna()):
+        if value not in manifest['rank_categories']:
+            manifest['rank_categories'].append(value)
+    present = ranks.notna().to_numpy()
+    codes[present] = pd.Index(manifest['rank_categories']).get_indexer(ranks[present])
+    return codes
+
+
+
+def _write_segment(directory, manifest, species_abundance):
+    #Group the rows by uid (stable, so a sample's rows stay in file order) and write them as a segment
+    uids = np.asarray(species_abundance[UID])
+    keep = ~pd.isna(uids)
+    dtypes = manifest['dtypes']
+    uids = uids[keep].astype(dtypes[UID])
+    indices = np.asarray(species_abundance[TAXON])[keep].astype(dtypes[TAXON])
+    values = np.asarray(species_abundance[VALUE])[keep].astype(dtypes[VALUE])
+    ranks = _encode_ranks(manifest, species_abundance[RANK][keep] if RANK in species_abundance.columns else None, len(uids))
+    order = np.argsort(uids, kind='stable')
+    uids, indices, values, ranks = uids[order], indices[order], values[order], ranks[order]
+    starts = np.flatnonzero(np.r_[True, uids[1:] != uids[:-1]]) if len(uids) else np.empty(0, dtype=np.int64)
+    indptr = np.append(starts, len(uids)).astype(np.int64)
+    name = f"segment_{len(manifest['segments'])}"
+    os.makedirs(os.path.join(directory, name), exist_ok=True)
+    for file_name, array in [("uids.bin", uids[starts]), ("indptr.bin", indptr), ("indices.bin", indices),
+                             ("values.bin", values), ("ranks.bin", ranks)]:
+        array.tofile(os.path.join(directory, name, file_name))
+    manifest['segments'].append({'name': name, 'n_rows': len(starts), 'nnz': len(uids)})
+
+
+
+def _save_manifest(directory, manifest):
+    manifest_path = os.path.join(directory, "manifest.json")
+    with open(manifest_path + ".tmp", 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+
+def build_store(path, directory, chunksize=tc.DEFAULT_CHUNKSIZE):
+    #Build the store of 'path' from its columnar cache, one segment per 'chunksize' rows. None when the file
+    #doesn't have the stored columns as numbers (the row filters then stay on the columnar cache).
+    table = tc.open_table(path, chunksize=chunksize, delimiter='\t')
+    meta = {column['name']: column for column in table.manifest['columns']}
+    if any(column not in meta for column in [UID, TAXON, VALUE]) or any(meta[column]['kind'] == 'category' for column in [UID, TAXON, VALUE]):
+        return None
+    if RANK in meta and meta[RANK]['kind'] != 'category':
+        return None
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'source': dict(table.manifest['source']),
+        'header': table.columns,
+        'columns': [column for column in table.columns if column in STORED_COLUMNS],
+        'dtypes': {column: meta[column]['source_dtype'] for column in [UID, TAXON, VALUE]},
+        'rank_dtype': meta[RANK]['source_dtype'] if RANK in meta else 'object',
+        'rank_categories': [],
+        'segments': [],
+    }
+    if RANK in meta:
+        manifest['rank_categories'] = table.categories(RANK)
+    building = tc.make_build_dir(directory)
+    try:
+        # One segment per 'chunksize' rows of the memory-mapped columns, so the build holds a chunk at a time
+        for start in range(0, max(table.num_rows, 1), chunksize):
+            rows = slice(start, start + chunksize)
+            chunk = {column: table.column(column, rows) for column in manifest['columns'] if column != RANK}
+            if RANK in meta:
+                chunk[RANK] = pd.Categorical.from_codes(np.asarray(table.raw_column(RANK)[rows]).astype(np.int64), categories=manifest['rank_categories'])
+            _write_segment(building, manifest, pd.DataFrame(chunk))
+        _save_manifest(building, manifest)
+    except BaseException:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    tc.install_build(building, directory)
+    return CSRStore(directory)
+
+
+
+def _prefix_digest(path, size):
+    #sha256 object of the first 'size' bytes of 'path'
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        remaining = size
+        while remaining > 0:
+            block = source.read(min(HASH_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+
+
+def _append_tail(path, directory, manifest, chunksize):
+    #The source grew by appended rows: parse only the new bytes and add them as a segment.
+    #False when the old content isn't a prefix of the file (then the store is rebuilt).
+    source = manifest['source']
+    stat = tc.source_key(path)
+    if stat['size'] <= source['size']:
+        return False
+    digest = _prefix_digest(path, source['size'])
+    if digest.hexdigest() != source['sha256']:
+        return False
+    with open(path, 'rb') as source_file:
+        source_file.seek(source['size'] - 1)
+        if source_file.read(1) != b"\n":
+            return False
+        tail = source_file.read()
+    digest.update(tail)
+    usecols = [column for column in manifest['header'] if column in STORED_COLUMNS]
+    dtype = {RANK: object} if RANK in usecols else None
+    for chunk in pd.read_csv(io.BytesIO(tail), delimiter='\t', header=None, names=manifest['header'], usecols=usecols, dtype=dtype, chunksize=chunksize):
+        _write_segment(directory, manifest, chunk)
+    manifest['source'] = dict(stat, sha256=digest.hexdigest())
+    _save_manifest(directory, manifest)
+    return True
+
+
+
+def open_store(path, directory=None, chunksize=tc.DEFAULT_CHUNKSIZE):
+    #Store of 'path': opened as is when the source is unchanged, extended with a segment when rows were
+    #appended to it, rebuilt otherwise. None when the file can't be stored (see build_store).
+    directory = directory or default_store_dir(path)
+    manifest_path = os.path.join(directory, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('format_version') == FORMAT_VERSION:
+            source, stat = manifest['source'], tc.source_key(path)
+            if (stat['size'], stat['mtime_ns']) == (source['size'], source['mtime_ns']):
+                return CSRStore(directory)
+            if stat['size'] == source['size'] and tc.file_sha256(path) == source['sha256']:
+                source.update(stat)
+                try:
+                    _save_manifest(directory, manifest)
+                except OSError:
+                    #Read-only store: the content hash is checked again next time
+                    pass
+                return CSRStore(directory)
+            if _append_tail(path, directory, manifest, chunksize):
+                return CSRStore(directory)
+    return build_store(path, directory, chunksize)
@@ -0,0 +1,268 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from scipy.spatial.distance import cdist
+import functions_analyze_cefprozil_effect as fn
+import taxonomy_index as ti
+from abundance_matrix import AbundanceMatrix
+
+
+#Species level diversity of the samples, from the rows of filter_species_abundance matched to their samples.
+#The samples x species abundances are kept as a sparse matrix (a sample has a few hundred of the species).
+#Alpha diversity of all the samples is computed at once from the non zero entries; beta diversity is computed
+#in blocks of samples x samples on a pool of processes, and written to a condensed distance vector (the upper
+#triangle of the distance matrix, row by row, as scipy.spatial.distance.squareform), memory mapped to a .npy file
+#for large numbers of samples.
+
+ALPHA_METRICS = ['richness', 'shannon', 'simpson']
+BETA_METRICS = ['braycurtis', 'jaccard']
+#Samples per block of the pairwise distances (a block of 256 samples x 10000 species is 20MB)
+BLOCK_SIZE = 256
+SAMPLE_COLUMNS = ['sample_name', 'project', 'patient', 'timepoint', 'Category']
+
+
+class SpeciesMatrix:
+    def __init__(self, values, samples, species, project=None):
+        #'values': samples x species sparse (CSR) matrix of relative abundances, 'project': project of every sample
+        self.values = values
+        self.samples = samples
+        self.species = species
+        self.project = project if project is not None else np.full(len(samples), None, dtype=object)
+
+    @classmethod
+    def from_species_abundance(cls, species_abundance_w_sample_name, selected_project_w_accession, project=None):
+        #Mean relative abundance of every species over the runs of each sample (as aggregate_family_abundance
+        #does for families). Rows of unknown species ("Other") are left out.
+        names = species_abundance_w_sample_name['scientific_name'].astype(object)
+        sample_codes, samples = pd.factorize(species_abundance_w_sample_name['sample_name'])
+        keep = names.notna().to_numpy() & (names != ti.OTHER).to_numpy() & (sample_codes >= 0)
+        species_codes, species = pd.factorize(names[keep])
+        weights = np.nan_to_num(species_abundance_w_sample_name['relative_abundance'].to_numpy(dtype=float)[keep])
+        values = sparse.csr_matrix((weights, (sample_codes[keep], species_codes)), shape=(len(samples), len(species)))
+        values.eliminate_zeros()
+        run_codes = pd.Index(samples).get_indexer(selected_project_w_accession['sample_name'])
+        runs = np.bincount(run_codes[run_codes >= 0], minlength=len(samples))
+        values.data /= np.repeat(np.maximum(runs, 1), np.diff(values.indptr))
+        return cls(values, np.asarray(samples, dtype=object), np.asarray(species, dtype=object),
+                   np.full(len(samples), project, dtype=object))
+
+    @classmethod
+    def concat(cls, matrices):
+        #Samples of several matrices (of several projects) on the union of their species
+        species = pd.Index(np.concatenate([matrix.species for matrix in matrices])).unique()
+        blocks = []
+        for matrix in matrices:
+            columns = species.get_indexer(matrix.species)
+            entries = matrix.values.tocoo()
+            blocks.append(sparse.csr_matrix((entries.data, (entries.row, columns[entries.col])), shape=(len(matrix.samples), len(species))))
+        return cls(sparse.vstack(blocks, format='csr'), np.concatenate([matrix.samples for matrix in matrices]),
+                   np.asarray(species, dtype=object), np.concatenate([matrix.project for matrix in matrices]))
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def row_ids(self):
+        #Row of every non zero entry
+        return np.repeat(np.arange(self.values.shape[0]), np.diff(self.values.indptr))
+
+    def proportions(self):
+        #Abundances divided by the total of their sample
+        totals = np.asarray(self.values.sum(axis=1)).ravel()
+        proportions = self.values.copy()
+        proportions.data = proportions.data / totals[self.row_ids()]
+        return proportions
+
+    def presence(self):
+        proportions = self.values.copy()
+        proportions.data = np.ones_like(proportions.data)
+        return proportions
+
+
+
+def alpha_diversity(matrix):
+    #Richness (number of species), Shannon index (natural log) and Gini-Simpson index (1 - sum of squared
+    #proportions) of every sample, from the proportions of the non zero entries summed per row.
+    #Shannon and Simpson are NaN for the samples without any species.
+    n_samples = matrix.shape[0]
+    rows = matrix.row_ids()
+    p = matrix.proportions().data
+    richness = np.bincount(rows, minlength=n_samples)
+    empty = np.where(richness > 0, 0.0, np.nan)
+    return pd.DataFrame({
+        'sample_name': matrix.samples,
+        'project': matrix.project,
+        'richness': richness.astype(np.int64),
+        'shannon': -np.bincount(rows, weights=p * np.log(p), minlength=n_samples) + empty,
+        'simpson': 1.0 - np.bincount(rows, weights=p * p, minlength=n_samples) + empty,
+    })
+
+
+
+def condensed_index(n, i, j):
+    #Position of the distance between samples i < j in the condensed vector of n samples
+    i, j = np.asarray(i), np.asarray(j)
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+
+#Rows of the matrix the distances are computed from, set once in every worker process
+_rows = None
+
+
+def _set_rows(rows):
+    global _rows
+    _rows = rows
+
+
+
+def _distance_block(task):
+    #Distances between the samples of rows [i0, i1) and [j0, j1). Written to the .npy file when there is one
+    #(by a worker process), returned otherwise.
+    i0, i1, j0, j1, metric, n, path = task
+    counts_i = np.diff(_rows.indptr[i0:i1 + 1])
+    counts_j = np.diff(_rows.indptr[j0:j1 + 1])
+    if metric == 'braycurtis':
+        # With proportions summing to 1, Bray-Curtis is sum |u - v| / 2 (faster than cdist's 'braycurtis');
+        # 1 between an empty sample and another one, NaN between two empty samples
+        block = cdist(_rows[i0:i1].toarray(), _rows[j0:j1].toarray(), 'cityblock') / 2
+        block[counts_i == 0] = 1.0
+        block[:, counts_j == 0] = 1.0
+        block[np.ix_(counts_i == 0, counts_j == 0)] = np.nan
+    else:
+        # Jaccard distance of the species present: 1 - shared / (present in either), 0 between two empty samples
+        shared = (_rows[i0:i1] @ _rows[j0:j1].T).toarray()
+        union = counts_i[:, None] + counts_j[None, :] - shared
+        block = np.where(union > 0, 1.0 - shared / np.maximum(union, 1), 0.0)
+    if path is None:
+        return block
+    distances = np.load(path, mmap_mode='r+')
+    _write_block(distances, n, i0, j0, block)
+    distances.flush()
+    return None
+
+
+
+def _write_block(distances, n, i0, j0, block):
+    # The part of every row above the diagonal is contiguous in the condensed vector
+    j1 = j0 + block.shape[1]
+    for k in range(block.shape[0]):
+        i = i0 + k
+        first = max(j0, i + 1)
+        if first >= j1:
+            continue
+        start = condensed_index(n, i, first)
+        distances[start:start + j1 - first] = block[k, first - j0:]
+
+
+
+class _SerialExecutor:
+    def map(self, function, tasks):
+        return map(function, tasks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        _set_rows(None)
+        return False
+
+
+
+def beta_diversity(matrix, metric='braycurtis', path=None, block_size=BLOCK_SIZE, n_jobs=1):
+    #Condensed vector of the distances between all the samples: Bray-Curtis of the proportions or Jaccard of
+    #the species present. Written to a memory mapped .npy file at 'path' (np.load(path, mmap_mode='r') reads it
+    #back), or kept in memory without a path (the workers then send their blocks back).
+    if metric not in BETA_METRICS:
+        raise ValueError(f"unknown beta diversity metric '{metric}', expected one of: {', '.join(BETA_METRICS)}")
+    rows = matrix.proportions() if metric == 'braycurtis' else matrix.presence()
+    n = matrix.shape[0]
+    size = n * (n - 1) // 2
+    if path is None:
+        distances = np.empty(size)
+    else:
+        distances = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(size,))
+    starts = range(0, n, block_size)
+    # The blocks of the upper triangle, on the workers when there are several
+    parallel = bool(n_jobs and n_jobs > 1) and len(starts) > 1
+    if parallel:
+        if path is not None:
+            distances.flush()
+        executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=_set_rows, initargs=(rows,))
+    else:
+        _set_rows(rows)
+        executor = _SerialExecutor()
+    tasks = [(i0, min(i0 + block_size, n), j0, min(j0 + block_size, n), metric, n, path if parallel else None)
+             for i0 in starts for j0 in starts if j0 >= i0]
+    with executor:
+        for task, block in zip(tasks, executor.map(_distance_block, tasks)):
+            if block is not None:
+                _write_block(distances, n, task[0], task[2], block)
+    if path is not None:
+        distances.flush()
+    return distances
+
+
+
+def sample_metadata(matrix, sys_argv, patient_info_path=None):
+    #Patient, time point and Category of every sample, from its name and the patient information (as add_patient_info)
+    samples = pd.DataFrame({'sample_name': matrix.samples, 'project': matrix.project})
+    return fn.add_patient_info(samples, sys_argv, patient_info_path)[SAMPLE_COLUMNS].reset_index(drop=True)
+
+
+
+def alpha_matrix(alpha, metadata):
+    #AbundanceMatrix of the alpha metrics (one "family" per metric) of the samples with patient information,
+    #for the tests between time points of stats_engine and resampling
+    alpha = alpha.merge(metadata[['sample_name', 'patient', 'timepoint', 'Category']], on='sample_name', how='left')
+    alpha = alpha[alpha['Category'].notna()]
+    long = alpha.melt(id_vars=['sample_name', 'patient', 'timepoint', 'Category'], value_vars=ALPHA_METRICS,
+                      var_name='family', value_name='relative_abundance')
+    return AbundanceMatrix.from_long(long)
+
+
+
+def group_distances(distances, groups, rows_per_chunk=1024):
+    #Number and mean of the distances within each group and between each two groups of samples
+    #('groups': label of every sample, NaN for the samples left out; NaN distances are skipped).
+    #The condensed vector is read in chunks of consecutive rows.
+    codes, labels = pd.factorize(pd.Series(groups, dtype=object))
+    n, n_groups = len(codes), len(labels)
+    counts = np.zeros(n_groups * n_groups)
+    sums = np.zeros(n_groups * n_groups)
+    for i0 in range(0, max(n - 1, 0), rows_per_chunk):
+        i1 = min(i0 + rows_per_chunk, n - 1)
+        rows = np.arange(i0, i1)
+        lengths = n - 1 - rows
+        start, stop = condensed_index(n, i0, i0 + 1), condensed_index(n, i1 - 1, n - 1) + 1
+        i = np.repeat(rows, lengths)
+        j = i + 1 + np.arange(stop - start) - np.repeat(condensed_index(n, rows, rows + 1) - start, lengths)
+        chunk = np.asarray(distances[start:stop])
+        a, b = codes[i], codes[j]
+        valid = (a >= 0) & (b >= 0) & ~np.isnan(chunk)
+        keys = np.minimum(a, b)[valid] * n_groups + np.maximum(a, b)[valid]
+        counts += np.bincount(keys, minlength=n_groups * n_groups)
+        sums += np.bincount(keys, weights=chunk[valid], minlength=n_groups * n_groups)
+    present = np.flatnonzero(counts)
+    group_1, group_2 = np.divmod(present, n_groups)
+    labels = np.asarray(labels, dtype=object)
+    return pd.DataFrame({'group_1': labels[group_1], 'group_2': labels[group_2],
+                         'n_pairs': counts[present].astype(np.int64), 'mean_distance': sums[present] / counts[present]})
+
+
+
+def distance_to_baseline(distances, metadata, baseline='0'):
+    #Distance of every sample to the sample of the same patient (and project) at the baseline time point
+    n = len(metadata)
+    keys = metadata['project'].astype(str) + '/' + metadata['patient'].astype(str)
+    baseline_rows = pd.Series(np.arange(n)[(metadata['timepoint'] == baseline).to_numpy()],
+                              index=keys[(metadata['timepoint'] == baseline).to_numpy()].to_numpy())
+    baseline_rows = baseline_rows[~baseline_rows.index.duplicated()]
+    reference = baseline_rows.reindex(keys.to_numpy()).to_numpy()
+    rows = np.flatnonzero(~np.isnan(reference) & (metadata['timepoint'] != baseline).to_numpy() & metadata['patient'].notna().to_numpy())
+    reference = reference[rows].astype(np.int64)
+    positions = condensed_index(n, np.minimum(rows, reference), np.maximum(rows, reference))
+    table = metadata.iloc[rows].reset_index(drop=True)
+    table['distance'] = np.asarray(distances[positions])
+    return table
@@ -0,0 +1,234 @@
+import os
+import colorsys
+import numpy as np
+import pandas as pd
+from abundance_matrix import AbundanceMatrix
+import stats_engine as se
+import sample_names as sn
+
+
+#Direct matplotlib versions of the three plots ('renderer': 'fast').
+#The stacked bars are computed from a families x samples matrix: the bottom of every bar is a cumulative sum
+#over the families and all the bars are drawn as one collection of rectangles. The box plots draw all the
+#boxes of a facet with one boxplot call, from the columns of the AbundanceMatrix. The layout, colours and
+#annotations follow the plotnine/seaborn plots. Figures can be saved in several formats (png, svg, pdf, ...)
+#at a chosen dpi, and the facets of the family plot can be split over several pages.
+
+#Same colours as relative_abundance_plot
+HEX_COLORS = [
+    "#011F4B", "#022655", "#03315F", "#033B69", "#044573", "#05507D", "#065A87", "#076491",
+    "#087E9B", "#0988A5", "#0A92AF", "#0BAEBF", "#1EC3CB", "#3FD0D7", "#5FE1E3", "#7FF0EF",
+    "#8FF3F3", "#9FF6F7", "#AFFAFB", "#C4FBF9", "#D9FCF7", "#EEFDF5", "#F3F3E3", "#F8E9D1",
+    "#FDE1BF", "#FED9AD", "#FFD198", "#FFC986", "#FFC174", "#FFB962", "#FFB050", "#FFA83D",
+    "#FFA02B", "#FF9819"]
+#seaborn's 'pastel' palette
+PASTEL = ["#a1c9f4", "#ffb482", "#8de5a1", "#ff9f9b", "#d0bbff", "#debb9b", "#fab0e4", "#cfcfcf", "#fffea3", "#b9f2f0"]
+TIMEPOINT_ORDER = ['0', '7', '90']
+#rcParams of the plotnine (gray) and seaborn whitegrid themes used by the original plots
+GGPLOT_RC = {'axes.facecolor': "#EBEBEB", 'axes.edgecolor': "none", 'axes.grid': True, 'grid.color': "white",
+             'axes.axisbelow': True, 'font.size': 11, 'xtick.color': "#4D4D4D", 'ytick.color': "#4D4D4D"}
+WHITEGRID_RC = {'axes.facecolor': "white", 'axes.edgecolor': ".8", 'axes.grid': True, 'grid.color': ".8",
+                'axes.axisbelow': True, 'font.size': 12, 'axes.labelsize': 12, 'xtick.labelsize': 11,
+                'ytick.labelsize': 11, 'xtick.bottom': False, 'ytick.left': False, 'axes.titlesize': 12,
+                'text.color': ".15", 'axes.labelcolor': ".15", 'xtick.color': ".15", 'ytick.color': ".15"}
+FLIERPROPS = dict(marker='o', markersize=6, markerfacecolor='black', markeredgecolor='black')
+BOX_DPI = 100
+BAR_DPI = 300
+
+
+def save_figure(fig, path_base, formats=('png',), dpi=None, **savefig_kwargs):
+    #Save 'fig' as path_base.<format> for every format, returns the written paths
+    paths = []
+    for file_format in formats:
+        path = f"{path_base}.{file_format}"
+        fig.savefig(path, format=file_format, dpi=dpi, **savefig_kwargs)
+        paths.append(path)
+    return paths
+
+
+
+def stack_matrix(species_relative_abundance, sample_order=None):
+    #(heights, bottoms, families, samples): families x samples arrays of the stacked bars. Families are sorted
+    #like the plotnine factor levels and the first one is on top of the stack, as geom_bar(position='stack') does.
+    data = species_relative_abundance
+    present = pd.unique(data['sample_name'].astype(object))
+    samples = [sample for sample in sample_order if sample in set(present)] if sample_order is not None else list(present)
+    families = sorted(pd.unique(data['family'].dropna().astype(object)))
+    sample_codes = pd.Index(samples).get_indexer(data['sample_name'].astype(object))
+    family_codes = pd.Index(families).get_indexer(data['family'].astype(object))
+    keep = (sample_codes >= 0) & (family_codes >= 0)
+    heights = np.zeros((len(families), len(samples)))
+    np.add.at(heights, (family_codes[keep], sample_codes[keep]), np.nan_to_num(data['relative_abundance'].to_numpy(dtype=float)[keep]))
+    # The last family is at the bottom: bottoms are cumulative sums from the last family up
+    bottoms = np.cumsum(heights[::-1], axis=0)[::-1] - heights
+    return heights, bottoms, families, samples
+
+
+
+def relative_abundance_plot(species_relative_abundance, sys_argv, sample_order=None, separators=None, formats=('png',), dpi=None):
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import PolyCollection
+    from matplotlib.patches import Patch
+    if sample_order is None:
+        sample_order, separators = sn.sample_order(species_relative_abundance['sample_name'])
+    heights, bottoms, families, samples = stack_matrix(species_relative_abundance, sample_order)
+    colors = [HEX_COLORS[i % len(HEX_COLORS)] for i in range(len(families))]
+    # One rectangle per (family, sample) with a height, as a single collection
+    family_of_bar, sample_of_bar = np.nonzero(heights)
+    left, right = sample_of_bar - 0.45, sample_of_bar + 0.45
+    bottom = bottoms[family_of_bar, sample_of_bar]
+    top = bottom + heights[family_of_bar, sample_of_bar]
+    vertices = np.stack([np.column_stack([left, bottom]), np.column_stack([left, top]),
+                         np.column_stack([right, top]), np.column_stack([right, bottom])], axis=1)
+    max_y = species_relative_abundance['relative_abundance'].max() * 1.165
+    with plt.rc_context(GGPLOT_RC):
+        fig, ax = plt.subplots(figsize=(15, 10), layout='constrained')
+        ax.add_collection(PolyCollection(vertices, facecolors=np.array(colors, dtype=object)[family_of_bar], edgecolors='none'))
+        for sample in (separators or []):
+            if sample in samples:
+                line_pos = samples.index(sample) + 0.45
+                ax.plot([line_pos, line_pos], [0, max_y], color='black', linewidth=1.5)
+        ax.set_xlim(-0.6, len(samples) - 0.4)
+        top_y = max(max_y, bottoms[0].max() + heights[0].max() if len(families) else max_y)
+        ax.set_ylim(-0.05 * top_y, top_y * 1.05)
+        ax.set_xticks(np.arange(len(samples)), samples, rotation=90, ha='center')
+        ax.grid(axis='x', visible=False)
+        ax.tick_params(length=3)
+        ax.set_xlabel('Sample Name')
+        ax.set_ylabel('Relative Abundance (%)')
+        ax.set_title('Relative Abundance of Bacteria Types by Sample')
+        # Legend in columns of 12 entries, like plotnine's
+        fig.legend(handles=[Patch(color=color, label=family) for family, color in zip(families, colors)], title='family',
+                   loc='outside right center', frameon=False, ncol=max(1, -(-len(families) // 12)), alignment='left')
+        paths = save_figure(fig, os.path.join(sys_argv[2], "relative_abundance_plot"), formats, dpi or BAR_DPI)
+        plt.close(fig)
+    return paths
+
+
+
+def _draw_brackets(ax, p_values, y, fontsize=26):
+    #Significance brackets between time points, as the seaborn plots draw them
+    h, increment, base_y_offset = 0.02, 0.03, y + 0.05
+    for i, (tp1, tp2, label) in enumerate(p_values):
+        y_offset = base_y_offset + i * increment
+        x1, x2 = TIMEPOINT_ORDER.index(tp1), TIMEPOINT_ORDER.index(tp2)
+        ax.plot([x1, x1, x2, x2], [y_offset, y_offset + h, y_offset + h, y_offset], lw=1.5, c='k')
+        ax.text((x1 + x2) * .5, y_offset + h, label, ha='center', va='bottom', color='k', fontsize=fontsize)
+
+
+
+def _boxes(ax, groups, positions, colors, width):
+    #All the boxes of one axis in one boxplot call (empty groups are skipped)
+    drawn = [(group, position, color) for group, position, color in zip(groups, positions, colors) if len(group)]
+    if not drawn:
+        return
+    groups, positions, colors = zip(*drawn)
+    boxes = ax.boxplot(list(groups), positions=list(positions), widths=width, patch_artist=True, whis=1.5,
+                       flierprops=FLIERPROPS, medianprops=dict(color=".3", linewidth=1.5),
+                       whiskerprops=dict(color=".3"), capprops=dict(color=".3"), boxprops=dict(edgecolor=".3"))
+    for patch, color in zip(boxes['boxes'], colors):
+        patch.set_facecolor(_desaturate(color))
+    # seaborn's despined categorical axes
+    ax.spines[['top', 'right']].set_visible(False)
+    ax.grid(axis='x', visible=False)
+
+
+
+def _desaturate(color, saturation=0.75):
+    #Box colour as seaborn draws it (boxplot's default saturation)
+    import matplotlib.colors as mcolors
+    hue, lightness, color_saturation = colorsys.rgb_to_hls(*mcolors.to_rgb(color))
+    return colorsys.hls_to_rgb(hue, lightness, color_saturation * saturation)
+
+
+
+def _timepoint_groups(matrix, j, categories=None):
+    #Non-missing values of family column j at every time point (and Category, when given)
+    column = matrix.values[:, j]
+    present = ~np.isnan(column)
+    groups = []
+    for timepoint in TIMEPOINT_ORDER:
+        rows = present & (matrix.timepoint == timepoint)
+        if categories is None:
+            groups.append(column[rows].astype(float))
+        else:
+            groups.append([column[rows & (matrix.category == category)].astype(float) for category in categories])
+    return groups
+
+
+
+def plot_families_aboundance(data_x, group, sys_argv, results=None, formats=('png',), dpi=None, facets_per_page=None):
+    #Same figure as fn.plot_families_aboundance, with 'facets_per_page' families per file (default: all in one)
+    import matplotlib.pyplot as plt
+    if not isinstance(data_x, AbundanceMatrix):
+        data_x = AbundanceMatrix.from_long(data_x)
+    if results is None:
+        results = se.compare_timepoints(data_x)
+    significance_data = se.significance_by_family(results)
+    family_max = data_x.max_by_family()
+    families = [family for j, family in enumerate(data_x.families) if (~np.isnan(data_x.values[:, j])).any()]
+    facets_per_page = facets_per_page or max(len(families), 1)
+    pages = [families[start:start + facets_per_page] for start in range(0, len(families), facets_per_page)] or [[]]
+    paths = []
+    with plt.rc_context(WHITEGRID_RC):
+        for page, page_families in enumerate(pages):
+            n_cols = min(8, max(len(page_families), 1))
+            n_rows = max(1, -(-len(page_families) // n_cols))
+            fig, axes = plt.subplots(n_rows, n_cols, figsize=(6 * n_cols, 8 * n_rows), squeeze=False)
+            for k, ax in enumerate(axes.flat):
+                if k >= len(page_families):
+                    ax.remove()
+                    continue
+                family = page_families[k]
+                _boxes(ax, _timepoint_groups(data_x, data_x.family_index[family]), range(3), PASTEL, 0.8)
+                ax.set_xlim(-0.5, 2.5)
+                ax.set_xticks(range(3), TIMEPOINT_ORDER)
+                ax.set_title(family, size=26, y=1.1)
+                # Axis labels on the outer facets, x tick labels on the bottom facet of each column
+                ax.set_xlabel("T.P" if k + n_cols >= len(page_families) else "")
+                if k + n_cols < len(page_families):
+                    ax.tick_params(labelbottom=False)
+                ax.set_ylabel("Relative Abundance" if k % n_cols == 0 else "")
+                if family in significance_data:
+                    _draw_brackets(ax, significance_data[family], family_max[family])
+            fig.subplots_adjust(top=0.85, hspace=0.6)
+            suffix = f"_page{page + 1}" if len(pages) > 1 else ""
+            paths += save_figure(fig, os.path.join(sys_argv[2], f"families_{group}_plot{suffix}"), formats, dpi or BOX_DPI, bbox_inches='tight')
+            plt.close(fig)
+    return set(significance_data)
+
+
+
+def plot_combined_families(data, family, sys_argv, results=None, formats=('png',), dpi=None):
+    #Same figure as fn.plot_combined_families: boxes of each Category side by side at every time point
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Patch
+    if not isinstance(data, AbundanceMatrix):
+        data = AbundanceMatrix.from_long(data[data['family'] == family])
+    data = data.select(families=[family])
+    if results is None:
+        results = se.compare_timepoints(data)
+    p_values = se.significance_by_family(results).get(family)
+    present = ~np.isnan(data.values[:, 0])
+    categories = list(pd.unique(pd.Series(data.category[present]).dropna()))
+    n = max(len(categories), 1)
+    width = 0.8 / n
+    groups = _timepoint_groups(data, 0, categories)
+    with plt.rc_context(WHITEGRID_RC):
+        fig, ax = plt.subplots(figsize=(6, 8))
+        _boxes(ax, [groups[i][k] for i in range(3) for k in range(len(categories))],
+               [i - 0.4 + width * (k + 0.5) for i in range(3) for k in range(len(categories))],
+               [PASTEL[k % len(PASTEL)] for i in range(3) for k in range(len(categories))], width * 0.98)
+        ax.set_xlim(-0.5, 2.5)
+        ax.set_xticks(range(3), TIMEPOINT_ORDER)
+        ax.set_xlabel("Time Point")
+        ax.set_ylabel("Relative Abundance")
+        fig.tight_layout()
+        fig.suptitle(f"Family: {family}", fontsize=26, y=1.05)
+        fig.legend(handles=[Patch(facecolor=_desaturate(PASTEL[k % len(PASTEL)]), edgecolor=".3", label=category) for k, category in enumerate(categories)],
+                   title='Category', loc='center left', bbox_to_anchor=(1.0, 0.5), frameon=False)
+        if p_values:
+            _draw_brackets(ax, p_values, data.max_by_family()[family])
+        paths = save_figure(fig, os.path.join(sys_argv[2], f"combined_family_{family}_plot"), formats, dpi or BOX_DPI, bbox_inches='tight')
+        plt.close(fig)
+    return paths
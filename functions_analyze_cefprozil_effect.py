@@ -1,38 +1,213 @@
 import pandas as pd
 from pandas.api.types import CategoricalDtype
-from plotnine import ggplot, aes, geom_bar, theme, element_text, labs, scale_fill_manual, geom_vline, geom_segment
 import os
-import seaborn as sns
-import matplotlib.pyplot as plt
-from scipy.stats import ttest_ind, f_oneway
+import json
+import warnings
+import numpy as np
+import table_cache as tc
+import taxonomy_index as ti
+import csr_store as csr
+from abundance_matrix import AbundanceMatrix
+import stats_engine as se
+import sample_names as sn
 
+#The plotting libraries (plotnine, seaborn, matplotlib) are imported inside the plot functions,
+#so the data and statistics stages run without loading them
 
 
-def get_raw_data(sys_argv):
+#Columns of the metadata tables used by the pipeline
+SAMPLES_LOADED_COLUMNS = ['uid', 'accession_id']
+PROJECT_COLUMNS = ['project_id', 'sample_name', 'run_id', 'loaded_uid']
+
+#Defaults of the analysed project (PRJEB8094), used for projects of a batch config that leave them out
+EXCLUDED_UIDS = [25687, 2615, 4124]
+
+
+
+def get_raw_data(sys_argv, use_cache=True):
     files_path = sys_argv[1]
-    samples_loaded = pd.read_csv(f"{files_path}/samples_loaded.txt", delimiter='\t')    
-    superkingdom = pd.read_csv(f"{files_path}/superkingdom2descendents.txt", delimiter='\t')
-    species_abundance = pd.read_csv(f"{files_path}/species_abundance.txt", delimiter='\t')
-    project = pd.read_csv(f"{files_path}/sample_to_run_info.txt", delimiter='\t', low_memory=False)
-    families_table = pd.read_csv(f"{files_path}/families.csv")
+    samples_loaded, superkingdom, project, families_table = get_metadata(sys_argv, use_cache)
+    species_abundance = read_input_table(f"{files_path}/species_abundance.txt", use_cache, delimiter='\t')
     return(samples_loaded, superkingdom, species_abundance, project,families_table)
 
 
 
-def filter_project(project):
-    selected_project_data = project[project['project_id'] == "PRJEB8094"]
+def cache_unavailable(path, error):
+    #The caches of an input file can't be written (e.g. read-only input directory): it is parsed as text instead
+    warnings.warn(f"no cache for {path} ({error}), reading the text file", stacklevel=3)
+
+
+
+def read_input_table(path, use_cache=True, columns=None, **read_csv_kwargs):
+    #Read one of the input tables, through its columnar cache (built on first use) when 'use_cache' is set
+    if use_cache:
+        try:
+            table = tc.open_table(path, **read_csv_kwargs)
+        except OSError as error:
+            cache_unavailable(path, error)
+            use_cache = False
+    if not use_cache:
+        usecols = None if columns is None else (lambda column: column in columns)
+        return pd.read_csv(path, usecols=usecols, **read_csv_kwargs)
+    if columns is not None:
+        columns = [column for column in table.columns if column in columns]
+    return table.read(columns)
+
+
+
+def get_metadata(sys_argv, use_cache=True):
+    #All the input tables except 'species_abundance.txt', which is streamed by stream_species_abundance
+    files_path = sys_argv[1]
+    samples_loaded = read_input_table(f"{files_path}/samples_loaded.txt", use_cache, SAMPLES_LOADED_COLUMNS, delimiter='\t')
+    superkingdom = read_input_table(f"{files_path}/superkingdom2descendents.txt", use_cache, delimiter='\t')
+    project = read_input_table(f"{files_path}/sample_to_run_info.txt", use_cache, PROJECT_COLUMNS, delimiter='\t', low_memory=False)
+    families_table = pd.read_csv(f"{files_path}/families.csv")
+    return(samples_loaded, superkingdom, project, families_table)
+
+
+
+def load_taxonomy_index(sys_argv, superkingdom, families_table):
+    #TaxonomyIndex of 'superkingdom2descendents.txt' and 'families.csv' (saved with the table caches),
+    #None when the taxonomy can't be indexed by taxon id and the merges are used instead
+    files_path = sys_argv[1]
+    return ti.open_index(f"{files_path}/superkingdom2descendents.txt", f"{files_path}/families.csv", superkingdom, families_table)
+
+
+
+def stream_species_abundance(sys_argv, selected_project_w_accession, superkingdom, chunksize=1_000_000, use_cache=True, taxonomy=None):
+    #Same result as add_kingdom + filter_species_abundance on the full table, but only rows of the
+    #selected uids at species rank are ever materialized, so peak memory depends on the selected
+    #samples and not on the file size
+    species_abundance_kingdom = load_species_abundance_kingdom(sys_argv, selected_project_w_accession['loaded_uid'], superkingdom, chunksize, use_cache, taxonomy)
+    return filter_species_abundance(selected_project_w_accession, species_abundance_kingdom)
+
+
+
+def load_species_abundance_kingdom(sys_argv, loaded_uids, superkingdom, chunksize=1_000_000, use_cache=True, taxonomy=None):
+    #add_kingdom output restricted to 'loaded_uids'. With the cache, the uid and rank columns are scanned
+    #from their memory-mapped files and only the matching rows of the other columns are read. Without it,
+    #the text file is parsed in chunks and each chunk is filtered before the next one is read.
+    #With a 'taxonomy' index, the taxonomy columns are gathered by taxon id (as interned categoricals)
+    #instead of merged, so only the taxon ids of the kept rows are read.
+    #When the file has the CSR store layout, the rows of each uid are sliced from the store instead of
+    #scanning the uid column (rows come grouped by uid, which filter_species_abundance's merge does anyway).
+    #Where the caches can't be written (read-only input directory), the text file is parsed in chunks.
+    files_path = sys_argv[1]
+    path = f"{files_path}/species_abundance.txt"
+    wanted_uids = pd.unique(pd.Series(loaded_uids).dropna())
+    if use_cache:
+        try:
+            store = csr.open_store(path, chunksize=chunksize)
+            if store is not None and not all(column in store.columns for column in species_abundance_columns(store.manifest['header'], superkingdom)):
+                store = None
+            table = tc.open_table(path, chunksize=chunksize, delimiter='\t') if store is None else None
+        except OSError as error:
+            cache_unavailable(path, error)
+            use_cache = False
+    if use_cache:
+        if store is not None:
+            usecols = species_abundance_columns(store.manifest['header'], superkingdom)
+            join = taxonomy.add_kingdom if taxonomy is not None and taxonomy.joins(usecols) else (lambda chunk: add_kingdom(chunk, superkingdom))
+            rank = 'species' if 'taxon_rank_level' in store.columns else None
+            return join(store.read(wanted_uids, usecols, rank))
+        usecols = species_abundance_columns(table.columns, superkingdom)
+        join = taxonomy.add_kingdom if taxonomy is not None and taxonomy.joins(usecols) else (lambda chunk: add_kingdom(chunk, superkingdom))
+        mask = np.isin(table.raw_column('loaded_uid'), wanted_uids)
+        if 'taxon_rank_level' in table.columns:
+            mask &= table.raw_column('taxon_rank_level') == table.code_of('taxon_rank_level', 'species')
+        species_abundance = table.read(usecols, rows=np.flatnonzero(mask))
+        return join(species_abundance)
+    header = pd.read_csv(path, delimiter='\t', nrows=0).columns
+    usecols = species_abundance_columns(header, superkingdom)
+    join = taxonomy.add_kingdom if taxonomy is not None and taxonomy.joins(usecols) else (lambda chunk: add_kingdom(chunk, superkingdom))
+    chunks = []
+    for chunk in pd.read_csv(path, delimiter='\t', usecols=usecols, chunksize=chunksize):
+        chunk = chunk[chunk['loaded_uid'].isin(wanted_uids)]
+        if 'taxon_rank_level' in chunk.columns:
+            chunk = chunk[chunk['taxon_rank_level'] == 'species']
+        if len(chunk) > 0:
+            chunks.append(join(chunk))
+    if chunks:
+        return pd.concat(chunks, ignore_index=True)
+    return join(pd.DataFrame(columns=usecols))
+
+
+
+def split_species_abundance(selected_projects, species_abundance_kingdom):
+    #Route the rows of one shared scan to each project: the row positions of every uid are found once,
+    #so each project only pays for its own rows. Returns filter_species_abundance output per project.
+    uid_rows = species_abundance_kingdom.groupby('loaded_uid', sort=False).indices
+    empty = np.empty(0, dtype=np.int64)
+    filtered = []
+    for selected_project_w_accession in selected_projects:
+        rows = [uid_rows.get(uid, empty) for uid in pd.unique(selected_project_w_accession['loaded_uid'].dropna())]
+        rows = np.sort(np.concatenate(rows)) if rows else empty
+        project_rows = species_abundance_kingdom.iloc[rows]
+        filtered.append(filter_species_abundance(selected_project_w_accession, project_rows))
+    return filtered
+
+
+
+def species_abundance_columns(columns, superkingdom):
+    #Keep the merge keys shared with 'superkingdom' so add_kingdom joins on the same columns as before
+    needed_columns = {'loaded_uid', 'scientific_name', 'relative_abundance', 'taxon_rank_level'} | set(superkingdom.columns)
+    return [column for column in columns if column in needed_columns]
+
+
+
+def project_settings(project=None):
+    #Settings of one project: the defaults of PRJEB8094, updated with the given ones. The excluded uids of
+    #PRJEB8094 are its own: other projects exclude no uid unless they list some.
+    project = project or {}
+    project_id = project.get('project_id', "PRJEB8094")
+    settings = {
+        'project_id': "PRJEB8094",
+        'excluded_uids': EXCLUDED_UIDS if project_id == "PRJEB8094" else [],
+        'sample_order': None,
+        'separators': None,
+        'patient_info': None,
+        'test': 'student',
+        'correction': None,
+    }
+    settings.update(project)
+    return settings
+
+
+
+def load_batch_config(config_path):
+    #Projects of a batch run, from a JSON list (or {"projects": [...]}) of project settings.
+    #Missing settings fall back to the defaults of PRJEB8094, and 'patient_info' paths are relative to the config file.
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    projects = config['projects'] if isinstance(config, dict) else config
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    batch = []
+    for project in projects:
+        if isinstance(project, str):
+            project = {'project_id': project}
+        settings = project_settings(project)
+        settings.setdefault('output_dir', settings['project_id'])
+        if settings['patient_info'] is not None:
+            settings['patient_info'] = os.path.join(config_dir, settings['patient_info'])
+        batch.append(settings)
+    return batch
+
+
+
+def filter_project(project, project_id="PRJEB8094"):
+    selected_project_data = project[project['project_id'] == project_id]
     return selected_project_data
 
 
 
-def add_accession_id(samples_loaded, selected_project_data):
+def add_accession_id(samples_loaded, selected_project_data, excluded_uids=EXCLUDED_UIDS):
     uid_table = pd.DataFrame({
         'loaded_uid': samples_loaded['uid'],
         'run_id': samples_loaded['accession_id']
     })
     
     selected_project_w_accession = pd.merge(selected_project_data, uid_table, how='left')
-    selected_project_w_accession = selected_project_w_accession[~selected_project_w_accession['loaded_uid'].isin([25687, 2615, 4124])]
+    selected_project_w_accession = selected_project_w_accession[~selected_project_w_accession['loaded_uid'].isin(excluded_uids)]
     return selected_project_w_accession
 
 
@@ -90,19 +265,55 @@ def cal_relative_abundance(species_abundance_family,selected_project_w_accession
 
 
 
-def relative_abundance_plot(species_relative_abundance, sys_argv):
+def aggregate_family_abundance(species_abundance_w_sample_name, families_table, selected_project_w_accession, taxonomy=None):
+    #Same table as add_family + cal_relative_abundance, without building and re-splitting 'family_sample'
+    #strings: species, families and samples are mapped to integer codes once and summed with bincount.
+    #Scientific names interned by a 'taxonomy' index get their family codes from it by a gather.
+    scientific_names = species_abundance_w_sample_name['scientific_name']
+    if taxonomy is not None and taxonomy.is_interned(scientific_names):
+        family_codes, family_uniques = taxonomy.family_codes(scientific_names), taxonomy.families
+    else:
+        families_table = families_table.iloc[:, [1, 2]].drop_duplicates(subset=families_table.columns[1])
+        family_names = families_table.iloc[:, 1].str.replace('.*: ', '', regex=True)
+        family_codes_of_species, family_uniques = pd.factorize(family_names)
+        species_codes = pd.Index(families_table.iloc[:, 0]).get_indexer(scientific_names)
+        family_codes = np.where(species_codes >= 0, family_codes_of_species.take(np.maximum(species_codes, 0)), -1) if len(family_codes_of_species) else np.full(len(species_codes), -1)
+    sample_codes, sample_uniques = pd.factorize(species_abundance_w_sample_name['sample_name'])
+    # Rows without a family or a sample name are dropped, as the groupby on 'family_sample' drops NaN keys
+    keep = (family_codes >= 0) & (sample_codes >= 0)
+    n_samples = len(sample_uniques)
+    keys = family_codes[keep] * n_samples + sample_codes[keep]
+    weights = np.nan_to_num(species_abundance_w_sample_name['relative_abundance'].to_numpy(dtype=float)[keep])
+    minlength = len(family_uniques) * n_samples
+    sums = np.bincount(keys, weights=weights, minlength=minlength)
+    present = np.flatnonzero(np.bincount(keys, minlength=minlength))
+    family_of_key, sample_of_key = np.divmod(present, n_samples)
+    # Number of runs of each sample, looked up by sample code instead of merging 'value_counts'
+    run_codes = pd.Index(sample_uniques).get_indexer(selected_project_w_accession['sample_name'])
+    runs = np.bincount(run_codes[run_codes >= 0], minlength=n_samples)
+    freq = runs[sample_of_key]
+    families = np.asarray(family_uniques, dtype=object)[family_of_key]
+    samples = np.asarray(sample_uniques, dtype=object)[sample_of_key]
+    species_abundance_sum = pd.DataFrame({
+        'family': families,
+        'x': sums[present],
+        'sample_name': samples,
+        'Freq': freq.astype(np.int64),
+        'relative_abundance': sums[present] / np.where(freq > 0, freq, np.nan),
+    })
+    # Row order of the groupby on the 'family_sample' strings (only built for the output rows)
+    order = np.argsort((species_abundance_sum['family'] + '_' + species_abundance_sum['sample_name']).to_numpy(dtype=object), kind='stable')
+    return species_abundance_sum.iloc[order].reset_index(drop=True)
+
+
+
+def relative_abundance_plot(species_relative_abundance, sys_argv, sample_order=None, separators=None):
+    from plotnine import ggplot, aes, geom_bar, theme, element_text, labs, scale_fill_manual, geom_segment
     path_to_save = os.path.join(sys_argv[2], "relative_abundance_plot")
-    # Define the order of samples (Experiment (time point 0,7,9) and Control (time point 0,7,9))
-    Listofsamples = [
-        "P1E0", "P2E0", "P3E0", "P4E0", "P5E0", "P9E0", "P10E0", "P11E0", "P12E0", "P13E0", 
-        "P14E0", "P15E0", "P17E0", "P18E0", "P19E0", "P20E0", "P21E0", "P22E0", "P1E7", "P2E7", 
-        "P3E7", "P4E7", "P5E7", "P9E7", "P10E7", "P11E7", "P12E7", "P13E7", "P14E7", "P15E7", 
-        "P17E7", "P18E7", "P19E7", "P20E7", "P21E7", "P22E7", "P1E90", "P2E90", "P3E90", "P4E90", 
-        "P5E90", "P9E90", "P10E90", "P11E90", "P12E90", "P13E90", "P14E90", "P15E90", "P17E90", 
-        "P18E90", "P19E90", "P20E90", "P21E90", "P22E90", "P6C0", "P7C0", "P8C0", "P23C0", "P25C0", 
-        "P38C0", "P6C7", "P7C7", "P8C7", "P23C7", "P25C7", "P38C7", "P6C90", "P7C90", "P8C90", 
-        "P23C90", "P25C90", "P38C90"
-    ]
+    # Define the order of samples (default: from the sample names, Experiment (time point 0,7,90) and Control (time point 0,7,90))
+    if sample_order is None:
+        sample_order, separators = sn.sample_order(species_relative_abundance['sample_name'])
+    Listofsamples = list(sample_order)
     cat_type = CategoricalDtype(categories=Listofsamples, ordered=True)
     species_relative_abundance['sample_name'] = species_relative_abundance['sample_name'].astype(cat_type)
     # Define the plot colors
@@ -113,12 +324,7 @@ def relative_abundance_plot(species_relative_abundance, sys_argv):
     "#FDE1BF", "#FED9AD", "#FFD198", "#FFC986", "#FFC174", "#FFB962", "#FFB050", "#FFA83D",
     "#FFA02B", "#FF9819"]
     
-    vertical_lines = {
-        "P22E0": "P1E7",
-        "P22E7": "P1E90",
-        "P22E90": "P6C0"
-    }
-    vertical_lines_pos = {k: Listofsamples.index(k) + 1.45 for k in vertical_lines.keys()}
+    vertical_lines_pos = [Listofsamples.index(sample) + 1.45 for sample in (separators or []) if sample in Listofsamples]
     max_y = species_relative_abundance['relative_abundance'].max() * 1.165
     
     # Create the plot
@@ -127,28 +333,25 @@ def relative_abundance_plot(species_relative_abundance, sys_argv):
         geom_bar(stat='identity', position='stack') +
         theme(axis_text_x=element_text(rotation=90, hjust=1)) +
         labs(x='Sample Name', y='Relative Abundance (%)', title='Relative Abundance of Bacteria Types by Sample') +
-        scale_fill_manual(values=hex_colors) +
-        geom_segment(aes(x=vertical_lines_pos["P22E0"], y=0, xend=vertical_lines_pos["P22E0"], yend=max_y), color='black', size=1) +
-        geom_segment(aes(x=vertical_lines_pos["P22E7"], y=0, xend=vertical_lines_pos["P22E7"], yend=max_y), color='black', size=1) +
-        geom_segment(aes(x=vertical_lines_pos["P22E90"], y=0, xend=vertical_lines_pos["P22E90"], yend=max_y), color='black', size=1)
+        scale_fill_manual(values=hex_colors)
     )
+    for line_pos in vertical_lines_pos:
+        relative_abundance_plot += geom_segment(aes(x=line_pos, y=0, xend=line_pos, yend=max_y), color='black', size=1)
     
     relative_abundance_plot.save(path_to_save, width=15, height=10, dpi=300)
     # relative_abundance_plot.show()
 
 
-def add_patient_info(species_relative_abundance, sys_argv):
+def add_patient_info(species_relative_abundance, sys_argv, patient_info_path=None):
     files_path = sys_argv[1]
     species_abundance_avg_tagged = species_relative_abundance.copy()
-    # Extract patient information
-    species_abundance_avg_tagged['patient'] = species_abundance_avg_tagged['sample_name'].str.replace(r'E.*', '', regex=True)
-    species_abundance_avg_tagged['patient'] = species_abundance_avg_tagged['patient'].str.replace(r'C.*', '', regex=True)
-    # Extract timepoint information
-    species_abundance_avg_tagged['timepoint'] = species_abundance_avg_tagged['sample_name'].str.replace(r'.*E', '', regex=True)
-    species_abundance_avg_tagged['timepoint'] = species_abundance_avg_tagged['timepoint'].str.replace(r'.*C', '', regex=True)
+    # Extract patient and timepoint information (each distinct sample name is parsed once)
+    parsed = sn.parse_sample_names(species_abundance_avg_tagged['sample_name'])
+    species_abundance_avg_tagged['patient'] = parsed['patient']
+    species_abundance_avg_tagged['timepoint'] = parsed['timepoint']
     # Read patient info CSV
     #patient_info = pd.read_csv("patient_info.csv")
-    patient_info = pd.read_csv(f"{files_path}/patient_info.csv")
+    patient_info = pd.read_csv(patient_info_path or f"{files_path}/patient_info.csv")
     # Merge the DataFrames
     species_abundance_avg_tagged = pd.merge(species_abundance_avg_tagged, patient_info, how='left')
     return species_abundance_avg_tagged
@@ -156,55 +359,41 @@ def add_patient_info(species_relative_abundance, sys_argv):
 
 
 def get_control_data(species_abundance_avg_tagged):
+    if isinstance(species_abundance_avg_tagged, AbundanceMatrix):
+        return species_abundance_avg_tagged.subset("Control")
     control_data = species_abundance_avg_tagged[species_abundance_avg_tagged['Category'] == "Control"]
     return control_data
 
 
 
 def get_exposed_data(species_abundance_avg_tagged):
+    if isinstance(species_abundance_avg_tagged, AbundanceMatrix):
+        return species_abundance_avg_tagged.subset("Exposed")
     exposed_data = species_abundance_avg_tagged[species_abundance_avg_tagged['Category'] == "Exposed"]
     return exposed_data
 
 
 
-def plot_families_aboundance(data_x, group, sys_argv):
+def plot_families_aboundance(data_x, group, sys_argv, results=None):
+    #'results' is a stats_engine.compare_timepoints table, computed here with the default t-test if not given
+    if not isinstance(data_x, AbundanceMatrix):
+        data_x = AbundanceMatrix.from_long(data_x)
+    if results is None:
+        results = se.compare_timepoints(data_x)
+    import seaborn as sns
+    import matplotlib.pyplot as plt
     plt.clf()
     plt.close('all')
     plotgroup = group
     path_to_save = os.path.join(sys_argv[2], f"families_{plotgroup}_plot.png")
     timepoint_order = ['0', '7', '90']
     plt.rcParams.update({'font.size': 20})
-    # Define significance levels
-    def significance_label(p_value):
-        if p_value < 0.001:
-            return '***'
-        elif p_value < 0.01:
-            return '**'
-        elif p_value < 0.05:
-            return '*'
-        else:
-            return None  # Not significant
-    # Perform statistical tests
-    families = data_x['family'].unique()
-    significance_data = {}
-    significant_families = set()  #keep track of significant families
-    for family in families:
-        family_data = data_x[data_x['family'] == family]
-        timepoints = family_data['timepoint'].unique()
-        comparisons = [(a, b) for idx, a in enumerate(timepoints) for b in timepoints[idx + 1:]]
-        for tp1, tp2 in comparisons:
-            group1 = family_data[family_data['timepoint'] == tp1]['relative_abundance']
-            group2 = family_data[family_data['timepoint'] == tp2]['relative_abundance']
-            stat, p_value = ttest_ind(group1, group2)
-            label = significance_label(p_value)
-            if label:
-                if family not in significance_data:
-                    significance_data[family] = []
-                significance_data[family].append((tp1, tp2, label))
-                significant_families.add(family)  # Add family to significant families set
+    significance_data = se.significance_by_family(results)
+    significant_families = set(significance_data)  #keep track of significant families
+    family_max = data_x.max_by_family()
     sns.set(style="whitegrid")
     g = sns.catplot(
-        data=data_x,
+        data=data_x.to_long(),
         x='timepoint',
         y='relative_abundance',
         kind='box',
@@ -222,7 +411,7 @@ def plot_families_aboundance(data_x, group, sys_argv):
     g.fig.subplots_adjust(top=0.85, hspace=0.6)  
     for family, p_values in significance_data.items():
         ax = g.axes_dict[family]
-        y = data_x[data_x['family'] == family]['relative_abundance'].max()
+        y = family_max[family]
         h = 0.02 
         increment = 0.03  
         base_y_offset = y + 0.05 
@@ -237,40 +426,24 @@ def plot_families_aboundance(data_x, group, sys_argv):
 
 
 
-def plot_combined_families(data, family, sys_argv):
+def plot_combined_families(data, family, sys_argv, results=None):
+    #'results' is a stats_engine.compare_timepoints table of the combined groups, computed here if not given
+    if not isinstance(data, AbundanceMatrix):
+        data = AbundanceMatrix.from_long(data[data['family'] == family])
+    if results is None:
+        results = se.compare_timepoints(data.select(families=[family]))
+    import seaborn as sns
+    import matplotlib.pyplot as plt
     plt.clf()
     plt.close('all')
     path_to_save = os.path.join(sys_argv[2], f"combined_family_{family}_plot.png")
     plt.rcParams.update({'font.size': 20})
     timepoint_order = ['0', '7', '90']
-    # Define significance levels
-    def significance_label(p_value):
-        if p_value < 0.001:
-            return '***'
-        elif p_value < 0.01:
-            return '**'
-        elif p_value < 0.05:
-            return '*'
-        else:
-            return None  # Not significant
-    # Perform statistical tests
-    significance_data = {}
-    family_data = data[data['family'] == family]
-    timepoints = family_data['timepoint'].unique()
-    comparisons = [(a, b) for idx, a in enumerate(timepoints) for b in timepoints[idx + 1:]]
-    for tp1, tp2 in comparisons:
-        group1 = family_data[family_data['timepoint'] == tp1]['relative_abundance']
-        group2 = family_data[family_data['timepoint'] == tp2]['relative_abundance']
-        stat, p_value = ttest_ind(group1, group2)
-        label = significance_label(p_value)
-        if label:
-            if family not in significance_data:
-                significance_data[family] = []
-            significance_data[family].append((tp1, tp2, label))
+    p_values = se.significance_by_family(results).get(family)
     
     sns.set(style="whitegrid")
     g = sns.catplot(
-        data=data,
+        data=data.select(families=[family]).to_long(),
         x='timepoint',
         y='relative_abundance',
         hue='Category',  # Differentiate between exposed and control
@@ -284,9 +457,9 @@ def plot_combined_families(data, family, sys_argv):
     g.set_axis_labels("Time Point", "Relative Abundance")
     g.fig.suptitle(f"Family: {family}", fontsize=26, y=1.05)  
     
-    for family, p_values in significance_data.items():
+    if p_values:
         ax = g.ax
-        y = data[data['family'] == family]['relative_abundance'].max()
+        y = data.max_by_family()[family]
         h = 0.02 
         increment = 0.03  
         base_y_offset = y + 0.05 
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import sample_names as sn
+
+
+#Patient x time point x family array of an AbundanceMatrix, for the per patient (paired) analyses.
+#The samples of a patient are aligned on the time point axis, so differences between time points and paired
+#tests are array operations. Cells of a patient not sampled at a time point, and families without a row for
+#a sample, are NaN (False in 'present').
+
+DELTA_COLUMNS = ['patient', 'Category', 'timepoint', 'baseline', 'family', 'value', 'baseline_value', 'delta']
+
+
+class PatientTensor:
+    def __init__(self, values, patients, timepoints, families, category):
+        #'category': Category of every patient
+        self.values = values
+        self.present = ~np.isnan(values)
+        self.patients = patients
+        self.timepoints = timepoints
+        self.families = families
+        self.category = category
+        self.timepoint_index = {timepoint: t for t, timepoint in enumerate(timepoints)}
+
+    @classmethod
+    def from_matrix(cls, matrix, timepoints=None):
+        #Patients by number (sample_names.patient_order), time points in the given order (default: by value,
+        #sample_names.timepoint_order). Rows without a patient or at other time points are left out, and a
+        #patient with several samples at one time point keeps the last one.
+        timepoints = list(timepoints) if timepoints is not None else sn.timepoint_order(matrix.timepoint)
+        timepoint_codes = pd.Index(timepoints, dtype=object).get_indexer(pd.Series(matrix.timepoint, dtype=object))
+        patients = sn.patient_order(matrix.patient)
+        patient_codes = pd.Index(patients, dtype=object).get_indexer(pd.Series(matrix.patient, dtype=object))
+        rows = np.flatnonzero((timepoint_codes >= 0) & (patient_codes >= 0))
+        patient_codes = patient_codes[rows]
+        values = np.full((len(patients), len(timepoints), len(matrix.families)), np.nan)
+        values[patient_codes, timepoint_codes[rows]] = matrix.values[rows]
+        category = np.full(len(patients), np.nan, dtype=object)
+        category[patient_codes] = matrix.category[rows]
+        return cls(values, np.asarray(patients, dtype=object), timepoints, matrix.families, category)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def pair_values(self, pairs):
+        #(patients x pairs x families) values at the first and at the second time point of every pair
+        first = [self.timepoint_index[tp1] for tp1, tp2 in pairs]
+        second = [self.timepoint_index[tp2] for tp1, tp2 in pairs]
+        return self.values[:, first], self.values[:, second]
+
+    def deltas(self, baseline=None):
+        #Change of every patient and family from the baseline time point (default: the first one) to each of the
+        #others: (patients x other time points x families) array, NaN when either value is missing, and the
+        #other time points
+        baseline = self.timepoints[0] if baseline is None else baseline
+        others = [timepoint for timepoint in self.timepoints if timepoint != baseline]
+        later, start = self.pair_values([(timepoint, baseline) for timepoint in others])
+        return later - start, others
+
+    def deltas_table(self, baseline=None):
+        #Long table of the changes from the baseline (one row per patient, time point and family with both values)
+        baseline = self.timepoints[0] if baseline is None else baseline
+        delta, others = self.deltas(baseline)
+        later, start = self.pair_values([(timepoint, baseline) for timepoint in others])
+        patient, timepoint, family = np.nonzero(~np.isnan(delta))
+        return pd.DataFrame({
+            'patient': self.patients[patient],
+            'Category': self.category[patient],
+            'timepoint': np.asarray(others, dtype=object)[timepoint],
+            'baseline': baseline,
+            'family': np.asarray(self.families, dtype=object)[family],
+            'value': later[patient, timepoint, family],
+            'baseline_value': start[patient, timepoint, family],
+            'delta': delta[patient, timepoint, family],
+        }, columns=DELTA_COLUMNS)
@@ -0,0 +1,136 @@
+import io
+import json
+import time
+import pstats
+import sys
+import cProfile
+import pandas as pd
+from abundance_matrix import AbundanceMatrix
+
+
+#Opt-in profiling of the pipeline stages (--profile).
+#Each measured stage records its wall and CPU time, the growth of the peak RSS of the process, and the rows and
+#memory of the tables it receives and returns. The measurements are written as a Chrome trace (chrome://tracing,
+#Perfetto) and a summary table. When profiling is off the stages are called directly, so it costs nothing.
+#CPU time and RSS are the ones of this process: work done in worker processes only counts as wall time.
+#The peak RSS comes from the Unix 'resource' module; where it is missing (Windows) it is left empty.
+
+SUMMARY_COLUMNS = ['stage', 'cached', 'wall_s', 'cpu_s', 'peak_rss_delta_mb', 'rows_in', 'rows_out', 'memory_in_mb', 'memory_out_mb']
+CPROFILE_LINES = 25
+
+
+def peak_rss_bytes():
+    #Peak resident set size of the process so far (ru_maxrss is in bytes on macOS, in kilobytes elsewhere),
+    #None without the resource module
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+
+def table_stats(obj):
+    #(rows, bytes) of the DataFrames and AbundanceMatrix objects in 'obj', looking into tuples, lists and dicts
+    if isinstance(obj, pd.DataFrame):
+        return len(obj), int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return len(obj), int(obj.memory_usage(index=True, deep=True))
+    if isinstance(obj, AbundanceMatrix):
+        return obj.shape[0], int(obj.values.nbytes)
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (tuple, list)):
+        rows, size = 0, 0
+        for item in obj:
+            item_rows, item_size = table_stats(item)
+            rows, size = rows + item_rows, size + item_size
+        return rows, size
+    return 0, 0
+
+
+
+class Profiler:
+    def __init__(self, cprofile=False):
+        #'cprofile' runs every stage under cProfile and keeps the statistics of the slowest one
+        self.cprofile = cprofile
+        self.records = []
+        self.slowest_stats = None
+        self._start = time.perf_counter()
+
+    def measure(self, name, function, args=(), kwargs=None, inputs=None, cached=None):
+        #Result of function(*args, **kwargs), recording its measurements under 'name'. 'inputs' are the
+        #tables counted as the stage's input (default: its arguments); 'cached' is a callable telling,
+        #once the stage returned, whether its result came from a cache.
+        kwargs = kwargs or {}
+        rows_in, bytes_in = table_stats(list(args) if inputs is None else inputs)
+        profile = cProfile.Profile() if self.cprofile else None
+        rss_before = peak_rss_bytes()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        rows_out, bytes_out = table_stats(result)
+        rss_after = peak_rss_bytes()
+        record = {
+            'stage': name, 'cached': bool(cached()) if cached else False,
+            'start_s': start - self._start, 'wall_s': wall, 'cpu_s': cpu,
+            'peak_rss_delta_mb': None if rss_before is None else (rss_after - rss_before) / 1024 ** 2,
+            'rows_in': rows_in, 'rows_out': rows_out,
+            'memory_in_mb': bytes_in / 1024 ** 2, 'memory_out_mb': bytes_out / 1024 ** 2,
+        }
+        self.records.append(record)
+        if profile is not None and wall >= max(other['wall_s'] for other in self.records):
+            self.slowest_stats = (name, profile)
+        return result
+
+    def summary(self):
+        #One row per measured stage, slowest first
+        table = pd.DataFrame(self.records, columns=SUMMARY_COLUMNS)
+        return table.sort_values('wall_s', ascending=False, kind='stable').reset_index(drop=True)
+
+    def chrome_trace(self):
+        #Trace Event Format: one complete event per stage, times in microseconds
+        events = [{
+            'name': record['stage'], 'cat': "cached" if record['cached'] else "computed", 'ph': "X",
+            'ts': record['start_s'] * 1e6, 'dur': record['wall_s'] * 1e6, 'pid': 1, 'tid': 1,
+            'args': {key: value for key, value in record.items() if key not in ('stage', 'start_s')},
+        } for record in self.records]
+        return {'traceEvents': events, 'displayTimeUnit': "ms"}
+
+    def cprofile_report(self):
+        #Top functions (by cumulative time) of the slowest stage, None without cProfile
+        if self.slowest_stats is None:
+            return None
+        name, profile = self.slowest_stats
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(CPROFILE_LINES)
+        return f"cProfile of the slowest stage: {name}\n{stream.getvalue()}"
+
+    def write(self, trace_path, summary_path, cprofile_path=None):
+        #Chrome trace as JSON, summary table as text (returned too), and the slowest stage's profile in pstats format
+        with open(trace_path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file, indent=1)
+        summary = self.summary().to_string(index=False, float_format=lambda value: f"{value:.3f}")
+        report = self.cprofile_report()
+        with open(summary_path, 'w') as summary_file:
+            summary_file.write(summary + "\n")
+            if report:
+                summary_file.write("\n" + report)
+        if cprofile_path and self.slowest_stats is not None:
+            self.slowest_stats[1].dump_stats(cprofile_path)
+        return summary
+
+
+
+def measure(profiler, name, function, args=(), kwargs=None, **options):
+    #function(*args, **kwargs), measured when a profiler is given
+    if profiler is None:
+        return function(*args, **(kwargs or {}))
+    return profiler.measure(name, function, args, kwargs, **options)
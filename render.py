@@ -0,0 +1,63 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+
+#Rendering stage: the figures of a run are gathered as jobs (plot function + its data and arguments)
+#and rendered on a process pool with the headless Agg backend (a handful of jobs are rendered in the calling
+#process, whose backend is left as it is: the figures are only saved, never shown). Every job starts from the rcParams of a
+#fresh matplotlib import and its changes (plt.rcParams.update, sns.set, ...) are undone afterwards, so a
+#figure never depends on the ones rendered before it and parallel output is the same as serial output.
+
+PlotJob = namedtuple('PlotJob', ['function', 'args', 'kwargs'], defaults=[(), {}])
+#Default number of processes (each one imports matplotlib, seaborn and plotnine), and the number of jobs up to
+#which they are rendered serially rather than paying for the start of a pool
+MAX_DEFAULT_JOBS = 4
+SERIAL_JOBS = 2
+
+_startup_rc = None
+
+
+def startup_rc():
+    #rcParams of a fresh import (matplotlibrc included), without the backend which is set per process
+    global _startup_rc
+    if _startup_rc is None:
+        import matplotlib
+        _startup_rc = {key: value for key, value in matplotlib.rc_params().items() if key != 'backend'}
+    return _startup_rc
+
+
+
+def _init_worker():
+    #Initializer of the pool processes only: the backend of the calling process is never changed
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+
+
+def render_job(job):
+    #Render one job with isolated matplotlib state, returns what the plot function returns
+    import matplotlib
+    import matplotlib.pyplot as plt
+    with matplotlib.rc_context():
+        matplotlib.rcParams.update(startup_rc())
+        try:
+            return job.function(*job.args, **job.kwargs)
+        finally:
+            plt.close('all')
+
+
+
+def render_jobs(jobs, n_jobs=None):
+    #Render all the jobs (default: up to MAX_DEFAULT_JOBS processes, serially for SERIAL_JOBS jobs or less),
+    #results are returned in the order of the jobs
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    if n_jobs is None:
+        n_jobs = 1 if len(jobs) <= SERIAL_JOBS else min(os.cpu_count() or 1, MAX_DEFAULT_JOBS)
+    n_jobs = min(n_jobs, len(jobs))
+    if n_jobs <= 1:
+        return [render_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker) as executor:
+        return list(executor.map(render_job, jobs))
@@ -0,0 +1,179 @@
+import warnings
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.special import betaincinv
+import stats_engine as se
+
+
+#Permutation p-values and bootstrap confidence intervals of the difference in mean relative abundance
+#between two timepoints, for all the families of an AbundanceMatrix at once.
+#Resamples are drawn in batches; each batch has its own seed derived from (seed, pair, batch), so the
+#results do not depend on the number of worker processes. A batch is evaluated for all the families still
+#being tested with two matrix products (group membership x values, membership x presence).
+
+RESULT_COLUMNS = se.RESULT_COLUMNS + ['n_resamples', 'ci_low', 'ci_high']
+BATCHES_PER_ROUND = 4
+
+
+def _batch_rng(seed, pair_index, batch_index, stream):
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(pair_index, batch_index, stream)))
+
+
+
+def _group_means(membership, filled, present):
+    #Means of the rows selected (or weighted) by each line of 'membership', NaN cells left out
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (membership @ filled) / (membership @ present)
+
+
+
+def _permutation_batch(task):
+    #Number of permutations with a difference at least as extreme as the observed one, per family
+    filled, present, n1, observed, seed, pair_index, batch_index, batch_size = task
+    rng = _batch_rng(seed, pair_index, batch_index, 0)
+    n = filled.shape[0]
+    order = rng.permuted(np.tile(np.arange(n), (batch_size, 1)), axis=1)
+    membership = np.zeros((batch_size, n))
+    np.put_along_axis(membership, order[:, :n1], 1.0, axis=1)
+    rest = 1.0 - membership
+    difference = _group_means(membership, filled, present) - _group_means(rest, filled, present)
+    # Tolerance for ties lost to floating point error
+    extreme = np.abs(difference) >= np.abs(observed) - 1e-12 * np.maximum(np.abs(observed), 1.0)
+    return extreme.sum(axis=0)
+
+
+
+def _bootstrap_batch(task):
+    #Differences in means of 'batch_size' bootstrap resamples (rows drawn with replacement within each group)
+    filled, present, n1, seed, pair_index, batch_index, batch_size = task
+    rng = _batch_rng(seed, pair_index, batch_index, 1)
+    n = filled.shape[0]
+    n2 = n - n1
+    weights1 = np.zeros((batch_size, n))
+    weights2 = np.zeros((batch_size, n))
+    for weights, start, size in ((weights1, 0, n1), (weights2, n1, n2)):
+        draws = rng.integers(start, start + size, (batch_size, size))
+        np.add.at(weights, (np.repeat(np.arange(batch_size), size), draws.reshape(-1)), 1.0)
+    return _group_means(weights1, filled, present) - _group_means(weights2, filled, present)
+
+
+
+def _decided(extreme, done, thresholds, confidence):
+    #Families whose Clopper-Pearson interval for the p-value contains none of the thresholds, i.e. lies
+    #entirely above or below each of them
+    tail = (1 - confidence) / 2
+    with np.errstate(invalid='ignore'):
+        lower = np.where(extreme > 0, betaincinv(extreme, done - extreme + 1, tail), 0.0)
+        upper = np.where(extreme < done, betaincinv(extreme + 1, done - extreme, 1 - tail), 1.0)
+    return np.all([(upper < threshold) | (lower > threshold) for threshold in thresholds], axis=0)
+
+
+
+class _SerialExecutor:
+    def map(self, function, tasks):
+        return map(function, tasks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+
+def group_summaries(filled, present, n1):
+    #Counts and means of the first 'n1' rows and of the other rows, per family
+    n_1, n_2 = present[:n1].sum(axis=0), present[n1:].sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return n_1, n_2, filled[:n1].sum(axis=0) / n_1, filled[n1:].sum(axis=0) / n_2
+
+
+
+def permutation_pvalues(filled, present, n1, pair_index=0, n_permutations=10000, batch_size=500, seed=0,
+                        alpha=0.05, early_stop=True, stop_confidence=0.999, executor=None):
+    #Two-sided permutation p-values (with the +1 correction) and the number of permutations used per family.
+    #With 'early_stop', a family stops being permuted once its p-value is known to be on one side of alpha
+    #and of each significance level of the labels, so stopping never changes its label.
+    thresholds = sorted({alpha} | {level for level, label in se.SIGNIFICANCE_LEVELS})
+    n_1, n_2, mean_1, mean_2 = group_summaries(filled, present, n1)
+    observed = mean_1 - mean_2
+    n_families = filled.shape[1]
+    extreme = np.zeros(n_families)
+    done = np.zeros(n_families)
+    active = ~np.isnan(observed)
+    executor = executor or _SerialExecutor()
+    n_batches = -(-n_permutations // batch_size)
+    batch_index = 0
+    while batch_index < n_batches and active.any():
+        columns = np.flatnonzero(active)
+        batches = range(batch_index, min(batch_index + BATCHES_PER_ROUND, n_batches))
+        tasks = [(filled[:, columns], present[:, columns], n1, observed[columns], seed, pair_index, k,
+                  min(batch_size, n_permutations - k * batch_size)) for k in batches]
+        for task, counts in zip(tasks, executor.map(_permutation_batch, tasks)):
+            extreme[columns] += counts
+            done[columns] += task[-1]
+        batch_index = batches.stop
+        if early_stop:
+            active[columns[_decided(extreme[columns], done[columns], thresholds, stop_confidence)]] = False
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p_values = np.where(done > 0, (extreme + 1) / (done + 1), np.nan)
+    return p_values, done
+
+
+
+def bootstrap_interval(filled, present, n1, pair_index=0, n_bootstrap=2000, batch_size=500, seed=0,
+                       confidence=0.95, executor=None):
+    #Percentile bootstrap interval of the difference in means, per family
+    executor = executor or _SerialExecutor()
+    n_batches = -(-n_bootstrap // batch_size)
+    tasks = [(filled, present, n1, seed, pair_index, k, min(batch_size, n_bootstrap - k * batch_size)) for k in range(n_batches)]
+    differences = np.concatenate(list(executor.map(_bootstrap_batch, tasks)), axis=0)
+    tail = (1 - confidence) / 2 * 100
+    with warnings.catch_warnings():
+        # Families without values in one of the groups have only NaN differences
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low, high = np.nanpercentile(differences, [tail, 100 - tail], axis=0)
+    return low, high
+
+
+
+def resample_timepoints(matrix, n_permutations=10000, n_bootstrap=2000, batch_size=500, n_jobs=1, seed=0,
+                        alpha=0.05, early_stop=True, correction=None, confidence=0.95, timepoint_order=None):
+    #Same table as stats_engine.compare_timepoints (plus the number of permutations and the bootstrap
+    #interval), with permutation p-values of the difference in means instead of t-test p-values.
+    #A corrected p-value depends on the p-values of all the families, at a precision early stopping
+    #doesn't give, so all the permutations are run when there is a 'correction'.
+    early_stop = early_stop and correction is None
+    timepoint_rows = matrix.timepoint_rows()
+    timepoints = [tp for tp in timepoint_order if tp in timepoint_rows] if timepoint_order else list(timepoint_rows)
+    values = matrix.values.astype(np.float64)
+    executor = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs and n_jobs > 1 else _SerialExecutor()
+    tables = []
+    with executor:
+        pair_index = 0
+        for idx, tp1 in enumerate(timepoints):
+            for tp2 in timepoints[idx + 1:]:
+                rows = np.concatenate([timepoint_rows[tp1], timepoint_rows[tp2]])
+                n1 = len(timepoint_rows[tp1])
+                present = (~np.isnan(values[rows])).astype(np.float64)
+                filled = np.nan_to_num(values[rows])
+                p_values, done = permutation_pvalues(filled, present, n1, pair_index, n_permutations, batch_size,
+                                                     seed, alpha, early_stop, executor=executor)
+                ci_low, ci_high = bootstrap_interval(filled, present, n1, pair_index, n_bootstrap, batch_size,
+                                                     seed, confidence, executor=executor)
+                n_1, n_2, mean_1, mean_2 = group_summaries(filled, present, n1)
+                tables.append(pd.DataFrame({
+                    'family': matrix.families, 'timepoint_1': tp1, 'timepoint_2': tp2,
+                    'n_1': n_1.astype(np.int64), 'n_2': n_2.astype(np.int64), 'mean_1': mean_1, 'mean_2': mean_2,
+                    'statistic': mean_1 - mean_2, 'p_value': p_values, 'n_resamples': done.astype(np.int64),
+                    'ci_low': ci_low, 'ci_high': ci_high}))
+                pair_index += 1
+    if not tables:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    results = pd.concat(tables, ignore_index=True)
+    results['p_adjusted'] = se.adjust_p_values(results['p_value'].to_numpy(), correction)
+    results['label'] = [se.significance_label(p_value) for p_value in results['p_adjusted']]
+    family_order = {family: j for j, family in enumerate(matrix.families)}
+    results = results.iloc[np.argsort(results['family'].map(family_order).to_numpy(), kind='stable')]
+    return results.reset_index(drop=True)[RESULT_COLUMNS]
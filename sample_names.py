@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+
+#Sample names of the cohorts are '<patient><arm><time point>': P12E7 is patient P12 of the exposed arm at day 7,
+#P6C90 patient P6 of the control arm at day 90. Every distinct name is decoded once, with one regular expression,
+#into its parts and into integer codes that order the samples (arm, time point, patient number), so the order of
+#the samples of a new cohort doesn't have to be listed by hand.
+
+SAMPLE_NAME_PATTERN = r'^(?P<patient>[^EC]*)(?P<arm>[EC])(?P<timepoint>[^EC]*)$'
+#Arms in the order of the plots: the exposed samples, then the controls
+ARMS = ['E', 'C']
+PARSED_COLUMNS = ['patient', 'arm', 'timepoint', 'arm_code', 'timepoint_value', 'patient_number']
+
+
+def _split_like_replacements(names):
+    #Patient and time point of names outside the pattern, as the chained str.replace calls add_patient_info
+    #used to split them ('E.*', 'C.*' for the patient, '.*E', '.*C' for the time point)
+    patient = names.str.replace(r'E.*', '', regex=True).str.replace(r'C.*', '', regex=True)
+    timepoint = names.str.replace(r'.*E', '', regex=True).str.replace(r'.*C', '', regex=True)
+    return patient, timepoint
+
+
+
+def parse_sample_names(sample_names):
+    #Parts of every name (same index as 'sample_name' when it is a Series): 'patient', 'arm' and 'timepoint'
+    #strings, and the codes ordering them: 'arm_code' (position in ARMS, len(ARMS) for other names),
+    #'timepoint_value' (NaN when not a number) and 'patient_number' (the number in the patient, -1 without)
+    names = pd.Series(sample_names)
+    codes, uniques = pd.factorize(names)
+    uniques = pd.Series(np.asarray(uniques, dtype=object), dtype=object)
+    parts = uniques.str.extract(SAMPLE_NAME_PATTERN)
+    unmatched = parts['arm'].isna().to_numpy()
+    if unmatched.any():
+        parts.loc[unmatched, 'patient'], parts.loc[unmatched, 'timepoint'] = _split_like_replacements(uniques[unmatched])
+    parts['arm_code'] = pd.Index(ARMS).get_indexer(parts['arm'])
+    parts.loc[parts['arm_code'] < 0, 'arm_code'] = len(ARMS)
+    parts['timepoint_value'] = pd.to_numeric(parts['timepoint'], errors='coerce')
+    parts['patient_number'] = pd.to_numeric(parts['patient'].str.extract(r'(\d+)')[0], errors='coerce')
+    # Back to one row per name (missing names get missing parts)
+    parsed = parts[PARSED_COLUMNS].reindex(codes)
+    parsed.index = names.index
+    parsed['arm_code'] = parsed['arm_code'].fillna(len(ARMS)).astype(np.int64)
+    parsed['patient_number'] = parsed['patient_number'].fillna(-1).astype(np.int64)
+    return parsed
+
+
+
+def timepoint_order(timepoints):
+    #Distinct time points by value, the ones that are not numbers after them in order of appearance
+    timepoints = pd.unique(pd.Series(timepoints, dtype=object).dropna())
+    values = pd.to_numeric(pd.Series(timepoints, dtype=object), errors='coerce').to_numpy(dtype=float)
+    return [timepoints[i] for i in np.lexsort((np.arange(len(timepoints)), values))]
+
+
+
+def patient_order(patients):
+    #Distinct patients by the number in them (P2 before P10), then by name
+    patients = pd.unique(pd.Series(patients, dtype=object).dropna())
+    numbers = pd.to_numeric(pd.Series(patients, dtype=object).astype(str).str.extract(r'(\d+)')[0], errors='coerce').fillna(-1).to_numpy()
+    return [patients[i] for i in np.lexsort((np.asarray(patients, dtype=str), numbers))]
+
+
+
+def sample_order(sample_names):
+    #Distinct names ordered by arm (exposed first), time point and patient number, and the last sample of every
+    #time point of the exposed arm, after which the relative abundance plot draws a line
+    names = pd.unique(pd.Series(sample_names, dtype=object).dropna())
+    parsed = parse_sample_names(names).assign(sample_name=names)
+    parsed = parsed.sort_values(['arm_code', 'timepoint_value', 'patient_number', 'patient', 'sample_name'], kind='stable', na_position='last')
+    exposed = parsed[parsed['arm'] == ARMS[0]]
+    separators = exposed.groupby('timepoint', sort=False, dropna=False)['sample_name'].last().tolist()
+    return parsed['sample_name'].tolist(), separators
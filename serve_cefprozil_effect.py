@@ -0,0 +1,451 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import traceback
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import functions_analyze_cefprozil_effect as fn
+import analyze_cefprozil_effect as analysis
+import table_cache as tc
+import stats_engine as se
+import resampling as rs
+import render
+from render import PlotJob
+
+
+#Resident query service: the input files are loaded, joined and indexed once, and the relative abundance
+#tables, tests between time points and plots of the projects are answered from memory over local HTTP.
+#Run it with: python serve_cefprozil_effect.py path/to/input_files [path/to/projects.json] [--port 8765]
+#Requests are handled on a pool of threads. Responses are kept in an LRU cache (per dataset generation),
+#and POST /reload loads the input files again (GET /health tells when they changed since the last load).
+#
+#  GET  /health                                        status, loaded projects, whether the input files changed
+#  GET  /projects                                      settings of the configured projects
+#  GET  /relative_abundance?project=&families=&samples=&format=json|csv
+#  GET  /significance?project=&category=&families=&timepoints=&test=&correction=bh|bonferroni|none&format=json|csv
+#  GET  /plot?project=&kind=relative_abundance|families|combined&family=&category=&format=png|svg|pdf&dpi=&renderer=
+#  POST /reload
+#List parameters are comma separated; 'project' defaults to the first configured project.
+#Invalid requests are answered with 400 and other failures with 500, as JSON {"error": ...}; neither is cached.
+
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_ENTRIES = 128
+INPUT_FILES = ["samples_loaded.txt", "superkingdom2descendents.txt", "sample_to_run_info.txt", "families.csv", "species_abundance.txt", "patient_info.csv"]
+PLOT_KINDS = ['relative_abundance', 'families', 'combined']
+CONTENT_TYPES = {'json': "application/json", 'csv': "text/csv", 'png': "image/png", 'svg': "image/svg+xml", 'pdf': "application/pdf"}
+
+
+class QueryError(ValueError):
+    #Invalid request (answered with 400), any other error of a handler is answered with 500
+    pass
+
+
+
+class ProjectData:
+    def __init__(self, settings, species_relative_abundance, abundance_matrix):
+        self.settings = settings
+        self.species_relative_abundance = species_relative_abundance
+        self.abundance_matrix = abundance_matrix
+
+
+
+class Dataset:
+    #The joined input tables, and the family abundances of the projects. Projects of the config are computed
+    #when loading, other project ids on their first request (with the default settings).
+    #Loaded projects are looked up without locking; a project being loaded has a future that the other requests
+    #for it wait on, so requests for other projects are not held up by its scan.
+    def __init__(self, input_dir, projects=None):
+        self.sys_argv = ["serve_cefprozil_effect.py", input_dir]
+        projects = projects or [fn.project_settings()]
+        self.patient_info_paths = [settings['patient_info'] for settings in projects if settings['patient_info']]
+        self.file_keys = self._file_keys()
+        self.samples_loaded, self.superkingdom, self.project, self.families_table = fn.get_metadata(self.sys_argv)
+        self.taxonomy = fn.load_taxonomy_index(self.sys_argv, self.superkingdom, self.families_table)
+        self.projects = {}
+        self.project_ids = []
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._add_projects(projects)
+        self.project_ids = [settings['project_id'] for settings in projects]
+        self.loaded_at = time.time()
+
+    def _file_keys(self):
+        paths = [os.path.join(self.sys_argv[1], name) for name in INPUT_FILES] + self.patient_info_paths
+        return {path: tc.source_key(path) for path in paths if os.path.exists(path)}
+
+    def _add_projects(self, projects):
+        #One scan of 'species_abundance.txt' for all the given projects, as run_batch does
+        selected_projects = analysis.select_projects(self.samples_loaded, self.project, projects)
+        filtered_per_project = analysis.scan_species_abundance(self.sys_argv, selected_projects, self.superkingdom, self.taxonomy)
+        for settings, selected_project_w_accession, filtered_species_abundance in zip(projects, selected_projects, filtered_per_project):
+            species_relative_abundance = analysis.family_abundance(filtered_species_abundance, selected_project_w_accession, self.families_table, self.taxonomy)
+            abundance_matrix = analysis.patient_matrix(species_relative_abundance, self.sys_argv, settings['patient_info'])
+            self.projects[settings['project_id']] = ProjectData(settings, species_relative_abundance, abundance_matrix)
+
+    def get(self, project_id=None):
+        project_id = project_id or self.project_ids[0]
+        project = self.projects.get(project_id)
+        if project is not None:
+            return project
+        if not (self.project['project_id'] == project_id).any():
+            raise QueryError(f"unknown project '{project_id}'")
+        # The lock only guards the futures: the first request of a project loads it, the others wait for it
+        with self._lock:
+            future = self._loading.get(project_id)
+            loads = future is None
+            if loads:
+                future = self._loading[project_id] = Future()
+        if loads:
+            try:
+                self._add_projects([fn.project_settings({'project_id': project_id})])
+                future.set_result(self.projects[project_id])
+            except BaseException as error:
+                future.set_exception(error)
+            finally:
+                # Loaded projects are in self.projects, failed ones are tried again by the next request
+                with self._lock:
+                    del self._loading[project_id]
+        return future.result()
+
+    def changed_files(self):
+        #Input files changed (or added, or removed) since the dataset was loaded
+        current = self._file_keys()
+        return sorted(path for path in set(current) | set(self.file_keys) if current.get(path) != self.file_keys.get(path))
+
+
+
+class LRUCache:
+    #Thread safe mapping keeping the 'max_entries' most recently used entries
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+
+def _param(query, name, default=None):
+    values = query.get(name)
+    return values[-1] if values else default
+
+
+
+def _list_param(query, name):
+    #Comma separated values, None when the parameter is not given
+    value = _param(query, name)
+    return None if value is None else [item for item in value.split(',') if item]
+
+
+
+def _table_response(table, query):
+    #(content type, body) of a table in the requested format
+    table_format = _param(query, 'format', 'json')
+    if table_format == 'csv':
+        return CONTENT_TYPES['csv'], table.to_csv(index=False).encode()
+    if table_format == 'json':
+        return CONTENT_TYPES['json'], table.to_json(orient='records').encode()
+    raise QueryError(f"unknown table format '{table_format}', expected json or csv")
+
+
+
+def relative_abundance(dataset, query):
+    #Relative abundance of the families in the samples, optionally of some families and samples only
+    table = dataset.get(_param(query, 'project')).species_relative_abundance
+    families, samples = _list_param(query, 'families'), _list_param(query, 'samples')
+    if families is not None:
+        table = table[table['family'].isin(families)]
+    if samples is not None:
+        table = table[table['sample_name'].isin(samples)]
+    return _table_response(table, query)
+
+
+
+def _check_values(name, values, known):
+    unknown = [value for value in (values or []) if value not in known]
+    if unknown:
+        raise QueryError(f"unknown {name}: {', '.join(unknown)}")
+
+
+
+def _select(matrix, categories, families):
+    _check_values("families", families, matrix.family_index)
+    return matrix.select(categories=categories, families=families)
+
+
+
+def _category(matrix, query, all_allowed=False):
+    #Category of the request (default: Exposed), one of the project's or 'all' where 'all_allowed'
+    category = _param(query, 'category', "Exposed")
+    if not (all_allowed and category == 'all'):
+        _check_values("category", [category], set(matrix.category))
+    return category
+
+
+
+def _timepoints(matrix, query):
+    #Time points of the request (None for all of them), each one sampled in the project
+    timepoints = _list_param(query, 'timepoints')
+    _check_values("time points", timepoints, matrix.timepoint_rows())
+    return timepoints
+
+
+
+def _timepoint_tests(matrix, settings, timepoints=None):
+    #Tests between the given time points (default: all of them) with the project's test and correction
+    test, correction = settings.get('test', 'student'), settings.get('correction')
+    if correction not in se.CORRECTIONS:
+        raise QueryError(f"unknown correction '{correction}', expected bh, bonferroni or none")
+    if test == 'permutation':
+        return rs.resample_timepoints(matrix, n_permutations=settings.get('n_permutations', 10000), n_jobs=settings.get('n_jobs', 1),
+                                      seed=settings.get('seed', 0), correction=correction, timepoint_order=timepoints)
+    if test not in se.TESTS:
+        raise QueryError(f"unknown test '{test}', expected one of: {', '.join(se.TESTS + ('permutation',))}")
+    return se.compare_timepoints(matrix, test, correction, timepoints)
+
+
+
+def _request_settings(project, query):
+    #Project settings with the test and correction of the request ('correction=none' or empty for no correction).
+    #Permutation tests run in the request thread: a process pool isn't forked from the threaded server.
+    overrides = {key: _param(query, key) for key in ['test', 'correction'] if _param(query, key) is not None}
+    if overrides.get('correction') in ('none', ''):
+        overrides['correction'] = None
+    return dict(project.settings, **overrides, n_jobs=1)
+
+
+
+def significance(dataset, query):
+    #Tests between time points of one Category (default: Exposed, 'all' for every sample) for all or some families
+    project = dataset.get(_param(query, 'project'))
+    category = _category(project.abundance_matrix, query, all_allowed=True)
+    timepoints = _timepoints(project.abundance_matrix, query)
+    matrix = _select(project.abundance_matrix, None if category == 'all' else [category], _list_param(query, 'families'))
+    return _table_response(_timepoint_tests(matrix, _request_settings(project, query), timepoints), query)
+
+
+
+def plot(dataset, query, render_lock):
+    #One plot rendered to a temporary directory, returned as the bytes of the file
+    project = dataset.get(_param(query, 'project'))
+    kind, plot_format = _param(query, 'kind', 'relative_abundance'), _param(query, 'format', 'png')
+    if kind not in PLOT_KINDS:
+        raise QueryError(f"unknown plot kind '{kind}', expected one of: {', '.join(PLOT_KINDS)}")
+    if plot_format not in CONTENT_TYPES or plot_format in ('json', 'csv'):
+        raise QueryError(f"unknown plot format '{plot_format}', expected png, svg or pdf")
+    settings = _request_settings(project, query)
+    dpi = _param(query, 'dpi')
+    if dpi is not None and not (dpi.isdigit() and int(dpi) > 0):
+        raise QueryError(f"invalid dpi '{dpi}', expected a positive integer")
+    settings.update({'renderer': _param(query, 'renderer', 'fast'), 'plot_formats': [plot_format], 'plot_dpi': int(dpi) if dpi else None})
+    if settings['renderer'] not in analysis.RENDERERS:
+        raise QueryError(f"unknown renderer '{settings['renderer']}', expected one of: {', '.join(analysis.RENDERERS)}")
+    if settings['renderer'] == 'default' and plot_format != 'png':
+        raise QueryError("the default renderer only draws png plots")
+    bar_plot, families_plot, combined_plot, plot_kwargs = analysis.plot_functions(settings)
+    with tempfile.TemporaryDirectory() as output_dir:
+        plot_argv = [dataset.sys_argv[0], dataset.sys_argv[1], output_dir]
+        if kind == 'relative_abundance':
+            job = PlotJob(bar_plot, (project.species_relative_abundance.copy(), plot_argv, settings['sample_order'], settings['separators']), plot_kwargs)
+        elif kind == 'families':
+            category = _category(project.abundance_matrix, query)
+            matrix = _select(project.abundance_matrix, [category], _list_param(query, 'families'))
+            job = PlotJob(families_plot, (matrix, category.lower(), plot_argv, _timepoint_tests(matrix, settings)), plot_kwargs)
+        else:
+            family = _param(query, 'family')
+            if family is None:
+                raise QueryError("a combined plot needs a 'family'")
+            matrix = _select(project.abundance_matrix, ["Exposed", "Control"], [family])
+            job = PlotJob(combined_plot, (matrix, family, plot_argv, _timepoint_tests(matrix, settings)), plot_kwargs)
+        # matplotlib's state is global: one plot at a time
+        with render_lock:
+            render.render_job(job)
+        paths = sorted(os.listdir(output_dir))
+        if not paths:
+            raise QueryError("nothing to plot")
+        with open(os.path.join(output_dir, paths[0]), 'rb') as plot_file:
+            return CONTENT_TYPES[plot_format], plot_file.read()
+
+
+
+class QueryService:
+    #Dataset, cache and handlers, independent of the HTTP server
+    def __init__(self, input_dir, projects=None, cache_entries=DEFAULT_CACHE_ENTRIES):
+        self.input_dir = input_dir
+        self.project_settings = projects
+        # (dataset, generation) replaced as one on reload, so a response is always cached with the generation of its data
+        self.state = (Dataset(input_dir, projects), 0)
+        self.cache = LRUCache(cache_entries)
+        self.render_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.routes = {
+            '/relative_abundance': relative_abundance,
+            '/significance': significance,
+            '/plot': lambda dataset, query: plot(dataset, query, self.render_lock),
+        }
+
+    def reload(self):
+        #Load the input files again; requests keep using the previous dataset until the new one is ready
+        with self._reload_lock:
+            self.state = (Dataset(self.input_dir, self.project_settings), self.generation + 1)
+            self.cache.clear()
+        return self.health()
+
+    @property
+    def dataset(self):
+        return self.state[0]
+
+    @property
+    def generation(self):
+        return self.state[1]
+
+    def health(self):
+        return {'status': "ok", 'generation': self.generation, 'loaded_at': self.dataset.loaded_at,
+                'projects': sorted(self.dataset.projects), 'changed_files': self.dataset.changed_files(),
+                'cache': {'entries': len(self.cache.entries), 'hits': self.cache.hits, 'misses': self.cache.misses}}
+
+    def get(self, path, query):
+        #(status, content type, body) of a GET request
+        if path == '/health':
+            return 200, CONTENT_TYPES['json'], json.dumps(self.health()).encode()
+        if path == '/projects':
+            body = [{key: value for key, value in settings.items() if key in ('project_id', 'output_dir', 'test', 'correction')}
+                    for settings in (self.dataset.projects[project_id].settings for project_id in self.dataset.project_ids)]
+            return 200, CONTENT_TYPES['json'], json.dumps(body).encode()
+        if path not in self.routes:
+            return 404, CONTENT_TYPES['json'], json.dumps({'error': f"unknown path '{path}'"}).encode()
+        dataset, generation = self.state
+        key = (generation, path, tuple(sorted((name, tuple(values)) for name, values in query.items())))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return (200,) + cached
+        status, response = self._handle(self.routes[path], dataset, query)
+        if status == 200:
+            self.cache.put(key, response)
+        return (status,) + response
+
+    def post(self, path):
+        #(status, content type, body) of a POST request
+        if path != '/reload':
+            return 404, CONTENT_TYPES['json'], json.dumps({'error': f"unknown path '{path}'"}).encode()
+        status, response = self._handle(lambda: (CONTENT_TYPES['json'], json.dumps(self.reload()).encode()))
+        return (status,) + response
+
+    def _handle(self, handler, *args):
+        #(status, (content type, body)): 400 for invalid requests, 500 (and the traceback on stderr) for other errors
+        try:
+            return 200, handler(*args)
+        except QueryError as error:
+            return 400, (CONTENT_TYPES['json'], json.dumps({'error': str(error)}).encode())
+        except Exception as error:
+            traceback.print_exc()
+            return 500, (CONTENT_TYPES['json'], json.dumps({'error': f"internal error: {error!r}"}).encode())
+
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    #The service is set on the server
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self._respond(*self.server.service.get(url.path, parse_qs(url.query)))
+
+    def do_POST(self):
+        self._respond(*self.server.service.post(urlsplit(self.path).path))
+
+    def _respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+
+class PooledHTTPServer(HTTPServer):
+    #HTTP server handling the requests on a fixed pool of threads
+    def __init__(self, address, service, threads=None, verbose=False):
+        super().__init__(address, RequestHandler)
+        self.service = service
+        self.verbose = verbose
+        self.pool = ThreadPoolExecutor(max_workers=threads or min(32, (os.cpu_count() or 1) + 4))
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+
+def make_server(input_dir, config=None, host="127.0.0.1", port=DEFAULT_PORT, threads=None, cache_entries=DEFAULT_CACHE_ENTRIES, verbose=False):
+    #Server of a service on the inputs of 'input_dir' (port 0 picks a free port, see server.server_address)
+    projects = fn.load_batch_config(config) if config else None
+    render._init_worker()
+    return PooledHTTPServer((host, port), QueryService(input_dir, projects, cache_entries), threads, verbose)
+
+
+
+def main(argv=None):
+    warnings.filterwarnings("ignore", category=UserWarning, module='plotnine')
+    warnings.filterwarnings("ignore", category=RuntimeWarning)
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    parser = argparse.ArgumentParser(prog="serve_cefprozil_effect.py", description="Local query service of the Cefprozil analysis.")
+    parser.add_argument("input_dir", help="path/to/input_files")
+    parser.add_argument("config", nargs='?', help="path/to/projects.json, projects loaded at startup")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--threads", type=int, help="number of request threads")
+    parser.add_argument("--cache-entries", type=int, default=DEFAULT_CACHE_ENTRIES, help="number of responses kept in the LRU cache")
+    parser.add_argument("--verbose", action='store_true', help="log every request")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    server = make_server(args.input_dir, args.config, args.host, args.port, args.threads, args.cache_entries, args.verbose)
+    print(f"Serving {args.input_dir} on http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import os
+import re
+import json
+import time
+import pickle
+import hashlib
+import inspect
+import table_cache as tc
+
+
+#Memoization of the pipeline stages between runs.
+#A stage's fingerprint combines its name, the source code of the functions it runs, its parameters, the
+#content hashes of the files it reads and the fingerprints of the stages it depends on, so a change only
+#recomputes the stages downstream of it. Results are pickled in the cache directory, which is kept under
+#'max_bytes' by evicting the least recently used results.
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def code_version(objects):
+    #Hash of the source code of functions/modules (their repr when the source is not available)
+    digest = hashlib.sha256()
+    for obj in objects:
+        try:
+            digest.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            digest.update(repr(obj).encode())
+    return digest.hexdigest()
+
+
+
+class StageCache:
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, force=False, invalidate=(), profiler=None):
+        #'directory' None disables caching, 'force' recomputes every stage and 'invalidate' the given stages
+        #(and the stages depending on them). A profiling.Profiler measures every stage (cached or not).
+        self.profiler = profiler
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.force = force
+        self.invalidated = set(invalidate)
+        self.fingerprints = {}
+        self.hits = []
+        self.misses = []
+        self._index = {'entries': {}, 'files': {}}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            index_path = os.path.join(directory, "index.json")
+            if os.path.exists(index_path):
+                with open(index_path) as index_file:
+                    self._index = json.load(index_file)
+
+    def file_fingerprint(self, path):
+        #Content hash of an input file, only recomputed when its size or mtime changed
+        key = tc.source_key(path)
+        known = self._index['files'].get(os.path.abspath(path))
+        if known and known['size'] == key['size'] and known['mtime_ns'] == key['mtime_ns']:
+            return known['sha256']
+        key['sha256'] = tc.file_sha256(path)
+        self._index['files'][os.path.abspath(path)] = key
+        return key['sha256']
+
+    def fingerprint(self, name, code=(), params=None, files=(), depends_on=()):
+        description = {
+            'stage': name,
+            'code': code_version(code),
+            'params': json.dumps(params, sort_keys=True, default=str),
+            'files': [(os.path.abspath(path), self.file_fingerprint(path)) for path in files],
+            'depends_on': [(stage, self.fingerprints.get(stage)) for stage in depends_on],
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def run(self, name, function, args=(), kwargs=None, code=None, params=None, files=(), depends_on=()):
+        #Result of function(*args, **kwargs), from the cache when the stage's fingerprint is known
+        if self.profiler is None:
+            return self._run(name, function, args, kwargs, code, params, files, depends_on)
+        hits = len(self.hits)
+        return self.profiler.measure(name, self._run, (name, function, args, kwargs, code, params, files, depends_on),
+                                     inputs=list(args), cached=lambda: len(self.hits) > hits)
+
+    def _run(self, name, function, args, kwargs, code, params, files, depends_on):
+        kwargs = kwargs or {}
+        if self.directory is None:
+            return function(*args, **kwargs)
+        #Stages of a project are named '<project_id>/<stage>' and are invalidated by '<stage>' too
+        if name.split('/')[-1] in self.invalidated or any(stage in self.invalidated for stage in depends_on):
+            self.invalidated.add(name)
+        fingerprint = self.fingerprint(name, code if code is not None else [function], params, files, depends_on)
+        self.fingerprints[name] = fingerprint
+        file_name = f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}-{fingerprint[:32]}.pkl"
+        path = os.path.join(self.directory, file_name)
+        if not self.force and name not in self.invalidated and file_name in self._index['entries'] and os.path.exists(path):
+            with open(path, 'rb') as result_file:
+                result = pickle.load(result_file)
+            self._index['entries'][file_name]['last_access'] = time.time()
+            self._save_index()
+            self.hits.append(name)
+            return result
+        result = function(*args, **kwargs)
+        with open(path + ".tmp", 'wb') as result_file:
+            pickle.dump(result, result_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+        self._index['entries'][file_name] = {'stage': name, 'size': os.path.getsize(path), 'last_access': time.time()}
+        self._evict(keep=file_name)
+        self._save_index()
+        self.misses.append(name)
+        return result
+
+    def _evict(self, keep):
+        #Remove least recently used results until the cache fits in 'max_bytes' (the newest result is kept)
+        entries = self._index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        for file_name in sorted(entries, key=lambda name: entries[name]['last_access']):
+            if total <= self.max_bytes:
+                break
+            if file_name == keep:
+                continue
+            total -= entries.pop(file_name)['size']
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+
+    def _save_index(self):
+        index_path = os.path.join(self.directory, "index.json")
+        with open(index_path + ".tmp", 'w') as index_file:
+            json.dump(self._index, index_file)
+        os.replace(index_path + ".tmp", index_path)
@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+from scipy.special import stdtr
+from longitudinal import PatientTensor
+
+
+#t-tests between timepoints for all the families of an AbundanceMatrix at once.
+#Each timepoint pair is one vectorized computation over the families (columns), NaN cells
+#(family without a row for a sample) are left out of the family's groups like the DataFrame filters did.
+#Paired tests align the samples of every patient on a patient x time point x family array (longitudinal.py)
+#and test all the time point pairs in one computation.
+
+TESTS = ('student', 'welch', 'paired')
+CORRECTIONS = (None, 'bh', 'bonferroni')
+#Labels of the p-values below each level, most significant first
+SIGNIFICANCE_LEVELS = [(0.001, '***'), (0.01, '**'), (0.05, '*')]
+RESULT_COLUMNS = ['family', 'timepoint_1', 'timepoint_2', 'n_1', 'n_2', 'mean_1', 'mean_2',
+                  'statistic', 'p_value', 'p_adjusted', 'label']
+
+
+def significance_label(p_value):
+    # Define significance levels
+    for level, label in SIGNIFICANCE_LEVELS:
+        if p_value < level:
+            return label
+    return None  # Not significant
+
+
+
+def _moments(values):
+    #Count, mean and sample variance of every column, ignoring NaN
+    present = ~np.isnan(values)
+    n = present.sum(axis=0)
+    filled = np.where(present, values, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = filled.sum(axis=0) / n
+        squares = np.where(present, values - mean, 0.0) ** 2
+        var = squares.sum(axis=0) / (n - 1)
+    return n, mean, var
+
+
+
+def _two_sided_p(statistic, df):
+    #Student t survival function through scipy.special, which loads much faster than scipy.stats
+    with np.errstate(invalid='ignore'):
+        return 2 * stdtr(df, -np.abs(statistic))
+
+
+
+def independent_ttest(group1, group2, equal_var=True):
+    #Column-wise ttest_ind of two (samples x families) arrays: Student (equal_var) or Welch
+    n1, mean1, var1 = _moments(group1)
+    n2, mean2, var2 = _moments(group2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if equal_var:
+            df = n1 + n2 - 2.0
+            pooled = ((n1 - 1) * var1 + (n2 - 1) * var2) / df
+            statistic = (mean1 - mean2) / np.sqrt(pooled * (1.0 / n1 + 1.0 / n2))
+        else:
+            se1, se2 = var1 / n1, var2 / n2
+            statistic = (mean1 - mean2) / np.sqrt(se1 + se2)
+            df = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+    return statistic, _two_sided_p(statistic, df), (n1, n2, mean1, mean2)
+
+
+
+def paired_ttest(group1, group2):
+    #Column-wise ttest_rel of two (patients x families) arrays with aligned rows
+    n1, mean1, _ = _moments(np.where(np.isnan(group2), np.nan, group1))
+    n2, mean2, _ = _moments(np.where(np.isnan(group1), np.nan, group2))
+    n, mean, var = _moments(group1 - group2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        statistic = mean / np.sqrt(var / n)
+    return statistic, _two_sided_p(statistic, n - 1.0), (n1, n2, mean1, mean2)
+
+
+
+def adjust_p_values(p_values, correction):
+    #Multiple testing correction over all the given p-values (NaN p-values are not counted as tests)
+    p_values = np.asarray(p_values, dtype=float)
+    if correction is None:
+        return p_values.copy()
+    adjusted = np.full(p_values.shape, np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    m = len(tested)
+    if m == 0:
+        return adjusted
+    if correction == 'bonferroni':
+        adjusted[tested] = np.minimum(p_values[tested] * m, 1.0)
+    elif correction == 'bh':
+        order = tested[np.argsort(p_values[tested], kind='stable')]
+        scaled = p_values[order] * m / np.arange(1, m + 1)
+        adjusted[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+    else:
+        raise ValueError(f"Unknown correction '{correction}', expected one of {CORRECTIONS}")
+    return adjusted
+
+
+
+def _paired_table(matrix, timepoints, pairs):
+    #Paired tests of all the timepoint pairs at once: the (patients x pairs x families) values at the two
+    #timepoints are tested as (patients x (pairs x families)) columns
+    tensor = PatientTensor.from_matrix(matrix, timepoints)
+    first, second = tensor.pair_values(pairs)
+    n_patients, n_pairs, n_families = first.shape
+    statistic, p_value, (n1, n2, mean1, mean2) = paired_ttest(first.reshape(n_patients, -1), second.reshape(n_patients, -1))
+    return pd.DataFrame({
+        'family': np.tile(np.asarray(matrix.families, dtype=object), n_pairs),
+        'timepoint_1': np.repeat([tp1 for tp1, tp2 in pairs], n_families),
+        'timepoint_2': np.repeat([tp2 for tp1, tp2 in pairs], n_families),
+        'n_1': n1, 'n_2': n2, 'mean_1': mean1, 'mean_2': mean2,
+        'statistic': statistic, 'p_value': p_value})
+
+
+
+def compare_timepoints(matrix, test='student', correction=None, timepoint_order=None):
+    #All family x timepoint-pair tests of 'matrix' in one table, the multiple testing correction is
+    #applied across every family and pair. Timepoints default to their order of appearance in the rows.
+    if test not in TESTS:
+        raise ValueError(f"Unknown test '{test}', expected one of {TESTS}")
+    timepoint_rows = matrix.timepoint_rows()
+    timepoints = [tp for tp in timepoint_order if tp in timepoint_rows] if timepoint_order else list(timepoint_rows)
+    values = matrix.values.astype(np.float64)
+    pairs = [(tp1, tp2) for idx, tp1 in enumerate(timepoints) for tp2 in timepoints[idx + 1:]]
+    tables = []
+    if test == 'paired' and pairs:
+        tables.append(_paired_table(matrix, timepoints, pairs))
+    elif test != 'paired':
+        for tp1, tp2 in pairs:
+            rows1, rows2 = timepoint_rows[tp1], timepoint_rows[tp2]
+            statistic, p_value, (n1, n2, mean1, mean2) = independent_ttest(values[rows1], values[rows2], equal_var=(test == 'student'))
+            tables.append(pd.DataFrame({
+                'family': matrix.families, 'timepoint_1': tp1, 'timepoint_2': tp2,
+                'n_1': n1, 'n_2': n2, 'mean_1': mean1, 'mean_2': mean2,
+                'statistic': statistic, 'p_value': p_value}))
+    if not tables:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    results = pd.concat(tables, ignore_index=True)
+    results['p_adjusted'] = adjust_p_values(results['p_value'].to_numpy(), correction)
+    results['label'] = [significance_label(p_value) for p_value in results['p_adjusted']]
+    # Family major order, as the plots read them
+    family_order = {family: j for j, family in enumerate(matrix.families)}
+    results = results.iloc[np.argsort(results['family'].map(family_order).to_numpy(), kind='stable')]
+    return results.reset_index(drop=True)[RESULT_COLUMNS]
+
+
+
+def significance_by_family(results):
+    #{family: [(tp1, tp2, label), ...]} for the significant comparisons, as drawn on the box plots
+    significance_data = {}
+    significant = results[results['label'].notna()]
+    for family, tp1, tp2, label in zip(significant['family'], significant['timepoint_1'], significant['timepoint_2'], significant['label']):
+        significance_data.setdefault(family, []).append((tp1, tp2, label))
+    return significance_data
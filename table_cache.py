@@ -0,0 +1,298 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype, is_bool_dtype
+
+
+#Columnar binary cache for the raw input tables.
+#Each source file gets a directory with one raw binary file per column and a 'manifest.json'.
+#Text columns are stored as categorical codes (+ a categories list), integer columns and codes are
+#downcast to the smallest dtype that holds them, and float columns are downcast to float32 only when
+#it is lossless. The cache is keyed by the source file size, mtime and sha256, and by the read options.
+#Caches are built in a directory of their own and moved in place when complete, so concurrent runs never see
+#(or remove) each other's partial builds. Building raises OSError where the cache can't be written (a read-only
+#input directory): the readers then parse the text files.
+
+FORMAT_VERSION = 1
+DEFAULT_CHUNKSIZE = 1_000_000
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class ColumnTypeConflict(Exception):
+    #A column is numeric in one chunk and text in another
+    def __init__(self, column):
+        super().__init__(column)
+        self.column = column
+
+
+
+def default_cache_dir(path):
+    return os.path.join(os.path.dirname(os.path.abspath(path)), ".table_cache")
+
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+
+def source_key(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+
+def _options_key(read_csv_kwargs):
+    return json.dumps(read_csv_kwargs, sort_keys=True, default=str)
+
+
+
+def _smallest_int_dtype(min_value, max_value):
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+
+class CachedTable:
+    #Read access to one cached table, columns are memory-mapped so only the requested ones are touched
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json")) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.num_rows = self.manifest['num_rows']
+        self.columns = [column['name'] for column in self.manifest['columns']]
+        self._meta = {column['name']: column for column in self.manifest['columns']}
+
+    def raw_column(self, name):
+        #Stored values: numbers, or categorical codes (-1 for missing) for text columns
+        meta = self._meta[name]
+        dtype = np.dtype(meta['dtype'])
+        if self.num_rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.directory, meta['file']), dtype=dtype, mode='r', shape=(self.num_rows,))
+
+    def categories(self, name):
+        meta = self._meta[name]
+        if meta['kind'] != 'category':
+            return None
+        with open(os.path.join(self.directory, meta['categories_file'])) as categories_file:
+            return json.load(categories_file)
+
+    def code_of(self, name, value):
+        #Categorical code of a text value (-2 if the value never occurs, so it matches no row)
+        categories = self.categories(name)
+        return categories.index(value) if value in categories else -2
+
+    def column(self, name, rows=None, categorical=False, downcast=False):
+        meta = self._meta[name]
+        values = self.raw_column(name)
+        values = np.asarray(values if rows is None else values[rows])
+        if meta['kind'] == 'category':
+            categories = self.categories(name)
+            if categorical:
+                return pd.Categorical.from_codes(values.astype(np.int64), categories=categories)
+            #Missing values have code -1, which picks the trailing NaN
+            lookup = np.array(categories + [np.nan], dtype=object)
+            return pd.Series(lookup.take(values.astype(np.int64)), dtype=meta['source_dtype'])
+        if not downcast:
+            values = values.astype(meta['source_dtype'], copy=False)
+        return values
+
+    def read(self, columns=None, rows=None, categorical=False, downcast=False):
+        #Read selected columns (default: all) for selected row positions (default: all rows)
+        columns = self.columns if columns is None else list(columns)
+        data = {}
+        for name in columns:
+            data[name] = self.column(name, rows, categorical, downcast)
+        return pd.DataFrame(data, columns=columns)
+
+
+
+def _is_valid(directory, path, options_key):
+    manifest_path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('format_version') != FORMAT_VERSION or manifest.get('options') != options_key:
+        return False
+    source = manifest['source']
+    current = source_key(path)
+    if current['size'] != source['size']:
+        return False
+    if current['mtime_ns'] == source['mtime_ns']:
+        return True
+    #Touched but maybe not changed: trust the content hash and refresh the stored mtime
+    if file_sha256(path) != source['sha256']:
+        return False
+    source['mtime_ns'] = current['mtime_ns']
+    try:
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+    except OSError:
+        #Read-only cache: the content hash is checked again next time
+        pass
+    return True
+
+
+
+def _write_chunks(path, directory, read_csv_kwargs, chunksize, text_columns):
+    kwargs = dict(read_csv_kwargs)
+    if text_columns:
+        dtype = dict(kwargs.get('dtype') or {})
+        dtype.update({column: str for column in text_columns})
+        kwargs['dtype'] = dtype
+    columns = {}
+    order = []
+    num_rows = 0
+    for chunk in pd.read_csv(path, chunksize=chunksize, **kwargs):
+        for name in chunk.columns:
+            series = chunk[name]
+            numeric = is_numeric_dtype(series.dtype) or is_bool_dtype(series.dtype)
+            if name not in columns:
+                index = len(order)
+                order.append(name)
+                columns[name] = {
+                    'name': name,
+                    'kind': 'numeric' if numeric else 'category',
+                    'dtype': str(series.dtype) if numeric else 'int32',
+                    'source_dtype': str(series.dtype),
+                    'file': f"{index}.bin",
+                }
+                if not numeric:
+                    columns[name]['categories_file'] = f"{index}.categories.json"
+                    columns[name]['lookup'] = {}
+                open(os.path.join(directory, columns[name]['file']), 'wb').close()
+            meta = columns[name]
+            column_file = os.path.join(directory, meta['file'])
+            if (meta['kind'] == 'numeric') != numeric:
+                raise ColumnTypeConflict(name)
+            if numeric:
+                stored = np.dtype(meta['dtype'])
+                promoted = np.result_type(stored, series.dtype)
+                if promoted != stored:
+                    #e.g. an int column that gets NaN values in a later chunk
+                    previous = np.fromfile(column_file, dtype=stored).astype(promoted)
+                    previous.tofile(column_file)
+                    meta['dtype'] = meta['source_dtype'] = str(promoted)
+                values = series.to_numpy().astype(meta['dtype'])
+            else:
+                codes, uniques = pd.factorize(series)
+                lookup = meta['lookup']
+                global_codes = np.array([lookup.setdefault(value, len(lookup)) for value in uniques], dtype=np.int32)
+                values = np.where(codes >= 0, global_codes.take(np.maximum(codes, 0)) if len(global_codes) else -1, -1).astype(np.int32)
+            with open(column_file, 'ab') as out:
+                values.tofile(out)
+        num_rows += len(chunk)
+    return [columns[name] for name in order], num_rows
+
+
+
+def _finalize_columns(directory, columns, num_rows):
+    for meta in columns:
+        column_file = os.path.join(directory, meta['file'])
+        stored = np.dtype(meta['dtype'])
+        values = np.fromfile(column_file, dtype=stored)
+        if meta['kind'] == 'category':
+            categories = list(meta.pop('lookup'))
+            with open(os.path.join(directory, meta['categories_file']), 'w') as categories_file:
+                json.dump(categories, categories_file)
+            target = _smallest_int_dtype(-1, max(len(categories) - 1, 0))
+        elif stored.kind in 'iu' and num_rows > 0:
+            target = _smallest_int_dtype(int(values.min()), int(values.max()))
+        elif stored.kind == 'f' and stored.itemsize > 4:
+            as_float32 = values.astype(np.float32)
+            lossless = np.array_equal(as_float32.astype(stored), values, equal_nan=True)
+            target = np.dtype(np.float32) if lossless else stored
+        else:
+            target = stored
+        if target != stored:
+            values.astype(target).tofile(column_file)
+            meta['dtype'] = str(target)
+
+
+
+def make_build_dir(directory):
+    #New empty directory next to 'directory', private to this build
+    os.makedirs(os.path.dirname(os.path.abspath(directory)), exist_ok=True)
+    return tempfile.mkdtemp(prefix=os.path.basename(directory) + ".building-", dir=os.path.dirname(os.path.abspath(directory)))
+
+
+
+def install_build(building, directory):
+    #Move a complete build to 'directory', replacing the previous one. When another run installed its build
+    #in between, theirs is kept (both were built from the same source).
+    shutil.rmtree(directory, ignore_errors=True)
+    try:
+        os.replace(building, directory)
+    except OSError:
+        shutil.rmtree(building, ignore_errors=True)
+        if not os.path.exists(os.path.join(directory, "manifest.json")):
+            raise
+
+
+
+def build_cache(path, directory, read_csv_kwargs=None, chunksize=DEFAULT_CHUNKSIZE):
+    #Parse 'path' in chunks and write its columnar cache to 'directory'
+    read_csv_kwargs = read_csv_kwargs or {}
+    building = make_build_dir(directory)
+    try:
+        _build_columns(path, building, read_csv_kwargs, chunksize)
+    except BaseException:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    install_build(building, directory)
+
+
+
+def _build_columns(path, building, read_csv_kwargs, chunksize):
+    text_columns = []
+    while True:
+        try:
+            columns, num_rows = _write_chunks(path, building, read_csv_kwargs, chunksize, text_columns)
+            break
+        except ColumnTypeConflict as conflict:
+            #Mixed column: read it as text everywhere, as a single full-file parse would
+            text_columns.append(conflict.column)
+            shutil.rmtree(building)
+            os.makedirs(building)
+    _finalize_columns(building, columns, num_rows)
+    source = source_key(path)
+    source['sha256'] = file_sha256(path)
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'options': _options_key(read_csv_kwargs),
+        'source': source,
+        'num_rows': num_rows,
+        'columns': columns,
+    }
+    with open(os.path.join(building, "manifest.json"), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+
+
+def open_table(path, cache_dir=None, chunksize=DEFAULT_CHUNKSIZE, **read_csv_kwargs):
+    #Open the cached version of 'path', (re)building it if it is missing or the source changed
+    cache_dir = cache_dir or default_cache_dir(path)
+    directory = os.path.join(cache_dir, os.path.basename(path))
+    if not _is_valid(directory, path, _options_key(read_csv_kwargs)):
+        build_cache(path, directory, read_csv_kwargs, chunksize)
+    return CachedTable(directory)
+
+
+
+def read_table(path, columns=None, cache_dir=None, **read_csv_kwargs):
+    #Drop-in replacement of pd.read_csv(path, **read_csv_kwargs) going through the cache
+    table = open_table(path, cache_dir=cache_dir, **read_csv_kwargs)
+    return table.read(columns)
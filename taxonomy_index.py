@@ -0,0 +1,163 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import table_cache as tc
+
+
+#Taxonomy index: 'superkingdom2descendents' and 'families.csv' compiled once into flat arrays.
+#Taxon ids are kept sorted, every other taxonomy column is stored as integer codes into an interned table
+#of its values, and every interned scientific name has the code of its family (-1 when families.csv does
+#not list it). Joining the abundance rows to the taxonomy is then a searchsorted + gathers instead of
+#merges on strings. The index is saved as an .npz next to the table caches and rebuilt when the two
+#source files change.
+
+FORMAT_VERSION = 1
+INDEX_FILE = "taxonomy_index.npz"
+TAXON_ID = 'ncbi_taxon_id'
+#Name that species missing from the taxonomy get, as filter_species_abundance does
+OTHER = "Other"
+
+
+class TaxonomyIndex:
+    def __init__(self, taxon_ids, codes, values, family_of_name, families, key=None):
+        #'codes'/'values': {column: codes per taxon} / {column: interned values} for the taxonomy columns
+        self.taxon_ids = taxon_ids
+        self.codes = codes
+        self.values = values
+        self.columns = list(codes)
+        self.family_of_name = family_of_name
+        self.families = families
+        self.key = key or {}
+
+    @classmethod
+    def build(cls, superkingdom, families_table, key=None):
+        #ValueError when the taxon ids can't be used as a unique join key
+        if TAXON_ID not in superkingdom.columns or 'scientific_name' not in superkingdom.columns:
+            raise ValueError(f"the taxonomy table needs '{TAXON_ID}' and 'scientific_name' columns")
+        taxon_ids = superkingdom[TAXON_ID]
+        if taxon_ids.isna().any() or taxon_ids.duplicated().any():
+            raise ValueError(f"'{TAXON_ID}' values of the taxonomy table are not unique")
+        order = np.argsort(taxon_ids.to_numpy(), kind='stable')
+        codes, values = {}, {}
+        for column in superkingdom.columns:
+            if column == TAXON_ID:
+                continue
+            column_codes, uniques = pd.factorize(superkingdom[column].iloc[order])
+            uniques = np.asarray(uniques, dtype=str)
+            if column == 'scientific_name' and OTHER not in uniques:
+                uniques = np.append(uniques, OTHER)
+            codes[column], values[column] = column_codes.astype(np.int32), uniques
+        # Family of every name, from the first row of each species in families.csv (as aggregate_family_abundance)
+        families_table = families_table.iloc[:, [1, 2]].drop_duplicates(subset=families_table.columns[1])
+        family_codes_of_species, families = pd.factorize(families_table.iloc[:, 1].str.replace('.*: ', '', regex=True))
+        species_codes = pd.Index(families_table.iloc[:, 0]).get_indexer(values['scientific_name'])
+        family_of_name = np.where(species_codes >= 0, family_codes_of_species.take(np.maximum(species_codes, 0)), -1) if len(families_table) else np.full(len(species_codes), -1)
+        return cls(taxon_ids.to_numpy()[order], codes, values, family_of_name.astype(np.int32), np.asarray(families, dtype=str), key)
+
+    def save(self, path):
+        arrays = {'taxon_ids': self.taxon_ids, 'family_of_name': self.family_of_name, 'families': self.families,
+                  'meta': np.array(json.dumps({'format': FORMAT_VERSION, 'columns': self.columns, 'key': self.key}))}
+        for i, column in enumerate(self.columns):
+            arrays[f"codes_{i}"], arrays[f"values_{i}"] = self.codes[column], self.values[column]
+        with open(path + ".tmp", 'wb') as index_file:
+            np.savez(index_file, **arrays)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        #None when the file is from another format version
+        with np.load(path, allow_pickle=False) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            if meta['format'] != FORMAT_VERSION:
+                return None
+            codes = {column: arrays[f"codes_{i}"] for i, column in enumerate(meta['columns'])}
+            values = {column: arrays[f"values_{i}"] for i, column in enumerate(meta['columns'])}
+            return cls(arrays['taxon_ids'], codes, values, arrays['family_of_name'], arrays['families'], meta['key'])
+
+    def positions(self, taxon_ids):
+        #Position of every taxon id in the index, -1 for the ids it doesn't have
+        taxon_ids = np.asarray(taxon_ids)
+        positions = np.searchsorted(self.taxon_ids, taxon_ids)
+        positions = np.minimum(positions, max(len(self.taxon_ids) - 1, 0))
+        found = self.taxon_ids[positions] == taxon_ids if len(self.taxon_ids) else np.zeros(len(taxon_ids), dtype=bool)
+        return np.where(found, positions, -1)
+
+    def joins(self, species_abundance_columns):
+        #True when the taxonomy would be merged to a table with these columns on the taxon id only
+        return [column for column in [TAXON_ID] + self.columns if column in species_abundance_columns] == [TAXON_ID]
+
+    def add_kingdom(self, species_abundance):
+        #add_kingdom through the index: rows at species rank, with the taxonomy columns as categoricals of
+        #the interned values (missing for unknown taxa, like the left merge)
+        #(row labels are positions in 'species_abundance', as after the merge)
+        species_abundance = species_abundance.reset_index(drop=True)
+        if 'taxon_rank_level' in species_abundance.columns:
+            species_abundance = species_abundance[species_abundance['taxon_rank_level'] == 'species'].copy()
+        positions = self.positions(species_abundance[TAXON_ID].to_numpy())
+        for column in self.columns:
+            codes = np.where(positions >= 0, self.codes[column].take(np.maximum(positions, 0)), -1) if len(self.taxon_ids) else np.full(len(positions), -1)
+            species_abundance[column] = pd.Categorical.from_codes(codes, categories=self.values[column])
+        return species_abundance
+
+    def is_interned(self, scientific_names):
+        #True for a categorical of the index's scientific names, whose codes can be gathered directly
+        return (isinstance(scientific_names.dtype, pd.CategoricalDtype)
+                and len(scientific_names.cat.categories) == len(self.values['scientific_name'])
+                and bool((scientific_names.cat.categories.to_numpy(dtype=str) == self.values['scientific_name']).all()))
+
+    def family_codes(self, scientific_names):
+        #Family code of every name of an interned categorical (-1 without family)
+        codes = scientific_names.cat.codes.to_numpy()
+        return np.where(codes >= 0, self.family_of_name.take(np.maximum(codes, 0)), -1) if len(self.family_of_name) else np.full(len(codes), -1)
+
+
+
+def _file_key(path):
+    key = tc.source_key(path)
+    key['sha256'] = tc.file_sha256(path)
+    return key
+
+
+
+def _is_current(index, paths):
+    #The source files are unchanged: same size and mtime, or same content (then the key gets the new mtime).
+    #Returns (current, key refreshed)
+    refreshed = False
+    for path in paths:
+        known = index.key.get(os.path.abspath(path))
+        if known is None:
+            return False, False
+        stat = tc.source_key(path)
+        if (stat['size'], stat['mtime_ns']) != (known['size'], known['mtime_ns']):
+            if tc.file_sha256(path) != known['sha256']:
+                return False, False
+            known.update(stat)
+            refreshed = True
+    return True, refreshed
+
+
+
+def open_index(superkingdom_path, families_path, superkingdom, families_table, cache_dir=None):
+    #Index of the two tables, loaded from its file when the sources didn't change, built (and saved) otherwise.
+    #None when the taxonomy table can't be indexed by taxon id.
+    index_path = os.path.join(cache_dir or tc.default_cache_dir(superkingdom_path), INDEX_FILE)
+    paths = [superkingdom_path, families_path]
+    if os.path.exists(index_path):
+        index = TaxonomyIndex.load(index_path)
+        current, refreshed = _is_current(index, paths) if index is not None else (False, False)
+        if current:
+            if refreshed:
+                index.save(index_path)
+            return index
+    try:
+        index = TaxonomyIndex.build(superkingdom, families_table, {os.path.abspath(path): _file_key(path) for path in paths})
+    except ValueError:
+        return None
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        index.save(index_path)
+    except OSError:
+        #Read-only input directory: the index is built again by the next run
+        pass
+    return index
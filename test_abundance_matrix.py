@@ -0,0 +1,36 @@
+from abundance_matrix import AbundanceMatrix
+import pandas as pd
+import numpy as np
+
+def long_table():
+    return pd.DataFrame({
+        'family': ["A", "A", "A", "B", "B"],
+        'sample_name': ["P1E0", "P6C0", "P1E7", "P1E0", "P1E7"],
+        'relative_abundance': [10.0, 20.0, 30.0, 40.0, 50.0],
+        'patient': ["P1", "P6", "P1", "P1", "P1"],
+        'timepoint': ["0", "0", "7", "0", "7"],
+        'Category': ["Exposed", "Control", "Exposed", "Exposed", "Exposed"]})
+
+def test_from_long_groups_rows_by_category():
+    matrix = AbundanceMatrix.from_long(long_table())
+    assert matrix.samples.tolist() == ["P1E0", "P1E7", "P6C0"]
+    assert matrix.families.tolist() == ["A", "B"]
+    assert matrix.values.dtype == np.float32
+    assert matrix.row("P1E7").tolist() == [30.0, 50.0]
+    # 'B' has no row for P6C0
+    assert np.isnan(matrix.column("B")[2])
+
+def test_category_subsets_are_views():
+    matrix = AbundanceMatrix.from_long(long_table())
+    exposed = matrix.subset("Exposed")
+    control = matrix.subset("Control")
+    assert exposed.samples.tolist() == ["P1E0", "P1E7"]
+    assert control.samples.tolist() == ["P6C0"]
+    assert np.shares_memory(exposed.values, matrix.values)
+    assert np.shares_memory(control.values, matrix.values)
+
+def test_to_long_round_trip():
+    table = long_table()
+    result = AbundanceMatrix.from_long(table).to_long()
+    expected = table.sort_values(['family', 'Category'], ascending=[True, False], kind='stable').reset_index(drop=True)
+    pd.testing.assert_frame_equal(result.astype(object), expected.astype(object))
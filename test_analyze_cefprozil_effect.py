@@ -0,0 +1,53 @@
+from test_functions_analyze_cefprozil_effect import write_small_inputs
+import subprocess
+import sys
+import os
+import json
+
+PLOTTING_MODULES = ['matplotlib', 'seaborn', 'plotnine']
+
+def loaded_plotting_modules(code):
+    # Modules loaded by running 'code' in a fresh interpreter
+    check = f"{code}\nimport sys\nprint(','.join(module for module in {PLOTTING_MODULES!r} if module in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ""
+
+def test_import_does_not_load_plotting_libraries():
+    assert loaded_plotting_modules("import analyze_cefprozil_effect") == ""
+
+def test_stats_only_run(tmp_path):
+    sys_argv = write_small_inputs(tmp_path / "input")
+    output_dir = tmp_path / "output"
+    code = f"import analyze_cefprozil_effect as a\na.main([{sys_argv[1]!r}, {str(output_dir)!r}, '--stats-only'])"
+    assert loaded_plotting_modules(code) == ""
+    assert sorted(os.listdir(output_dir)) == [".stage_cache", "run_info.json", "timepoint_tests_exposed.csv"]
+    with open(output_dir / "run_info.json") as run_info_file:
+        run_info = json.load(run_info_file)
+    assert run_info['outputs'] == "stats-only"
+    assert run_info['startup_seconds'] > 0
+
+def test_profile_run(tmp_path):
+    import analyze_cefprozil_effect as main_script
+    sys_argv = write_small_inputs(tmp_path / "input")
+    output_dir = tmp_path / "output"
+    main_script.main([sys_argv[1], str(output_dir), '--stats-only', '--profile-cprofile'])
+    with open(output_dir / "profile_trace.json") as trace_file:
+        stages = [event['name'] for event in json.load(trace_file)['traceEvents']]
+    assert stages[:3] == ['metadata', 'select_projects', 'species_abundance']
+    assert 'PRJEB8094/timepoint_tests' in stages
+    assert "cProfile of the slowest stage" in (output_dir / "profile_summary.txt").read_text()
+    assert os.path.exists(output_dir / "profile_slowest_stage.prof")
+
+def test_plot_options_need_the_fast_renderer(tmp_path, capsys):
+    import analyze_cefprozil_effect as main_script
+    import pytest
+    for options in [['--dpi', '50'], ['--renderer', 'default', '--plot-format', 'svg'], ['--facets-per-page', '4']]:
+        with pytest.raises(SystemExit):
+            main_script.parse_arguments(["input", "output"] + options)
+        assert "only apply to --renderer fast" in capsys.readouterr().err
+    assert main_script.parse_arguments(["input", "output", '--renderer', 'fast', '--dpi', '50']).dpi == 50
+    # The renderer can come from the config
+    config_path = tmp_path / "projects.json"
+    config_path.write_text(json.dumps([{'project_id': "PRJEB8094", 'renderer': "fast"}]))
+    assert main_script.parse_arguments(["input", "output", str(config_path), '--dpi', '50']).dpi == 50
@@ -0,0 +1,50 @@
+import benchmark_cefprozil_effect as bench
+import functions_analyze_cefprozil_effect as fn
+import analyze_cefprozil_effect as main_script
+import pandas as pd
+import os
+
+def test_synthetic_inputs_have_the_input_schemas(tmp_path):
+    sys_argv = bench.generate_synthetic_inputs(str(tmp_path), n_projects=3, n_patients=8, n_species=40, runs_per_sample=2, species_per_run=10)
+    samples_loaded, superkingdom, project, families_table = fn.get_metadata(sys_argv, use_cache=False)
+    assert set(fn.SAMPLES_LOADED_COLUMNS) <= set(samples_loaded.columns)
+    assert set(fn.PROJECT_COLUMNS) <= set(project.columns)
+    assert project['project_id'].nunique() == 3
+    # 8 patients x 3 time points x 2 runs per project
+    assert len(fn.filter_project(project)) == 48
+    assert families_table.shape[1] == 3 and families_table.iloc[-1, 1] == "Other"
+    species_abundance = pd.read_csv(os.path.join(tmp_path, "species_abundance.txt"), sep='\t')
+    assert (species_abundance['taxon_rank_level'] == "species").sum() == 3 * 48 * 10
+
+def test_per_project_data_grows_with_the_scale(tmp_path):
+    rows = []
+    for scale in [1, 3]:
+        sys_argv = bench.generate_synthetic_inputs(str(tmp_path / f"scale_{scale}"), **bench.scale_settings(scale))
+        samples_loaded, superkingdom, project, families_table = fn.get_metadata(sys_argv, use_cache=False)
+        runs = fn.filter_project(project)
+        species_abundance = pd.read_csv(os.path.join(sys_argv[1], "species_abundance.txt"), sep='\t')
+        project_rows = species_abundance['loaded_uid'].isin(runs['loaded_uid']) & (species_abundance['taxon_rank_level'] == "species")
+        rows.append((runs['sample_name'].nunique(), len(runs), species_abundance.loc[project_rows, 'ncbi_taxon_id'].nunique(), project_rows.sum()))
+    # Samples, runs, species and abundance rows of PRJEB8094 all grow
+    assert all(larger > smaller for smaller, larger in zip(*rows))
+
+def test_pipeline_runs_on_synthetic_inputs(tmp_path):
+    sys_argv = bench.generate_synthetic_inputs(str(tmp_path / "input"), n_patients=8, n_species=40, species_per_run=20)
+    main_script.main([sys_argv[1], str(tmp_path / "output"), "--stats-only", "--no-cache"])
+    results = pd.read_csv(tmp_path / "output" / "timepoint_tests_exposed.csv")
+    assert set(results['timepoint_1']) == {0, 7}
+
+def test_benchmark_measures_every_stage(tmp_path):
+    sys_argv = bench.generate_synthetic_inputs(str(tmp_path), n_patients=8, n_species=40, species_per_run=10)
+    results = bench.benchmark_stages(sys_argv)
+    assert 'aggregate_family_abundance' in results and 'compare_timepoints' in results
+    assert all(measurement['seconds'] >= 0 and measurement['peak_bytes'] >= 0 for measurement in results.values())
+
+def test_regressions_beyond_tolerance_fail():
+    baseline = {'stage': {'seconds': 1.0, 'peak_bytes': 100 * 1024 ** 2}}
+    assert bench.compare_to_baseline({'stage': {'seconds': 1.2, 'peak_bytes': 100 * 1024 ** 2}}, baseline, 0.3) == []
+    assert len(bench.compare_to_baseline({'stage': {'seconds': 1.5, 'peak_bytes': 200 * 1024 ** 2}}, baseline, 0.3)) == 2
+    # Tiny absolute differences are noise
+    assert bench.compare_to_baseline({'stage': {'seconds': 0.02, 'peak_bytes': 0}}, {'stage': {'seconds': 0.01, 'peak_bytes': 0}}) == []
+    # Stages without a baseline are not compared
+    assert bench.compare_to_baseline({'new_stage': {'seconds': 5.0, 'peak_bytes': 0}}, baseline) == []
@@ -0,0 +1,68 @@
+from test_functions_analyze_cefprozil_effect import write_small_inputs
+import csr_store as csr
+import numpy as np
+import pandas as pd
+import os
+
+def test_read_matches_text_rows(tmp_path):
+    write_small_inputs(tmp_path)
+    path = str(tmp_path / "species_abundance.txt")
+    store = csr.open_store(path)
+    species_abundance = pd.read_csv(path, sep='\t')
+    result = store.read([2, 1, 7], rank='species')
+    expected = species_abundance[species_abundance['taxon_rank_level'] == 'species']
+    expected = pd.concat([expected[expected['loaded_uid'] == uid] for uid in [2, 1]])[store.columns].reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected)
+    assert list(store.read([3], ['loaded_uid', 'relative_abundance']).columns) == ['loaded_uid', 'relative_abundance']
+
+def test_row_is_a_view_of_the_mapped_arrays(tmp_path):
+    write_small_inputs(tmp_path)
+    store = csr.open_store(str(tmp_path / "species_abundance.txt"))
+    taxa, values, ranks = store.row(1)
+    assert list(taxa) == [10, 11, 20] and list(values) == [40.0, 60.0, 40.0]
+    assert isinstance(taxa.base, np.memmap) or isinstance(taxa, np.memmap)
+    assert len(store.row(99)[0]) == 0
+
+def test_appended_rows_become_a_new_segment(tmp_path):
+    write_small_inputs(tmp_path)
+    path = tmp_path / "species_abundance.txt"
+    store = csr.open_store(str(path))
+    segment_0 = os.path.join(store.directory, "segment_0", "values.bin")
+    built = os.stat(segment_0).st_mtime_ns
+    with open(path, 'a') as source:
+        source.write("9\t1\t12\t5.0\tspecies\n10\t5\t10\t100.0\tstrain\n")
+    store = csr.open_store(str(path))
+    assert [segment['name'] for segment in store.manifest['segments']] == ["segment_0", "segment_1"]
+    assert os.stat(segment_0).st_mtime_ns == built
+    # Rows of uid 1 from both segments, in file order
+    assert list(store.read([1], rank='species')['ncbi_taxon_id']) == [10, 11, 12]
+    assert list(store.read([5])['taxon_rank_level']) == ["strain"]
+    # Unchanged source: the store is opened as is
+    assert len(csr.open_store(str(path)).manifest['segments']) == 2
+
+def test_append_dataframe_and_rebuild_on_edit(tmp_path):
+    write_small_inputs(tmp_path)
+    path = tmp_path / "species_abundance.txt"
+    store = csr.open_store(str(path))
+    store.append(pd.DataFrame({'loaded_uid': [6, 6], 'ncbi_taxon_id': [10, 11], 'relative_abundance': [1.0, 2.0], 'taxon_rank_level': ["species", "species"]}))
+    assert list(store.read([6])['relative_abundance']) == [1.0, 2.0]
+    assert store.nnz == 11
+    # An edited (not appended) source is rebuilt
+    species_abundance = pd.read_csv(path, sep='\t')
+    species_abundance.loc[0, 'relative_abundance'] = 45.0
+    species_abundance.to_csv(path, sep='\t', index=False)
+    store = csr.open_store(str(path))
+    assert len(store.manifest['segments']) == 1
+    assert store.read([1])['relative_abundance'].iloc[0] == 45.0
+
+def test_build_in_chunks(tmp_path):
+    write_small_inputs(tmp_path)
+    path = str(tmp_path / "species_abundance.txt")
+    whole = csr.open_store(path)
+    # 9 rows in segments of 2: the rows of a sample spread over segments are read back in file order
+    store = csr.open_store(path, str(tmp_path / "chunked.csr"), chunksize=2)
+    assert [segment['nnz'] for segment in store.manifest['segments']] == [2, 2, 2, 2, 1]
+    uids = list(whole.uids)
+    pd.testing.assert_frame_equal(store.read(uids), whole.read(uids))
+    pd.testing.assert_frame_equal(store.read(uids, rank='species'), whole.read(uids, rank='species'))
+    assert [list(part) for part in store.row(1)] == [list(part) for part in whole.row(1)]
@@ -0,0 +1,111 @@
+from test_functions_analyze_cefprozil_effect import write_small_inputs
+import functions_analyze_cefprozil_effect as fn
+import analyze_cefprozil_effect as main_script
+import diversity as dv
+from scipy import sparse
+from scipy.spatial.distance import pdist, squareform
+import pandas as pd
+import numpy as np
+import pytest
+
+def random_matrix(n_samples=23, n_species=40, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.random((n_samples, n_species)) * (rng.random((n_samples, n_species)) < 0.3)
+    values[4] = 0
+    return dv.SpeciesMatrix(sparse.csr_matrix(values), np.array([f"S{i}" for i in range(n_samples)], dtype=object),
+                            np.array([f"species {j}" for j in range(n_species)], dtype=object)), values
+
+def test_species_matrix_averages_runs():
+    species_abundance_w_sample_name = pd.DataFrame({
+        'loaded_uid': [1, 1, 2, 2, 3],
+        'scientific_name': ["A", "Other", "A", "B", "B"],
+        'relative_abundance': [40.0, 60.0, 20.0, 80.0, 100.0],
+        'sample_name': ["P1E0", "P1E0", "P1E0", "P1E0", "P6C0"]})
+    selected_project_w_accession = pd.DataFrame({'sample_name': ["P1E0", "P1E0", "P6C0"], 'loaded_uid': [1, 2, 3]})
+    matrix = dv.SpeciesMatrix.from_species_abundance(species_abundance_w_sample_name, selected_project_w_accession, "PRJ")
+    assert matrix.samples.tolist() == ["P1E0", "P6C0"]
+    assert matrix.species.tolist() == ["A", "B"]
+    assert matrix.values.toarray().tolist() == [[30.0, 40.0], [0.0, 100.0]]
+    assert matrix.project.tolist() == ["PRJ", "PRJ"]
+
+def test_alpha_diversity():
+    matrix, values = random_matrix()
+    alpha = dv.alpha_diversity(matrix)
+    totals = values.sum(axis=1)
+    for i in [0, 7]:
+        p = values[i][values[i] > 0] / totals[i]
+        assert alpha['richness'][i] == len(p)
+        assert alpha['shannon'][i] == pytest.approx(-(p * np.log(p)).sum())
+        assert alpha['simpson'][i] == pytest.approx(1 - (p * p).sum())
+    # Sample without any species
+    assert alpha['richness'][4] == 0
+    assert np.isnan(alpha['shannon'][4]) and np.isnan(alpha['simpson'][4])
+
+@pytest.mark.parametrize("metric", dv.BETA_METRICS)
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_beta_diversity_matches_pdist(tmp_path, metric, n_jobs):
+    matrix, values = random_matrix()
+    totals = values.sum(axis=1, keepdims=True)
+    expected = pdist(values / np.where(totals > 0, totals, 1), 'braycurtis') if metric == 'braycurtis' else pdist(values > 0, 'jaccard')
+    # Blocks smaller than the number of samples, in memory and memory mapped
+    for path in [None, str(tmp_path / f"{metric}.npy")]:
+        distances = dv.beta_diversity(matrix, metric, path, block_size=5, n_jobs=n_jobs)
+        np.testing.assert_allclose(np.asarray(distances), expected)
+    np.testing.assert_allclose(np.load(tmp_path / f"{metric}.npy", mmap_mode='r'), expected)
+
+def test_beta_diversity_unknown_metric():
+    with pytest.raises(ValueError):
+        dv.beta_diversity(random_matrix()[0], 'euclidean')
+
+def test_group_distances():
+    matrix, values = random_matrix()
+    distances = dv.beta_diversity(matrix, 'jaccard')
+    groups = np.array(["a", "b", None] * 7 + ["a", "b"], dtype=object)
+    result = dv.group_distances(distances, groups, rows_per_chunk=4)
+    square = squareform(distances)
+    a, b = np.flatnonzero(groups == "a"), np.flatnonzero(groups == "b")
+    between = result[(result['group_1'] == "a") & (result['group_2'] == "b")].iloc[0]
+    assert between['n_pairs'] == len(a) * len(b)
+    assert between['mean_distance'] == pytest.approx(square[np.ix_(a, b)].mean())
+    within = result[(result['group_1'] == "a") & (result['group_2'] == "a")].iloc[0]
+    assert within['n_pairs'] == len(a) * (len(a) - 1) // 2
+    assert within['mean_distance'] == pytest.approx(square[np.ix_(a, a)][np.triu_indices(len(a), 1)].mean())
+
+def test_species_diversity_of_small_inputs(tmp_path):
+    sys_argv = write_small_inputs(tmp_path)
+    samples_loaded, superkingdom, species_abundance, project, families_table = fn.get_raw_data(sys_argv)
+    selected_project_w_accession = fn.add_accession_id(samples_loaded, fn.filter_project(project))
+    filtered_species_abundance = fn.filter_species_abundance(selected_project_w_accession, fn.add_kingdom(species_abundance, superkingdom))
+    matrix, metadata, alpha, alpha_tests = main_script.species_diversity(
+        filtered_species_abundance, selected_project_w_accession, sys_argv, fn.project_settings())
+    assert matrix.samples.tolist() == ["P1E0", "P1E7", "P6C0"]
+    assert metadata[['patient', 'timepoint', 'Category']].values.tolist() == [["P1", "0", "Exposed"], ["P1", "7", "Exposed"], ["P6", "0", "Control"]]
+    assert alpha['richness'].tolist() == [2, 2, 1]
+    distances = dv.beta_diversity(matrix, 'braycurtis')
+    # P1E0 (40% S. sonnei, 60% V. parvula) and P1E7 (30% S. sonnei, 70% V. dispar) share 30%
+    assert distances[0] == pytest.approx(0.7)
+    to_baseline = dv.distance_to_baseline(distances, metadata)
+    assert to_baseline['sample_name'].tolist() == ["P1E7"]
+    assert to_baseline['distance'].tolist() == [pytest.approx(distances[0])]
+
+def test_beta_diversity_stage_is_cached(tmp_path):
+    import os
+    from stage_cache import StageCache
+    sys_argv = write_small_inputs(tmp_path / "input")
+    output_dir = tmp_path / "output"
+    def run(outputs='no-plots'):
+        cache = StageCache(str(tmp_path / "cache"))
+        main_script.run_batch([sys_argv[0], sys_argv[1], str(output_dir)], [dict(fn.project_settings({'diversity': True}), output_dir='')], cache, outputs)
+        return cache
+    assert 'PRJEB8094/beta_diversity' in run().misses
+    distances = np.load(output_dir / "beta_braycurtis.npy")
+    assert 'PRJEB8094/beta_diversity' in run().hits
+    # A removed distance file is written again
+    os.remove(output_dir / "beta_braycurtis.npy")
+    assert 'PRJEB8094/beta_diversity' in run().misses
+    np.testing.assert_array_equal(np.load(output_dir / "beta_braycurtis.npy"), distances)
+    # Statistics only: the distances go to a temporary file that is removed
+    stats_dir = tmp_path / "output" / "stats"
+    output_dir = stats_dir
+    run('stats-only')
+    assert sorted(os.listdir(stats_dir)) == ["alpha_diversity_tests.csv", "beta_diversity_groups.csv", "timepoint_tests_exposed.csv"]
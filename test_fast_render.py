@@ -0,0 +1,39 @@
+from abundance_matrix import AbundanceMatrix
+import fast_render
+import pandas as pd
+
+def long_table():
+    rows = []
+    for patient, category in [("P1", "Exposed"), ("P2", "Exposed"), ("P6", "Control")]:
+        for timepoint in ['0', '7', '90']:
+            sample = f"{patient}{category[0]}{timepoint}"
+            for k, family in enumerate(["Bacteroidaceae", "Lachnospiraceae", "Veillonellaceae"]):
+                rows.append({'family': family, 'sample_name': sample, 'relative_abundance': float(10 * k + len(rows) % 7),
+                             'patient': patient, 'timepoint': timepoint, 'Category': category})
+    return pd.DataFrame(rows)
+
+def test_stack_offsets():
+    data = pd.DataFrame({'family': ["B", "A", "B", "C"], 'sample_name': ["S2", "S2", "S1", "S1"], 'relative_abundance': [2.0, 3.0, 4.0, 1.0]})
+    heights, bottoms, families, samples = fast_render.stack_matrix(data, ["S1", "S2", "S3"])
+    assert families == ["A", "B", "C"] and samples == ["S1", "S2"]
+    assert heights.tolist() == [[0.0, 3.0], [4.0, 2.0], [1.0, 0.0]]
+    # The first family is on top: its bottom is the sum of the families after it
+    assert bottoms.tolist() == [[5.0, 2.0], [1.0, 0.0], [0.0, 0.0]]
+
+def test_plots_in_several_formats(tmp_path):
+    sys_argv = ["analyze_cefprozil_effect.py", "", str(tmp_path)]
+    data = long_table()
+    paths = fast_render.relative_abundance_plot(data[['family', 'sample_name', 'relative_abundance']], sys_argv, list(pd.unique(data['sample_name'])), ["P2E0"], formats=['png', 'svg'], dpi=50)
+    assert [path.rsplit('.', 1)[1] for path in paths] == ['png', 'svg']
+    matrix = AbundanceMatrix.from_long(data)
+    paths = fast_render.plot_combined_families(matrix, "Lachnospiraceae", sys_argv, formats=['pdf'])
+    assert paths == [str(tmp_path / "combined_family_Lachnospiraceae_plot.pdf")]
+    assert all((tmp_path / name).stat().st_size > 0 for name in ["relative_abundance_plot.png", "relative_abundance_plot.svg", "combined_family_Lachnospiraceae_plot.pdf"])
+
+def test_family_facets_split_in_pages(tmp_path):
+    sys_argv = ["analyze_cefprozil_effect.py", "", str(tmp_path)]
+    matrix = AbundanceMatrix.from_long(long_table()).subset("Exposed")
+    fast_render.plot_families_aboundance(matrix, "exposed", sys_argv, facets_per_page=2, dpi=30)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["families_exposed_plot_page1.png", "families_exposed_plot_page2.png"]
+    fast_render.plot_families_aboundance(matrix, "single", sys_argv, dpi=30)
+    assert (tmp_path / "families_single_plot.png").exists()
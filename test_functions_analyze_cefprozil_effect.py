@@ -94,4 +94,74 @@ def test_data_types():
     assert species_abundance_family['family'].dtype == object, "Family column is not of type object"
 
 
+def write_small_inputs(path):
+    os.makedirs(path, exist_ok=True)
+    # Small input tables with the columns used by the pipeline
+    pd.DataFrame({'uid': [1, 2, 3, 4], 'accession_id': ["R1", "R2", "R3", "R4"]}).to_csv(path / "samples_loaded.txt", sep='\t', index=False)
+    pd.DataFrame({'project_id': ["PRJEB8094", "PRJEB8094", "PRJEB8094", "OTHER_PROJECT"],
+                  'sample_name': ["P1E0", "P1E7", "P6C0", "X1"],
+                  'run_id': ["R1", "R2", "R3", "R4"],
+                  'loaded_uid': [1, 2, 3, 4]}).to_csv(path / "sample_to_run_info.txt", sep='\t', index=False)
+    pd.DataFrame({'ncbi_taxon_id': [10, 11, 12, 20],
+                  'scientific_name': ["Shigella sonnei", "Veillonella parvula", "Veillonella dispar", "Shigella"],
+                  'superkingdom': ["Bacteria"] * 4}).to_csv(path / "superkingdom2descendents.txt", sep='\t', index=False)
+    pd.DataFrame({'uid': range(9),
+                  'loaded_uid': [1, 1, 1, 2, 2, 3, 4, 4, 2],
+                  'ncbi_taxon_id': [10, 11, 20, 10, 12, 11, 10, 11, 20],
+                  'relative_abundance': [40.0, 60.0, 40.0, 30.0, 70.0, 100.0, 50.0, 50.0, 30.0],
+                  'taxon_rank_level': ["species", "species", "genus", "species", "species", "species", "species", "species", "genus"]
+                  }).to_csv(path / "species_abundance.txt", sep='\t', index=False)
+    pd.read_csv(os.path.join(input_files_dir, "families.csv")).to_csv(path / "families.csv", index=False)
+    pd.read_csv(os.path.join(input_files_dir, "patient_info.csv")).to_csv(path / "patient_info.csv", index=False)
+    return ["analyze_cefprozil_effect.py", str(path)]
 
+def test_stream_species_abundance(tmp_path):
+    # Streaming in small chunks gives the same table as the full-table chain
+    sys_argv = write_small_inputs(tmp_path)
+    samples_loaded, superkingdom, species_abundance, project, families_table = fn.get_raw_data(sys_argv)
+    selected_project_w_accession = fn.add_accession_id(samples_loaded, fn.filter_project(project))
+    species_abundance_kingdom = fn.add_kingdom(species_abundance, superkingdom)
+    expected = fn.filter_species_abundance(selected_project_w_accession, species_abundance_kingdom)
+    result = fn.stream_species_abundance(sys_argv, selected_project_w_accession, superkingdom, chunksize=2, use_cache=False)
+    pd.testing.assert_frame_equal(result, expected)
+    result = fn.stream_species_abundance(sys_argv, selected_project_w_accession, superkingdom, chunksize=2)
+    pd.testing.assert_frame_equal(result, expected)
+
+def test_cached_metadata_matches_text(tmp_path):
+    sys_argv = write_small_inputs(tmp_path)
+    for cached, parsed in zip(fn.get_metadata(sys_argv), fn.get_metadata(sys_argv, use_cache=False)):
+        pd.testing.assert_frame_equal(cached, parsed)
+    assert os.path.exists(tmp_path / ".table_cache" / "sample_to_run_info.txt" / "manifest.json")
+
+def test_split_species_abundance_matches_single_project_runs(tmp_path):
+    sys_argv = write_small_inputs(tmp_path)
+    samples_loaded, superkingdom, project, families_table = fn.get_metadata(sys_argv)
+    selected_projects = [fn.add_accession_id(samples_loaded, fn.filter_project(project, project_id), [])
+                         for project_id in ["PRJEB8094", "OTHER_PROJECT"]]
+    all_uids = pd.concat([selected['loaded_uid'] for selected in selected_projects])
+    species_abundance_kingdom = fn.load_species_abundance_kingdom(sys_argv, all_uids, superkingdom)
+    for selected, result in zip(selected_projects, fn.split_species_abundance(selected_projects, species_abundance_kingdom)):
+        expected = fn.stream_species_abundance(sys_argv, selected, superkingdom)
+        pd.testing.assert_frame_equal(result, expected)
+
+def test_load_batch_config(tmp_path):
+    config_path = tmp_path / "projects.json"
+    config_path.write_text('{"projects": ["PRJEB8094", {"project_id": "OTHER", "patient_info": "other.csv"}, {"project_id": "THIRD", "excluded_uids": [7]}]}')
+    default, other, third = fn.load_batch_config(config_path)
+    assert default['excluded_uids'] == [25687, 2615, 4124]
+    assert default['output_dir'] == "PRJEB8094"
+    # The exclusions of PRJEB8094 are not inherited by other projects
+    assert other['excluded_uids'] == []
+    assert third['excluded_uids'] == [7]
+    assert other['patient_info'] == os.path.join(str(tmp_path), "other.csv")
+
+def test_aggregate_family_abundance_matches_string_groupby(tmp_path):
+    sys_argv = write_small_inputs(tmp_path)
+    samples_loaded, superkingdom, project, families_table = fn.get_metadata(sys_argv)
+    selected_project_w_accession = fn.add_accession_id(samples_loaded, fn.filter_project(project))
+    filtered_species_abundance = fn.stream_species_abundance(sys_argv, selected_project_w_accession, superkingdom)
+    species_abundance_w_sample_name = fn.match_sample_name(selected_project_w_accession, filtered_species_abundance)
+    result = fn.aggregate_family_abundance(species_abundance_w_sample_name, families_table, selected_project_w_accession)
+    species_abundance_family = fn.add_family(species_abundance_w_sample_name, families_table.copy())
+    expected = fn.cal_relative_abundance(species_abundance_family, selected_project_w_accession)
+    pd.testing.assert_frame_equal(result, expected)
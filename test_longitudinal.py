@@ -0,0 +1,34 @@
+from longitudinal import PatientTensor
+from test_stats_engine import random_matrix
+import numpy as np
+
+def test_tensor_aligns_samples_by_patient():
+    matrix = random_matrix()
+    tensor = PatientTensor.from_matrix(matrix)
+    assert tensor.shape == (8, 3, 5)
+    assert tensor.patients.tolist() == [f"P{i}" for i in range(8)]
+    assert tensor.timepoints == ["0", "7", "90"]
+    for sample in ["P3E7", "P5E90"]:
+        row = matrix.sample_index[sample]
+        cell = tensor.values[tensor.patients.tolist().index(matrix.patient[row]), tensor.timepoint_index[matrix.timepoint[row]]]
+        np.testing.assert_array_equal(cell, matrix.values[row])
+    assert (tensor.present == ~np.isnan(tensor.values)).all()
+
+def test_missing_samples_are_masked():
+    matrix = random_matrix()
+    keep = matrix.samples != "P2E7"
+    matrix = type(matrix)(matrix.values[keep], matrix.samples[keep], matrix.families, matrix.patient[keep],
+                          matrix.timepoint[keep], matrix.category[keep])
+    tensor = PatientTensor.from_matrix(matrix)
+    assert not tensor.present[2, 1].any()
+
+def test_deltas_from_baseline():
+    tensor = PatientTensor.from_matrix(random_matrix())
+    delta, others = tensor.deltas()
+    assert others == ["7", "90"]
+    np.testing.assert_array_equal(delta[:, 1], tensor.values[:, 2] - tensor.values[:, 0])
+    table = tensor.deltas_table()
+    assert len(table) == (~np.isnan(delta)).sum()
+    row = table.iloc[0]
+    assert row['delta'] == row['value'] - row['baseline_value']
+    assert row['baseline'] == "0" and row['Category'] == "Exposed"
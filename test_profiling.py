@@ -0,0 +1,48 @@
+from stage_cache import StageCache
+import profiling
+import pandas as pd
+import time
+
+def make_table(n):
+    return pd.DataFrame({'value': range(n)})
+
+def test_measure_records_rows_and_times():
+    profiler = profiling.Profiler()
+    table = profiler.measure('make', make_table, (10,))
+    assert len(table) == 10
+    (record,) = profiler.records
+    assert record['stage'] == 'make' and record['rows_in'] == 0 and record['rows_out'] == 10
+    assert record['wall_s'] >= 0 and record['cpu_s'] >= 0 and record['memory_out_mb'] > 0
+    assert profiler.measure('head', lambda df: df.head(3), (table,)) is not None
+    assert profiler.records[-1]['rows_in'] == 10 and profiler.records[-1]['rows_out'] == 3
+
+def test_measure_without_profiler_calls_the_function():
+    assert profiling.measure(None, 'make', make_table, (4,)).shape == (4, 1)
+
+def test_measure_without_resource_module(monkeypatch):
+    # No resource module (Windows): the RSS is left empty, the rest is still measured
+    import sys
+    monkeypatch.setitem(sys.modules, 'resource', None)
+    assert profiling.peak_rss_bytes() is None
+    profiler = profiling.Profiler()
+    profiler.measure('make', make_table, (3,))
+    assert profiler.records[0]['peak_rss_delta_mb'] is None and profiler.records[0]['rows_out'] == 3
+
+def test_trace_summary_and_slowest_stage(tmp_path):
+    profiler = profiling.Profiler(cprofile=True)
+    profiler.measure('fast', make_table, (2,))
+    profiler.measure('slow', time.sleep, (0.05,))
+    events = profiler.chrome_trace()['traceEvents']
+    assert [event['name'] for event in events] == ['fast', 'slow']
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+    assert list(profiler.summary()['stage']) == ['slow', 'fast']
+    profiler.write(str(tmp_path / "trace.json"), str(tmp_path / "summary.txt"), str(tmp_path / "slowest.prof"))
+    assert "cProfile of the slowest stage: slow" in (tmp_path / "summary.txt").read_text()
+    assert (tmp_path / "slowest.prof").exists()
+
+def test_stage_cache_stages_are_measured(tmp_path):
+    for expected_cached in [False, True]:
+        profiler = profiling.Profiler()
+        cache = StageCache(str(tmp_path / "cache"), profiler=profiler)
+        assert len(cache.run('make', make_table, (5,))) == 5
+        assert [record['cached'] for record in profiler.records] == [expected_cached]
@@ -0,0 +1,52 @@
+import render
+from render import PlotJob
+import os
+
+def leaky_plot(path):
+    # Changes global state the way the plot functions do (rcParams update, no cleanup)
+    import matplotlib.pyplot as plt
+    plt.rcParams.update({'font.size': 30, 'lines.linewidth': 5})
+    plt.plot([0, 1], [1, 0])
+    plt.title("leaky")
+    plt.savefig(path)
+    return path
+
+def plain_plot(path):
+    import matplotlib.pyplot as plt
+    figure, ax = plt.subplots()
+    ax.plot([0, 1], [0, 1])
+    ax.set_title("plain")
+    figure.savefig(path)
+    return path
+
+def read_bytes(path):
+    with open(path, 'rb') as image:
+        return image.read()
+
+def test_state_does_not_leak_between_jobs(tmp_path):
+    alone = render.render_jobs([PlotJob(plain_plot, (str(tmp_path / "alone.png"),))], n_jobs=1)
+    after_leak = render.render_jobs([PlotJob(leaky_plot, (str(tmp_path / "leaky.png"),)),
+                                     PlotJob(plain_plot, (str(tmp_path / "after.png"),))], n_jobs=1)
+    assert alone == [str(tmp_path / "alone.png")]
+    assert after_leak[1] == str(tmp_path / "after.png")
+    assert read_bytes(tmp_path / "alone.png") == read_bytes(tmp_path / "after.png")
+
+def test_parallel_output_matches_serial(tmp_path):
+    os.makedirs(tmp_path / "serial")
+    os.makedirs(tmp_path / "parallel")
+    for folder, n_jobs in [("serial", 1), ("parallel", 2)]:
+        render.render_jobs([PlotJob(leaky_plot, (str(tmp_path / folder / "leaky.png"),)),
+                            PlotJob(plain_plot, (str(tmp_path / folder / "plain.png"),))], n_jobs=n_jobs)
+    for name in ["leaky.png", "plain.png"]:
+        assert read_bytes(tmp_path / "serial" / name) == read_bytes(tmp_path / "parallel" / name)
+
+def test_serial_rendering_keeps_the_backend(tmp_path):
+    import matplotlib
+    backend = matplotlib.get_backend()
+    matplotlib.use('pdf', force=True)
+    try:
+        render.render_jobs([PlotJob(plain_plot, (str(tmp_path / "plain.png"),))])
+        assert matplotlib.get_backend() == 'pdf'
+    finally:
+        matplotlib.use(backend, force=True)
+    assert read_bytes(tmp_path / "plain.png")[:4] == b'\x89PNG'
@@ -0,0 +1,51 @@
+from abundance_matrix import AbundanceMatrix
+import resampling as rs
+import pandas as pd
+import numpy as np
+
+def shifted_matrix(seed=0, n_patients=10, n_families=6, shifts=(5.0, 5.0)):
+    # Families F0, F1, ... increase at day 7 by 'shifts', the others do not change
+    rng = np.random.default_rng(seed)
+    rows = []
+    for patient in range(n_patients):
+        for timepoint in ["0", "7"]:
+            for family in range(n_families):
+                shift = shifts[family] if family < len(shifts) and timepoint == "7" else 0.0
+                rows.append({'family': f"F{family}", 'sample_name': f"P{patient}E{timepoint}",
+                             'relative_abundance': rng.normal(10.0 + shift, 1.0),
+                             'patient': f"P{patient}", 'timepoint': timepoint, 'Category': "Exposed"})
+    return AbundanceMatrix.from_long(pd.DataFrame(rows))
+
+def test_permutation_detects_shifted_families():
+    results = rs.resample_timepoints(shifted_matrix(), n_permutations=2000, n_bootstrap=500, seed=1)
+    assert list(results.columns) == rs.RESULT_COLUMNS
+    significant = results[results['label'].notna()]['family'].tolist()
+    assert significant[:2] == ["F0", "F1"]
+    shifted = results[results['family'].isin(["F0", "F1"])]
+    assert (shifted['ci_high'] < 0).all()
+
+def test_results_do_not_depend_on_workers():
+    matrix = shifted_matrix(seed=2)
+    serial = rs.resample_timepoints(matrix, n_permutations=2000, n_bootstrap=500, seed=5)
+    parallel = rs.resample_timepoints(matrix, n_permutations=2000, n_bootstrap=500, seed=5, n_jobs=2)
+    pd.testing.assert_frame_equal(serial, parallel)
+
+def test_early_stop_uses_fewer_permutations():
+    matrix = shifted_matrix(seed=3)
+    early = rs.resample_timepoints(matrix, n_permutations=20000, n_bootstrap=100, batch_size=250)
+    full = rs.resample_timepoints(matrix, n_permutations=20000, n_bootstrap=100, batch_size=250, early_stop=False)
+    assert (early['n_resamples'] < full['n_resamples']).any()
+    assert (full['n_resamples'] == 20000).all()
+    assert (early['label'].notna() == full['label'].notna()).all()
+
+def test_early_stop_keeps_the_labels():
+    # Shifts giving each label: early stopping only stops a family once its label is known
+    matrix = shifted_matrix(seed=0, n_families=7, shifts=(3.0, 1.6, 1.3, 1.0, 0.7))
+    early = rs.resample_timepoints(matrix, n_permutations=20000, n_bootstrap=100, batch_size=250)
+    full = rs.resample_timepoints(matrix, n_permutations=20000, n_bootstrap=100, batch_size=250, early_stop=False)
+    assert set(full['label'].dropna()) == {'***', '**', '*'}
+    assert early['label'].fillna('').tolist() == full['label'].fillna('').tolist()
+    assert (early['n_resamples'] < full['n_resamples']).any()
+    # Corrected p-values use every permutation
+    corrected = rs.resample_timepoints(matrix, n_permutations=2000, n_bootstrap=100, batch_size=250, correction='bonferroni')
+    assert (corrected['n_resamples'] == 2000).all()
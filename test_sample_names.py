@@ -0,0 +1,33 @@
+import sample_names as sn
+import pandas as pd
+import numpy as np
+
+COHORT_ORDER = ["P1E0", "P2E0", "P10E0", "P1E7", "P2E7", "P10E7", "P6C0", "P23C0", "P6C7", "P23C7"]
+
+def test_parse_sample_names():
+    parsed = sn.parse_sample_names(pd.Series(["P12E7", "P6C90", "P12E7", None], index=[5, 6, 7, 8]))
+    assert parsed.index.tolist() == [5, 6, 7, 8]
+    assert parsed['patient'].tolist()[:3] == ["P12", "P6", "P12"]
+    assert parsed['arm'].tolist()[:3] == ["E", "C", "E"]
+    assert parsed['timepoint'].tolist()[:3] == ["7", "90", "7"]
+    assert parsed['patient_number'].tolist() == [12, 6, 12, -1]
+    assert parsed['arm_code'].tolist() == [0, 1, 0, 2]
+    assert parsed.loc[8, ['patient', 'timepoint']].isna().all()
+
+def test_names_outside_the_pattern_split_like_the_replacements():
+    # The replacements this parser took over from: patient before the first E or C, time point after the last one
+    names = pd.Series(["X1", "PE1E2", "CE"])
+    parsed = sn.parse_sample_names(names)
+    assert parsed['patient'].tolist() == ["X1", "P", ""]
+    assert parsed['timepoint'].tolist() == ["X1", "2", ""]
+
+def test_sample_order_from_the_names():
+    shuffled = list(np.random.default_rng(0).permutation(COHORT_ORDER)) + ["P1E0"]
+    order, separators = sn.sample_order(shuffled)
+    assert order == COHORT_ORDER
+    # A line after the last exposed sample of each time point
+    assert separators == ["P10E0", "P10E7"]
+
+def test_timepoint_and_patient_order():
+    assert sn.timepoint_order(["90", "7", "0", "7", "end"]) == ["0", "7", "90", "end"]
+    assert sn.patient_order(["P11", "P2", "P10", None, "P2"]) == ["P2", "P10", "P11"]
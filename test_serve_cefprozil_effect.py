@@ -0,0 +1,132 @@
+from test_functions_analyze_cefprozil_effect import write_small_inputs
+from concurrent.futures import ThreadPoolExecutor
+import serve_cefprozil_effect as service
+import urllib.request
+import urllib.error
+import threading
+import pandas as pd
+import json
+import io
+import pytest
+
+@pytest.fixture
+def server(tmp_path):
+    sys_argv = write_small_inputs(tmp_path)
+    server = service.make_server(sys_argv[1], port=0, threads=4)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def request(server, path, method='GET'):
+    # (status, content type, body) from the local server
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method=method)) as response:
+            return response.status, response.headers['Content-Type'], response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers['Content-Type'], error.read()
+
+def test_relative_abundance(server):
+    status, content_type, body = request(server, "/relative_abundance?samples=P1E0,P6C0&format=csv")
+    assert status == 200 and content_type == "text/csv"
+    table = pd.read_csv(io.BytesIO(body))
+    expected = server.service.dataset.get().species_relative_abundance
+    assert len(table) == expected['sample_name'].isin(["P1E0", "P6C0"]).sum()
+    assert set(table['sample_name']) == {"P1E0", "P6C0"}
+
+def test_significance_is_cached(server):
+    status, _, body = request(server, "/significance?category=all&timepoints=0,7")
+    assert status == 200
+    results = json.loads(body)
+    assert {(row['timepoint_1'], row['timepoint_2']) for row in results} == {("0", "7")}
+    assert request(server, "/significance?category=all&timepoints=0,7")[2] == body
+    assert server.service.cache.hits == 1
+
+def test_plots(server):
+    status, content_type, body = request(server, "/plot?kind=relative_abundance&dpi=20")
+    assert status == 200 and content_type == "image/png" and body.startswith(b"\x89PNG")
+    status, content_type, body = request(server, "/plot?kind=families&category=Exposed&format=svg")
+    assert status == 200 and content_type == "image/svg+xml" and b"<svg" in body
+
+def test_bad_requests(server):
+    assert request(server, "/significance?families=Unknownaceae")[0] == 400
+    assert request(server, "/significance?project=PRJNOTHERE")[0] == 400
+    assert request(server, "/plot?kind=heatmap")[0] == 400
+    assert request(server, "/plot?dpi=high")[0] == 400
+    # Unknown categories and time points are rejected rather than answered with empty results
+    assert request(server, "/significance?category=Exposd")[0] == 400
+    assert request(server, "/significance?category=all&timepoints=0,30")[0] == 400
+    assert request(server, "/plot?kind=families&category=Placebo")[0] == 400
+    assert len(server.service.cache.entries) == 0
+    assert request(server, "/significance?test=permutation&correction=holm")[0] == 400
+    assert request(server, "/nothing")[0] == 404
+    assert request(server, "/nothing", method='POST')[0] == 404
+
+def test_internal_errors(server, monkeypatch):
+    # Failures that are not caused by the request are 500, and not cached
+    def broken(dataset, query):
+        raise KeyError("index")
+    monkeypatch.setitem(server.service.routes, '/significance', broken)
+    status, _, body = request(server, "/significance")
+    assert status == 500 and "KeyError" in json.loads(body)['error']
+    assert len(server.service.cache.entries) == 0
+    def broken_dataset(input_dir, projects):
+        raise OSError("input files not readable")
+    monkeypatch.setattr(service, 'Dataset', broken_dataset)
+    status, _, body = request(server, "/reload", method='POST')
+    assert status == 500 and "input files not readable" in json.loads(body)['error']
+    assert server.service.generation == 0
+
+def test_concurrent_requests(server):
+    paths = ["/significance?category=all", "/relative_abundance", "/health", "/projects"] * 5
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(lambda path: request(server, path), paths))
+    assert all(status == 200 for status, _, _ in responses)
+    assert len({body for (_, _, body), path in zip(responses, paths) if path == "/relative_abundance"}) == 1
+
+def test_reload_after_input_change(server):
+    before = json.loads(request(server, "/significance?category=Exposed")[2])
+    assert json.loads(request(server, "/health")[2])['changed_files'] == []
+    # P6 joins the exposed group
+    patient_info_path = f"{server.service.input_dir}/patient_info.csv"
+    patient_info = pd.read_csv(patient_info_path)
+    patient_info.loc[patient_info['patient'] == "P6", 'Category'] = "Exposed"
+    patient_info.to_csv(patient_info_path, index=False)
+    assert json.loads(request(server, "/health")[2])['changed_files'] == [patient_info_path]
+    # Answers come from the loaded data until the reload
+    assert json.loads(request(server, "/significance?category=Exposed")[2]) == before
+    status, _, body = request(server, "/reload", method='POST')
+    assert status == 200 and json.loads(body)['generation'] == 1
+    after = json.loads(request(server, "/significance?category=Exposed")[2])
+    # P6C0 has a single family
+    assert sum(row['n_1'] for row in after) == sum(row['n_1'] for row in before) + 1
+
+def test_project_loading_does_not_block_loaded_projects(server, monkeypatch):
+    dataset = server.service.dataset
+    add_projects, loading, release, loads = dataset._add_projects, threading.Event(), threading.Event(), []
+    def slow_add_projects(projects):
+        loads.append(projects[0]['project_id'])
+        loading.set()
+        release.wait(10)
+        add_projects(projects)
+    monkeypatch.setattr(dataset, '_add_projects', slow_add_projects)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        others = [executor.submit(dataset.get, "OTHER_PROJECT") for _ in range(2)]
+        assert loading.wait(10)
+        # The configured project is answered while OTHER_PROJECT is being loaded
+        assert request(server, "/relative_abundance?format=csv")[0] == 200
+        release.set()
+        assert others[0].result() is others[1].result()
+    assert loads == ["OTHER_PROJECT"]
+
+def test_request_settings(server):
+    # A request can turn off the project's correction; permutation tests stay in the request thread
+    project = server.service.dataset.get()
+    project.settings.update({'correction': 'bonferroni', 'n_jobs': 4})
+    settings = service._request_settings(project, {'correction': ["none"], 'test': ["permutation"]})
+    assert settings['correction'] is None and settings['test'] == "permutation" and settings['n_jobs'] == 1
+    assert service._request_settings(project, {})['correction'] == 'bonferroni'
+    results = json.loads(request(server, "/significance?category=all&correction=none")[2])
+    assert all(row['p_adjusted'] == row['p_value'] for row in results)
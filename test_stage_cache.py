@@ -0,0 +1,57 @@
+from stage_cache import StageCache
+import os
+
+def double(value):
+    return value * 2
+
+def add_file_length(value, path):
+    with open(path) as source:
+        return value + len(source.read())
+
+def run_pipeline(cache, path, value=1):
+    doubled = cache.run('double', double, (value,), params={'value': value})
+    return cache.run('add_file_length', add_file_length, (doubled, path), files=[path], depends_on=['double'])
+
+def test_second_run_reads_cached_results(tmp_path):
+    path = tmp_path / "input.txt"
+    path.write_text("abc")
+    assert run_pipeline(StageCache(str(tmp_path / "cache")), str(path)) == 5
+    cache = StageCache(str(tmp_path / "cache"))
+    assert run_pipeline(cache, str(path)) == 5
+    assert cache.hits == ['double', 'add_file_length']
+
+def test_only_stages_after_a_change_are_recomputed(tmp_path):
+    path = tmp_path / "input.txt"
+    path.write_text("abc")
+    run_pipeline(StageCache(str(tmp_path / "cache")), str(path))
+    path.write_text("abcdef")
+    cache = StageCache(str(tmp_path / "cache"))
+    assert run_pipeline(cache, str(path)) == 8
+    assert cache.hits == ['double'] and cache.misses == ['add_file_length']
+    # A changed parameter recomputes its stage and the ones depending on it
+    cache = StageCache(str(tmp_path / "cache"))
+    assert run_pipeline(cache, str(path), value=2) == 10
+    assert cache.misses == ['double', 'add_file_length']
+
+def test_force_and_invalidate(tmp_path):
+    path = tmp_path / "input.txt"
+    path.write_text("abc")
+    run_pipeline(StageCache(str(tmp_path / "cache")), str(path))
+    cache = StageCache(str(tmp_path / "cache"), invalidate=['double'])
+    run_pipeline(cache, str(path))
+    assert cache.misses == ['double', 'add_file_length']
+    cache = StageCache(str(tmp_path / "cache"), invalidate=['add_file_length'])
+    run_pipeline(cache, str(path))
+    assert cache.hits == ['double'] and cache.misses == ['add_file_length']
+    cache = StageCache(str(tmp_path / "cache"), force=True)
+    run_pipeline(cache, str(path))
+    assert cache.hits == []
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    cache = StageCache(str(tmp_path / "cache"), max_bytes=2000)
+    for value in range(5):
+        cache.run('big', lambda value: 'x' * 900 + str(value), (value,), params={'value': value})
+    results = [name for name in os.listdir(tmp_path / "cache") if name.endswith(".pkl")]
+    assert len(results) == 2
+    total = sum(os.path.getsize(tmp_path / "cache" / name) for name in results)
+    assert total <= 2000
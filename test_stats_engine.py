@@ -0,0 +1,58 @@
+from abundance_matrix import AbundanceMatrix
+import stats_engine as se
+from scipy.stats import ttest_ind, ttest_rel
+import pandas as pd
+import numpy as np
+import pytest
+
+def random_matrix(seed=0, n_patients=8, n_families=5):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for patient in range(n_patients):
+        for timepoint in ["0", "7", "90"]:
+            for family in range(n_families):
+                # Some families are missing from some samples
+                if rng.random() < 0.15:
+                    continue
+                rows.append({'family': f"F{family}", 'sample_name': f"P{patient}E{timepoint}",
+                             'relative_abundance': rng.gamma(2.0, 2.0 + family + int(timepoint) / 30),
+                             'patient': f"P{patient}", 'timepoint': timepoint, 'Category': "Exposed"})
+    return AbundanceMatrix.from_long(pd.DataFrame(rows))
+
+def column_values(matrix, family, timepoint):
+    values = matrix.column(family)[matrix.timepoint == timepoint].astype(float)
+    return values[~np.isnan(values)]
+
+@pytest.mark.parametrize("test", ["student", "welch"])
+def test_independent_tests_match_scipy(test):
+    matrix = random_matrix()
+    results = se.compare_timepoints(matrix, test=test)
+    assert len(results) == 5 * 3
+    for row in results.itertuples():
+        expected = ttest_ind(column_values(matrix, row.family, row.timepoint_1),
+                             column_values(matrix, row.family, row.timepoint_2), equal_var=(test == "student"))
+        assert row.statistic == pytest.approx(expected.statistic)
+        assert row.p_value == pytest.approx(expected.pvalue)
+
+def test_paired_test_matches_scipy():
+    matrix = random_matrix(seed=1)
+    results = se.compare_timepoints(matrix, test="paired")
+    for row in results.itertuples():
+        first = pd.Series(matrix.column(row.family)[matrix.timepoint == row.timepoint_1].astype(float), index=matrix.patient[matrix.timepoint == row.timepoint_1])
+        second = pd.Series(matrix.column(row.family)[matrix.timepoint == row.timepoint_2].astype(float), index=matrix.patient[matrix.timepoint == row.timepoint_2])
+        both = pd.concat([first, second], axis=1).dropna()
+        expected = ttest_rel(both[0], both[1])
+        assert row.p_value == pytest.approx(expected.pvalue)
+
+def test_adjust_p_values():
+    p_values = np.array([0.01, 0.04, np.nan, 0.03, 0.5])
+    assert np.allclose(se.adjust_p_values(p_values, 'bonferroni'), [0.04, 0.16, np.nan, 0.12, 1.0], equal_nan=True)
+    assert np.allclose(se.adjust_p_values(p_values, 'bh'), [0.04, 0.16 / 3, np.nan, 0.16 / 3, 0.5], equal_nan=True)
+    with pytest.raises(ValueError):
+        se.adjust_p_values(p_values, 'holm')
+
+def test_labels_use_adjusted_p_values():
+    matrix = random_matrix()
+    results = se.compare_timepoints(matrix, correction='bonferroni')
+    assert (results['p_adjusted'] >= results['p_value']).all()
+    assert (results['label'].notna() == (results['p_adjusted'] < 0.05)).all()
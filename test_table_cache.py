@@ -0,0 +1,73 @@
+import table_cache as tc
+import pandas as pd
+import numpy as np
+import os
+
+def write_table(path, table):
+    table.to_csv(path, sep='\t', index=False)
+    return str(path)
+
+def test_cache_round_trip(tmp_path):
+    path = write_table(tmp_path / "table.txt", pd.DataFrame({
+        'uid': [1, 2, 3, 4, 5],
+        'name': ["a", None, "b", "a", "c"],
+        'value': [0.5, 1.25, 3.0, None, 2.0],
+        'mixed': [1, 2, 3, 4, "x"]}))
+    expected = pd.read_csv(path, delimiter='\t', low_memory=False)
+    # Chunks smaller than the table, so 'mixed' is numeric in the first chunks and text in the last one
+    table = tc.open_table(path, chunksize=2, delimiter='\t', low_memory=False)
+    pd.testing.assert_frame_equal(table.read(), expected)
+    assert table.manifest['columns'][0]['dtype'] == 'int8'
+    assert table.manifest['columns'][2]['dtype'] == 'float32'
+
+def test_cache_reads_selected_columns_and_rows(tmp_path):
+    path = write_table(tmp_path / "table.txt", pd.DataFrame({'uid': [1, 2, 3], 'name': ["a", "b", "a"]}))
+    table = tc.open_table(path, delimiter='\t')
+    result = table.read(['name'], rows=np.array([0, 2]), categorical=True)
+    assert list(result.columns) == ['name']
+    assert result['name'].dtype == 'category'
+    assert result['name'].tolist() == ["a", "a"]
+
+def test_cache_rebuilds_when_source_changes(tmp_path):
+    path = write_table(tmp_path / "table.txt", pd.DataFrame({'uid': [1, 2, 3]}))
+    assert tc.read_table(path, delimiter='\t')['uid'].tolist() == [1, 2, 3]
+    write_table(tmp_path / "table.txt", pd.DataFrame({'uid': [7, 8, 9, 10]}))
+    assert tc.read_table(path, delimiter='\t')['uid'].tolist() == [7, 8, 9, 10]
+    # Touching the file without changing it keeps the cache
+    manifest_path = os.path.join(tc.default_cache_dir(path), "table.txt", "manifest.json")
+    built = os.stat(manifest_path).st_mtime_ns
+    os.utime(path, ns=(built + 10**9, built + 10**9))
+    assert tc.read_table(path, delimiter='\t')['uid'].tolist() == [7, 8, 9, 10]
+    assert tc.open_table(path, delimiter='\t').manifest['source']['mtime_ns'] == built + 10**9
+
+def test_builds_are_private_and_cleaned_up(tmp_path):
+    path = write_table(tmp_path / "table.txt", pd.DataFrame({'uid': [1, 2, 3]}))
+    directory = os.path.join(tc.default_cache_dir(path), "table.txt")
+    # Two runs building at once get their own build directory
+    assert tc.make_build_dir(directory) != tc.make_build_dir(directory)
+    for name in os.listdir(tc.default_cache_dir(path)):
+        os.rmdir(os.path.join(tc.default_cache_dir(path), name))
+    tc.read_table(path, delimiter='\t')
+    assert os.listdir(tc.default_cache_dir(path)) == ["table.txt"]
+
+def test_unwritable_cache_falls_back_to_the_text_files(tmp_path, monkeypatch):
+    # Input directory where nothing can be written (a read-only dataset mount)
+    import warnings
+    import tempfile
+    import functions_analyze_cefprozil_effect as fn
+    from test_functions_analyze_cefprozil_effect import write_small_inputs
+    sys_argv = write_small_inputs(tmp_path)
+    expected = fn.get_metadata(sys_argv, use_cache=False)
+    expected_abundance = fn.load_species_abundance_kingdom(sys_argv, [1, 2], expected[1], use_cache=False)
+    def read_only(*args, **kwargs):
+        raise PermissionError("read-only file system")
+    monkeypatch.setattr(tempfile, 'mkdtemp', read_only)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        metadata = fn.get_metadata(sys_argv)
+        species_abundance = fn.load_species_abundance_kingdom(sys_argv, [1, 2], metadata[1])
+    for table, expected_table in zip(metadata, expected):
+        pd.testing.assert_frame_equal(table, expected_table)
+    pd.testing.assert_frame_equal(species_abundance, expected_abundance)
+    assert any("reading the text file" in str(warning.message) for warning in caught)
+    assert os.listdir(tmp_path / ".table_cache") == []
@@ -0,0 +1,62 @@
+from test_functions_analyze_cefprozil_effect import write_small_inputs
+import functions_analyze_cefprozil_effect as fn
+import taxonomy_index as ti
+import pandas as pd
+import os
+
+def small_inputs_with_unknown_taxon(path):
+    sys_argv = write_small_inputs(path)
+    species_abundance = pd.read_csv(path / "species_abundance.txt", sep='\t')
+    unknown = pd.DataFrame({'uid': [9], 'loaded_uid': [1], 'ncbi_taxon_id': [999], 'relative_abundance': [5.0], 'taxon_rank_level': ["species"]})
+    pd.concat([species_abundance, unknown]).to_csv(path / "species_abundance.txt", sep='\t', index=False)
+    return sys_argv
+
+def test_index_join_matches_merge(tmp_path):
+    sys_argv = small_inputs_with_unknown_taxon(tmp_path)
+    samples_loaded, superkingdom, species_abundance, project, families_table = fn.get_raw_data(sys_argv, use_cache=False)
+    taxonomy = fn.load_taxonomy_index(sys_argv, superkingdom, families_table)
+    expected = fn.add_kingdom(species_abundance, superkingdom)
+    result = taxonomy.add_kingdom(species_abundance)
+    assert list(result.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(result.astype(object), expected.astype(object))
+    # The unknown taxon has no name, and becomes 'Other' like with the merge
+    selected_project_w_accession = fn.add_accession_id(samples_loaded, fn.filter_project(project))
+    for use_cache in [True, False]:
+        filtered = fn.stream_species_abundance(sys_argv, selected_project_w_accession, superkingdom, 2, use_cache, taxonomy)
+        assert "Other" in set(filtered['scientific_name'])
+        assert taxonomy.is_interned(filtered['scientific_name'])
+
+def test_family_abundance_through_index(tmp_path):
+    sys_argv = small_inputs_with_unknown_taxon(tmp_path)
+    samples_loaded, superkingdom, project, families_table = fn.get_metadata(sys_argv)
+    taxonomy = fn.load_taxonomy_index(sys_argv, superkingdom, families_table)
+    selected_project_w_accession = fn.add_accession_id(samples_loaded, fn.filter_project(project))
+    expected = fn.stream_species_abundance(sys_argv, selected_project_w_accession, superkingdom)
+    expected = fn.match_sample_name(selected_project_w_accession, expected)
+    expected = fn.cal_relative_abundance(fn.add_family(expected, families_table.copy()), selected_project_w_accession)
+    filtered = fn.stream_species_abundance(sys_argv, selected_project_w_accession, superkingdom, taxonomy=taxonomy)
+    result = fn.aggregate_family_abundance(fn.match_sample_name(selected_project_w_accession, filtered), families_table, selected_project_w_accession, taxonomy)
+    pd.testing.assert_frame_equal(result.astype({'family': object, 'sample_name': object}), expected.astype({'family': object, 'sample_name': object}))
+    assert "Other" in set(result['family'])
+
+def test_index_is_saved_and_rebuilt_on_change(tmp_path):
+    sys_argv = write_small_inputs(tmp_path)
+    samples_loaded, superkingdom, project, families_table = fn.get_metadata(sys_argv)
+    taxonomy = fn.load_taxonomy_index(sys_argv, superkingdom, families_table)
+    index_path = tmp_path / ".table_cache" / ti.INDEX_FILE
+    assert index_path.exists()
+    loaded = ti.TaxonomyIndex.load(str(index_path))
+    assert list(loaded.taxon_ids) == list(taxonomy.taxon_ids)
+    assert list(loaded.values['scientific_name']) == list(taxonomy.values['scientific_name'])
+    assert list(loaded.family_of_name) == list(taxonomy.family_of_name)
+    # Touching a file without changing it keeps the index, a new taxon rebuilds it
+    os.utime(tmp_path / "superkingdom2descendents.txt", ns=(1, 1))
+    assert list(fn.load_taxonomy_index(sys_argv, superkingdom, families_table).taxon_ids) == [10, 11, 12, 20]
+    superkingdom = pd.concat([superkingdom, pd.DataFrame({'ncbi_taxon_id': [5], 'scientific_name': ["Escherichia coli"], 'superkingdom': ["Bacteria"]})])
+    superkingdom.to_csv(tmp_path / "superkingdom2descendents.txt", sep='\t', index=False)
+    assert list(fn.load_taxonomy_index(sys_argv, superkingdom, families_table).taxon_ids) == [5, 10, 11, 12, 20]
+
+def test_duplicate_taxon_ids_fall_back_to_merges(tmp_path):
+    sys_argv = write_small_inputs(tmp_path)
+    samples_loaded, superkingdom, project, families_table = fn.get_metadata(sys_argv)
+    assert fn.load_taxonomy_index(sys_argv, pd.concat([superkingdom, superkingdom]), families_table) is None